@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare StreamDecoder against U6.processStreamData.
+
+Builds synthetic stream packets, checks that both decoders give identical
+output, then times each of them.
+
+    python benchmarks/bench_decode.py [rate] [seconds] [nchannels]
+"""
+import collections
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import u6  # noqa: E402
+from ljsacore import StreamDecoder  # noqa: E402
+
+SAMPLES_PER_PACKET = 25
+PACKETS_PER_REQUEST = 48
+
+
+def make_device(channels):
+    """An unopened U6 with stream settings as left by streamConfig."""
+    dev = u6.U6(autoOpen=False)
+    dev.streamSamplesPerPacket = SAMPLES_PER_PACKET
+    dev.streamChannelNumbers = channels
+    dev.streamChannelOptions = [0] * len(channels)
+    dev.streamChannelDuplicates = collections.Counter()
+    dev.streamPacketOffset = 0
+    return dev
+
+
+def make_results(nsamples):
+    """Raw streamData results holding nsamples random 16-bit samples."""
+    npackets = -(-nsamples // SAMPLES_PER_PACKET)
+    packet_size = 14 + 2 * SAMPLES_PER_PACKET
+    rng = np.random.default_rng(0)
+    packets = np.zeros((npackets, packet_size // 2), dtype='<u2')
+    packets[:, 6:6 + SAMPLES_PER_PACKET] = rng.integers(
+        0, 2**16, (npackets, SAMPLES_PER_PACKET))
+    raw = packets.tobytes()
+    request = packet_size * PACKETS_PER_REQUEST
+    return [raw[i:i + request] for i in range(0, len(raw), request)]
+
+
+def decode_per_packet(dev, results):
+    """The original StreamReader.fetch_data loop."""
+    data = {}
+    for result in results:
+        for k, v in dev.processStreamData(result).items():
+            if k in data:
+                data[k].extend(v)
+            else:
+                data[k] = v
+    return data
+
+
+def main(rate=50000, seconds=10, nchannels=4):
+    channels = list(range(nchannels))
+    results = make_results(int(rate * seconds))
+    print("%d channels, %d samples in %d reads." % (
+        nchannels, rate * seconds, len(results)))
+
+    dev = make_device(channels)
+    expected = decode_per_packet(dev, results)
+    actual = StreamDecoder(make_device(channels)).decode(results)
+    assert expected.keys() == actual.keys()
+    for k in expected:
+        assert np.array_equal(np.array(expected[k]), actual[k]), k
+    print("Outputs match.")
+
+    t_old = min(timeit.repeat(
+        lambda: decode_per_packet(make_device(channels), results),
+        number=1, repeat=3))
+    t_new = min(timeit.repeat(
+        lambda: StreamDecoder(make_device(channels)).decode(results),
+        number=1, repeat=3))
+    print("processStreamData: %8.1f ms" % (1000 * t_old))
+    print("StreamDecoder:     %8.1f ms" % (1000 * t_new))
+    print("Speedup:           %8.1f x" % (t_old / t_new))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure each stage of the processing pipeline with a simulated U6.
+
+Stages are acquire (StreamReader streaming continuously), decode, psd,
+plot data preparation and save. For each stage, reports sustained samples/s,
+median and 95th percentile latency per capture, peak memory allocated, and
+drop rate: the fraction of captures that took longer than the time between
+windows, so could not keep up in real time. For acquire, drops also count
+samples lost to injected device overflows.
+
+Results are written to benchmarks/results/<version>.json, where version is
+from git describe, and can be compared with an earlier run:
+
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/abc1234.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+from ljsacore import (DataHandler, SpectrumProcessor,  # noqa: E402
+                      StreamDecoder, StreamReader)
+from ljsasim import SimulatedU6  # noqa: E402
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+# Points per trace after plot data preparation, as for a typical display.
+PLOT_BINS = 2000
+
+
+def version():
+    try:
+        out = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return out.decode().strip()
+
+
+def make_device(args):
+    return SimulatedU6(signals=[(125., 1.), (1250., 0.1)], realtime=False,
+                       overflow_rate=args.overflow, seed=0)
+
+
+def acquire(args):
+    """Stream continuously, returning fetched windows and fetch times"""
+    source = StreamReader(device_factory=lambda: make_device(args))
+    source.set_channels(list(range(args.channels)))
+    source.set_sampling(rate=args.rate, time=args.time, overlap=args.overlap)
+    frames = []
+    times = []
+    if not source.start_acquisition(continuous=True):
+        raise RuntimeError(source.get_status())
+    t_start = time.perf_counter()
+    while len(frames) < args.captures:
+        data = source.fetch_data()
+        if data:
+            frames.append(data)
+            times.append(time.perf_counter())
+        elif not source.is_running():
+            raise RuntimeError(source.get_status())
+    source.stop_acquisition()
+    return frames, [t_start] + times
+
+
+def raw_reads(args):
+    """Raw streamData results, grouped into one list per window"""
+    dev = make_device(args)
+    channels = list(range(args.channels))
+    dev.streamConfig(NumChannels=len(channels), ChannelNumbers=channels,
+                     ChannelOptions=[0] * len(channels), ResolutionIndex=0,
+                     ScanFrequency=args.rate)
+    dev.streamStart()
+    stream = dev.streamData(convert=False)
+    per_read = dev.packetsPerRequest * dev.streamSamplesPerPacket
+    nreads = -(-int(args.rate * args.time * len(channels)) // per_read)
+    captures = [[next(stream)['result'] for i in range(nreads)]
+                for j in range(args.captures)]
+    dev.streamStop()
+    return dev, captures
+
+
+def measure(func, items):
+    """Time func on each item, then find peak memory over one more pass.
+
+    One untimed call first pays for lazy imports and thread pools."""
+    func(items[0])
+    latencies = []
+    for item in items:
+        t0 = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    for item in items:
+        func(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return latencies, peak
+
+
+def summarize(latencies, samples, budget, peak, lost=0.):
+    latencies = np.asarray(latencies)
+    late = np.count_nonzero(latencies > budget) / len(latencies)
+    return {'samples_per_s': samples * len(latencies) / latencies.sum(),
+            'latency_median_ms': 1000 * np.median(latencies),
+            'latency_p95_ms': 1000 * np.percentile(latencies, 95),
+            'peak_memory_mb': peak / 2**20,
+            'drop_rate': min(1., late + lost)}
+
+
+def run(args):
+    samples = int(np.ceil(args.rate * args.time)) * args.channels
+    hop = max(1, int(round(args.rate * args.time * (1 - args.overlap))))
+    # Time between windows: the budget for each stage to keep up.
+    budget = hop / args.rate
+    stages = {}
+
+    tracemalloc.start()
+    frames, times = acquire(args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # Windows are produced faster than real time, so some are replaced
+    # before they are fetched: spread the time over all windows published.
+    windows = np.diff([0] + [f['sequence'] for f in frames])
+    latencies = np.diff(times) / windows
+    fetched = sum(len(f['channels']) * f['new'] for f in frames)
+    lost = sum(f['dropped'] for f in frames) / (
+        fetched + sum(f['dropped'] for f in frames))
+    stages['acquire'] = summarize(latencies, hop * args.channels, budget,
+                                  peak, lost)
+
+    dev, captures = raw_reads(args)
+    decoder = StreamDecoder(dev)
+    latencies, peak = measure(decoder.decode, captures)
+    stages['decode'] = summarize(latencies, samples, budget, peak)
+
+    for f in frames:
+        f.update(prefactor=1.0, unit='V')
+    processor = SpectrumProcessor()
+    latencies, peak = measure(processor.process, frames)
+    stages['psd'] = summarize(latencies, samples, budget, peak)
+
+    try:
+        from labjacksa import minmax_envelope, peak_bins
+    except ImportError as e:
+        print("Skipping plot stage: %s" % e)
+    else:
+        processed = [processor.process(f) for f in frames]
+
+        def prepare(frame):
+            for k, y in frame['channels'].items():
+                # Scaled as LiveFigure does, once decimated.
+                reduced = minmax_envelope(frame['times'], y, PLOT_BINS)
+                if reduced is not None:
+                    np.multiply(frame['prefactor'], reduced[1:])
+                freqs, psd = frame['spectra'][k]
+                peak_bins(freqs, psd, PLOT_BINS)
+
+        latencies, peak = measure(prepare, processed)
+        stages['plot'] = summarize(latencies, samples, budget, peak)
+
+    with tempfile.TemporaryDirectory() as path:
+        writer = DataHandler(fmt='binary')
+        paths = iter(os.path.join(path, "%d.ljsa" % i) for i in range(
+            2 * len(frames) + 1))
+        latencies, peak = measure(
+            lambda f: writer.save_one(next(paths), f), frames)
+        stages['save'] = summarize(latencies, samples, budget, peak)
+    return stages
+
+
+def show(stages, previous=None):
+    columns = ('samples_per_s', 'latency_median_ms', 'latency_p95_ms',
+               'peak_memory_mb', 'drop_rate')
+    print("%-8s %14s %12s %12s %10s %8s" % (
+        "stage", "samples/s", "median ms", "p95 ms", "peak MB", "drops"))
+    for name, r in stages.items():
+        print("%-8s %14.3g %12.2f %12.2f %10.1f %8.3f" % (
+            (name,) + tuple(r[c] for c in columns)))
+        if previous and name in previous['stages']:
+            p = previous['stages'][name]
+            # Ratio to the previous run: above 1 is better for throughput,
+            # worse for everything else.
+            print("%-8s %13.2fx %11.2fx %11.2fx %9.2fx %8.3f" % (
+                ("  ratio",)
+                + tuple(r[c] / p[c] if p[c] else float('nan')
+                        for c in columns[:-1])
+                + (r['drop_rate'] - p['drop_rate'],)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--rate', type=int, default=12500,
+                        help="per-channel sampling rate in Hz")
+    parser.add_argument('--time', type=float, default=2,
+                        help="window length in seconds")
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--captures', type=int, default=20)
+    parser.add_argument('--overflow', type=float, default=0.01,
+                        help="fraction of reads with a device overflow")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="results of an earlier run to compare with")
+    parser.add_argument('--output', metavar='FILE',
+                        help="where to write results (default: "
+                             "benchmarks/results/<version>.json)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    previous = None
+    if args.compare:
+        with open(args.compare) as fh:
+            previous = json.load(fh)
+    print("%d channels at %d Hz, %g s windows, %g overlap, %d captures." % (
+        args.channels, args.rate, args.time, args.overlap, args.captures))
+    stages = run(args)
+    results = {'version': version(),
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'numpy': np.__version__, 'machine': platform.machine(),
+               'config': {k: v for k, v in vars(args).items()
+                          if k not in ('compare', 'output')},
+               'stages': stages}
+    show(stages, previous)
+    output = args.output or os.path.join(RESULTS,
+                                         "%s.json" % results['version'])
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fh:
+        json.dump(results, fh, indent=2)
+    print("Results written to %s." % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time LiveFigure updates and redraws, with and without fast rendering.
+
+Uses the Agg canvas, so no display is needed; Tk adds the cost of copying
+the blitted regions to the screen.
+
+    python benchmarks/bench_plot.py [rate] [seconds] [nchannels]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from labjacksa import LiveFigure  # noqa: E402
+from ljsacore import SpectrumProcessor  # noqa: E402
+
+
+def make_data(rate, seconds, nchannels, seed):
+    rng = np.random.default_rng(seed)
+    npoints = int(rate * seconds)
+    t = np.arange(npoints) / rate
+    channels = {"AIN%d" % i: np.sin(2 * np.pi * 125 * (i + 1) * t)
+                + 0.1 * rng.standard_normal(npoints)
+                for i in range(nchannels)}
+    return {'rate': rate, 'points': npoints, 'dropped': 0,
+            'prefactor': 1.0, 'unit': 'V', 'channels': channels}
+
+
+def run(fast, frames, repeats=5):
+    fig = LiveFigure(figsize=(10, 6), dpi=100)
+    FigureCanvasAgg(fig)
+    fig.set_fast(fast)
+    fig.rescale()
+    # First update creates lines and does a full draw.
+    fig.on_data(frames[0])
+    fig.redraw()
+    t_update = []
+    t_draw = []
+    for i in range(repeats):
+        data = frames[(i + 1) % len(frames)]
+        t0 = time.perf_counter()
+        fig.on_data(data)
+        t1 = time.perf_counter()
+        fig.redraw()
+        t2 = time.perf_counter()
+        t_update.append(t1 - t0)
+        t_draw.append(t2 - t1)
+    return np.median(t_update), np.median(t_draw)
+
+
+def main(rate=12500, seconds=10.0, nchannels=4):
+    processor = SpectrumProcessor()
+    frames = [processor.process(make_data(rate, seconds, nchannels, seed))
+              for seed in range(2)]
+    print("%d channels of %d points." % (nchannels, frames[0]['points']))
+    print("%-6s %12s %12s" % ("mode", "update ms", "redraw ms"))
+    for fast in (False, True):
+        t_update, t_draw = run(fast, frames)
+        print("%-6s %12.1f %12.1f" % ("fast" if fast else "full",
+                                      1000 * t_update, 1000 * t_draw))
+
+
+if __name__ == '__main__':
+    main(*[t(a) for t, a in zip((int, float, int), sys.argv[1:])])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare SpectralEngine against a call to periodogram per channel.
+
+The per-call path is what SpectrumProcessor did for each capture: a new
+time axis with linspace, a scaled copy of each channel, and a periodogram
+of each, which builds the window and frequencies every time. The engine
+path uses a cached time axis and plan, and transforms all channels at
+once. Checks that both give the same spectra, then times each of them.
+
+    python benchmarks/bench_spectral.py [rate] [seconds] [nchannels]
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+from scipy.signal import periodogram
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from ljsacore import SpectralEngine  # noqa: E402
+
+PREFACTOR = 0.1
+
+
+def per_call(channels, rate):
+    """The original per-capture path"""
+    npoints = len(channels[0])
+    np.linspace(0, npoints / rate, npoints)
+    spectra = []
+    for v in channels:
+        v = np.multiply(PREFACTOR, v)
+        spectra.append(periodogram(v, fs=rate, window='hann',
+                                   scaling='density'))
+    return spectra
+
+
+def cached(engine, channels, rate):
+    freqs, psd = engine.psd(channels, rate, scale=PREFACTOR ** 2)
+    return [(freqs, p) for p in psd]
+
+
+def main(rate=12500, seconds=2.0, nchannels=4):
+    rng = np.random.default_rng(0)
+    npoints = int(rate * seconds)
+    channels = [rng.standard_normal(npoints) for i in range(nchannels)]
+    engine = SpectralEngine()
+    for (f0, p0), (f1, p1) in zip(per_call(channels, rate),
+                                  cached(engine, channels, rate)):
+        assert np.allclose(f0, f1) and np.allclose(p0, p1)
+    print("Outputs match.")
+    print("%d channels of %d points." % (nchannels, npoints))
+    t_old = min(timeit.repeat(lambda: per_call(channels, rate),
+                              number=10, repeat=5)) / 10
+    t_new = min(timeit.repeat(lambda: cached(engine, channels, rate),
+                              number=10, repeat=5)) / 10
+    # A new plan each time, as after every change of sampling settings.
+    t_cold = min(timeit.repeat(
+        lambda: (engine.clear(), cached(engine, channels, rate)),
+        number=10, repeat=5)) / 10
+    print("periodogram per channel: %8.2f ms" % (1000 * t_old))
+    print("SpectralEngine:          %8.2f ms" % (1000 * t_new))
+    print("SpectralEngine, no plan: %8.2f ms" % (1000 * t_cold))
+    print("Speedup:                 %8.1f x" % (t_old / t_new))
+
+
+if __name__ == '__main__':
+    main(*[t(a) for t, a in zip((int, float, int), sys.argv[1:])])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare size and speed of the JSON, binary and archive capture formats.
+
+    python benchmarks/bench_storage.py [rate] [seconds] [nchannels]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from ljsacore import DataHandler  # noqa: E402
+
+# Nominal U6 calibration for the +/-10 V range.
+CENTER = 33523.0
+SLOPE = 3.1580578e-4
+# Timed writes and reads of each format, after one untimed warm-up.
+REPEATS = 5
+
+
+def make_capture(rate, seconds, nchannels):
+    """A capture of quantized sine waves plus noise"""
+    rng = np.random.default_rng(0)
+    npoints = int(rate * seconds)
+    t = np.arange(npoints) / rate
+    channels = {}
+    for i in range(nchannels):
+        volts = np.sin(2 * np.pi * 125 * (i + 1) * t)
+        volts += 0.05 * rng.standard_normal(npoints)
+        counts = np.round(CENTER + volts / SLOPE)
+        channels["AIN%d" % i] = (counts - CENTER) * SLOPE
+    return {'prefactor': 1.0, 'unit': 'V', 'rate': rate,
+            'points': npoints, 'dropped': 0, 'channels': channels}
+
+
+def timed(fn, paths):
+    """Median time of fn on each path, after an untimed call on the first,
+    which pays for any first imports and allocations"""
+    fn(paths[0])
+    times = []
+    for fpath in paths[1:]:
+        t = time.perf_counter()
+        fn(fpath)
+        times.append(time.perf_counter() - t)
+    return np.median(times)
+
+
+def main(rate=12500, seconds=10, nchannels=4):
+    data = make_capture(rate, seconds, nchannels)
+    handler = DataHandler()
+    print("%d channels of %d points." % (nchannels, data['points']))
+    print("%-8s %10s %10s %10s" % ("format", "MB", "write ms", "read ms"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt, ext in DataHandler.EXTENSIONS.items():
+            # A new file for each write, as archives are appended to.
+            paths = [os.path.join(tmp, "capture%d%s" % (i, ext))
+                     for i in range(REPEATS + 1)]
+            t_write = timed(
+                lambda fpath: handler.save_one(fpath, data, fmt=fmt), paths)
+            # Touch every sample, so memory-mapped data are actually read.
+            t_read = timed(
+                lambda fpath: {k: np.asarray(v, dtype=float).sum() for k, v in
+                               handler.load_one(fpath)['channels'].items()},
+                paths)
+            fpath = paths[0]
+            check = handler.load_one(fpath)['channels']
+            for k, v in data['channels'].items():
+                assert np.array_equal(v, np.asarray(check[k])), (fmt, k)
+            del check
+            print("%-8s %10.2f %10.1f %10.1f" % (
+                fmt, os.path.getsize(fpath) / 2**20,
+                1000 * t_write, 1000 * t_read))
+
+
+if __name__ == '__main__':
+    main(*[t(a) for t, a in zip((int, float, int), sys.argv[1:])])
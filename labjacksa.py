@@ -17,289 +17,125 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-import numpy as np
-from scipy.signal import periodogram
+import os
 import threading
-from collections import deque
-import json
 import time
-import tkinter.ttk
-import os
+from concurrent.futures import ThreadPoolExecutor
 
-from typing import List, Optional
+import numpy as np
+import tkinter.ttk
 
 import tkinter
 from matplotlib.backends.backend_tkagg import (
     FigureCanvasTkAgg, NavigationToolbar2Tk)
 # Implement the default Matplotlib key bindings.
+from matplotlib import colormaps
 from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
 
-import u6
-
-MAXSAMPLERATE = 50000
-
-
-class StreamReader():
-    def __init__(self):
-        # A buffer for incoming data. Use deque for fast writes.
-        self.buffer = deque()
-        # Integration time in seconds
-        self._t_integrate = 2
-        # Data required
-        self.data_request = threading.Event()
-        # Data ready for processing
-        self.data_ready = threading.Event()
-        # Collection thread should stop
-        self.data_stop = threading.Event()
-        # Connecton to U6 hardware.
-        self._device = None
-        # Data collection thread.
-        self._acq_thread = None
-        # List of channels to collect
-        self._channels = []
-        # Sampling rate
-        self._rate = 5000
-        # Status callback
-        self.status = ""
-
-    def connect(self):
-        self._device = u6.U6()
-        self._device.getCalibrationData()
-        # Set up a frequency source for testing.
-        self._device.configIO(NumberTimersEnabled=1)
-        # 1MHz / 250 = 4 kHz
-        self._device.configTimerClock(3, 250)
-        # 4KHz / 2 * 16 = 125 Hz
-        self._device.getFeedback(u6.Timer0Config(7, 16))
-
-    def __del__(self):
-        """Close connection to hardware"""
-        if self._device is not None:
-            try:
-                self._device.streamStop()
-            except Exception:
-                pass
-            self._device.close()
-
-    def is_running(self):
-        """Return True if acquisition thread is running"""
-        return self._acq_thread is not None and self._acq_thread.is_alive()
-
-    def set_channels(self, channels: List[int]):
-        """Set list of channels to acquire"""
-        if self.is_running():
-            self.stop_acquisition()
-            self._channels = channels
-            self.start_acquisition()
-        else:
-            self._channels = channels
+from ljsacore import (MAXSAMPLERATE, DataHandler, FeatureLog,
+                      FramePublisher, MetricsLogger, MetricsServer,
+                      SpectrumAverager, SpectrumProcessor, SessionArchive,
+                      Trigger, metrics, open_u6, parse_condition,
+                      stream_source)
 
-    def set_sampling(self, rate: Optional[int] = None,
-                     time: Optional[float] = None):
-        if self.is_running():
-            self.stop_acquisition()
-            restart = True
-        else:
-            restart = False
-        if rate is not None:
-            self._rate = rate
-        if time is not None:
-            self._t_integrate = time
-        if restart:
-            self.start_acquisition()
-
-    def start_acquisition(self):
-        """Start data acquisition thread"""
-        if self._device is None:
-            try:
-                self.connect()
-            except Exception:
-                self.status = "No hardware connected."
-                return False
-        if len(self._channels) == 0:
-            self.status = "No channels selected."
-            return False
-        if self._rate > (MAXSAMPLERATE / len(self._channels)):
-            self.status = "Sample rate too high for %d channels." % \
-                          len(self._channels)
-            return False
-        if self._acq_thread is None or not self._acq_thread.is_alive():
-            self.data_stop.clear()
-            self._acq_thread = threading.Thread(target=self._acquire_loop,
-                                                daemon=True)
-            self._acq_thread.start()
-        self.data_request.set()
-        return True
-
-    def stop_acquisition(self):
-        """Stop data acquisition thread"""
-        self.data_request.clear()
-        self.data_stop.set()
-        if self._acq_thread:
-            self._acq_thread.join(2*self._t_integrate)
-            if self._acq_thread.is_alive():
-                self.status = "Acquisiton thread timed out"
-
-    def fetch_data(self):
-        """Fetch data and start another acquisition once buffer is empty"""
-        if not self.data_ready.wait(0.05):
-            return {}
-        self.data_ready.clear()
-        data = {}
-        dropped = 0
-        while len(self.buffer) > 0:
-            raw = self.buffer.popleft()
-            dropped += raw['missed']
-            processed = self._device.processStreamData(raw['result'])
-            for k, v in processed.items():
-                if k in data:
-                    data[k].extend(v)
-                else:
-                    data[k] = v
-        npoints = max(map(len, data.values()))
-        return {'rate': self._rate, 'points': npoints,
-                'channels': data, 'dropped': dropped}
-
-    def get_status(self):
-        return self.status
-
-    def _acquire_loop(self):
-        """Target for data acquisition thread."""
-        dev = self._device
-        try:
-            dev.streamStop()
-        except Exception:
-            pass
-        error = None
-        while not self.data_stop.is_set():
-            if not self.data_request.wait(0.01):
-                self.status = "Waiting"
-                continue
-            # Do acquisition
-            # Prevent data collection by client.
-            self.data_ready.clear()
-            self.buffer.clear()
-            # Grab and store local copy of current sampling settings, as
-            # these may change.
-            channels = self._channels
-            rate = self._rate
-            nchannels = len(self._channels)
-            if nchannels == 0:
-                self.data_stop.set()
-                break
-            try:
-                dev.streamConfig(NumChannels=nchannels,
-                                 ChannelNumbers=channels,
-                                 ChannelOptions=[0]*nchannels,
-                                 ResolutionIndex=0, ScanFrequency=rate)
-            except Exception as e:
-                self.status = "Error: %s" % e
-                continue
-            npts = 0
-            stream = dev.streamData(convert=False)
-            self.status = "Streaming"
-            dev.streamStart()
-            while npts < self._t_integrate * self._rate * nchannels:
-                if self.data_stop.is_set():
-                    break
-                try:
-                    raw = next(stream)
-                except Exception as e:
-                    import traceback
-                    import sys
-                    traceback.print_exc(file=sys.stderr)
-                    self.data_stop.set()
-                    error = e
-                    break
-                if raw is None:
-                    self.status = "Error: no data"
-                    continue
-                # if (raw['errors'] + raw['missed']) > 0:
-                #     print(raw['errors'], raw['missed'])
-                #     for pkt, err in enumerate(raw['result'][11::64]):
-                #         errNum = err
-                #         if errNum != 0:
-                #             #Error detected in this packet
-                #             print ("Packet", pkt, "error:", errNum)
-                npts += raw['numPackets'] * self._device.streamSamplesPerPacket
-                self.buffer.append(raw)
-            dev.streamStop()
-            if error is None:
-                self.data_request.clear()
-            if not self.data_stop.is_set():
-                # set event
-                self.data_ready.set()
-        if error is None:
-            self.status = "Stopped."
-        else:
-            self.status = "Aborted: %s" % error
 
+def minmax_envelope(x, y, nbins: int):
+    """Reduce y to its min and max in each of up to nbins bins.
 
-class DataHandler():
-    def __init__(self):
-        self._path = None
-        self._status = (None, "")
+    Returns (x, lo, hi), with x at the start of each bin, or None if y has
+    no more than 2 * nbins points and is better drawn as it is."""
+    n = len(y)
+    if nbins < 1 or n <= 2 * nbins:
+        return None
+    starts = np.arange(0, n, -(-n // nbins))
+    return (x[starts], np.minimum.reduceat(y, starts),
+            np.maximum.reduceat(y, starts))
 
-    def get_status(self):
-        if self._status[0] is None:
-            return ""
-        elif time.time() - self._status[0] > 5:
-            if self._path:
-                sstr = "Saving all to %s." % os.path.basename(self._path)
-                self._status = (time.time(), sstr)
-            else:
-                self._status = (None, "")
-        return self._status[1]
 
-    def save_continuous(self, data):
-        if self._path is None:
+def peak_bins(x, y, nbins: int):
+    """Reduce y to its maximum in each of nbins bins.
+
+    Returns (x, y) at the position of each maximum, so that peaks in a
+    spectrum keep their height and frequency."""
+    n = len(y)
+    if nbins < 1 or n <= nbins:
+        return x, y
+    # Bins of equal size, with the last one padded: a short remainder bin
+    # would leave one wide gap at the end.
+    size = -(-n // nbins)
+    nb = -(-n // size)
+    padded = np.full(nb * size, -np.inf)
+    padded[:n] = y
+    idx = np.argmax(padded.reshape(nb, size), axis=1)
+    idx += np.arange(0, nb * size, size)
+    return x[idx], y[idx]
+
+
+def _visible(x, y, lim):
+    """Return the parts of x and y within lim, plus a point either side"""
+    i0, i1 = np.searchsorted(x, sorted(lim))
+    return x[max(i0 - 1, 0):i1 + 1], y[max(i0 - 1, 0):i1 + 1]
+
+
+class RollingImage():
+    def __init__(self, nrows: int, ncols: int, cmap: str = 'viridis',
+                 range_db: float = 80.):
+        """Image of nrows rows that scrolls as rows are added.
+
+        Rows are stored twice, at i and i + nrows, so the image is always a
+        contiguous view with the oldest row first, and are colour-mapped as
+        they arrive, so adding rows costs time in proportion to the new
+        rows only. Values are shown in dB, over range_db below a limit
+        rounded up from the largest value; the whole image is mapped again
+        only when that limit changes."""
+        self.nrows = nrows
+        self._db = np.full((2 * nrows, ncols), np.nan, dtype=np.float32)
+        self._rgba = np.zeros((2 * nrows, ncols, 4), dtype=np.uint8)
+        # Position of the oldest row.
+        self._head = 0
+        self._cmap = colormaps[cmap]
+        self._range = range_db
+        # Colour limits in dB, set from the first rows.
+        self.clim = None
+
+    def add(self, rows):
+        """Add rows of linear values, replacing the oldest rows"""
+        if not len(rows):
             return
-        import datetime
-        ts = datetime.datetime.now().replace(microsecond=0).isoformat()
-        ts.replace(':', '')
-        i = 0
-        while True:
-            fpath = os.path.join(self._path, "{:s}_{:02d}.txt".format(ts, i))
-            if not os.path.exists(fpath):
-                break
-            i += 1
-        if self.save_one(fpath, data):
-            # There was an error
-            pass
+        rows = rows[-self.nrows:]
+        with np.errstate(divide='ignore'):
+            db = 10 * np.log10(rows)
+        idx = (self._head + np.arange(len(db))) % self.nrows
+        self._db[idx] = db
+        self._db[idx + self.nrows] = db
+        self._head = (self._head + len(db)) % self.nrows
+        peak = np.max(db)
+        if self.clim is None or peak > self.clim[1]:
+            self.autoscale()
         else:
-            self.status = (time.time(),
-                           "Saving all to %s." % os.path.basename(self._path))
-
-    def load_one(self, fpath):
-        with open(fpath, 'r') as fh:
-            return json.load(fh)
-
-    def save_one(self, fpath, data_in):
-        # Set key order for output.
-        data = dict.fromkeys(['prefactor', 'unit', 'rate',
-                              'points', 'dropped', 'channels'])
-        data.update(data_in)
-        status = "Writing to file %s." % os.path.basename(fpath)
-        with open(fpath, 'w') as fh:
-            try:
-                json.dump(data, fh)
-                status = "Save complete."
-            except Exception:
-                status = "Error writing to %s." % os.path.basename(fpath)
-        self._status = (time.time(), status)
-
-    def set_save_all(self, fpath):
-        self._path = fpath
-        self._status = (time.time(),
-                        "Saving all to %s." % os.path.basename(self._path))
-        if not os.path.exists(fpath):
-            try:
-                os.makedirs(fpath)
-            except Exception:
-                self._status = (time.time(), "Error creating folders.")
-
-    def clear_save_all(self):
-        self._path = None
+            rgba = self._colour(db)
+            self._rgba[idx] = rgba
+            self._rgba[idx + self.nrows] = rgba
+
+    def autoscale(self):
+        """Set colour limits from all rows and map the whole image again"""
+        db = self._db[:self.nrows]
+        finite = db[np.isfinite(db)]
+        if not len(finite):
+            return
+        top = 10 * np.ceil(finite.max() / 10)
+        self.clim = (top - self._range, top)
+        self._rgba[:] = self._colour(self._db)
+
+    def _colour(self, db):
+        vmin, vmax = self.clim
+        # NaN, for rows not yet filled, maps to transparent.
+        return self._cmap((db - vmin) / (vmax - vmin), bytes=True)
+
+    def image(self):
+        """Return the RGBA image as a view, oldest row first"""
+        return self._rgba[self._head:self._head + self.nrows]
 
 
 class LiveFigure(Figure):
@@ -308,67 +144,385 @@ class LiveFigure(Figure):
         # Maintain a mapping
         self._lines = {}
         super().__init__(*args, **kwargs)
-        self._axes_t = self.add_subplot(211)
-        self._axes_f = self.add_subplot(212)
+        self._axes_t = self.add_subplot(311)
+        self._axes_f = self.add_subplot(312)
+        # Spectrogram, sharing its frequency axis with the spectra.
+        self._axes_s = self.add_subplot(313, sharex=self._axes_f)
         self._axes_f.set_yscale('log')
         self._axes_t.set_xlabel('s')
         self._axes_t.xaxis.set_label_coords(1.01, -0.01)
         self._axes_f.set_xlabel('Hz')
         self._axes_f.xaxis.set_label_coords(1.01, -0.01)
         self._rescale = False
+        # Fast mode: decimate traces to the axes' pixel width, and blit
+        # lines over a cached background rather than redrawing everything.
+        self._fast = True
+        # Full-resolution (x, y, scale) data for each line: time traces are
+        # kept unscaled, and multiplied by the prefactor once decimated.
+        self._data = {}
+        # Cached axes backgrounds for blitting, or None if stale.
+        self._backgrounds = None
+        # Channels shown in the legend.
+        self._legend_keys = None
+        # Filled min/max envelopes that replace decimated time traces:
+        # much cheaper to render than a line zig-zagging between extremes.
+        self._envelopes = {}
+        # Show the spectrogram axes; its image, the rolling buffer behind
+        # it, and the (channel, shape, row period) the buffer was made for.
+        self._show_spectrogram = False
+        self._image = None
+        self._rolling = None
+        self._rolling_key = None
+        self._axes_s.set_xlabel('Hz')
+        self._axes_s.xaxis.set_label_coords(1.01, -0.01)
+        self._layout()
+        for ax in self.axes:
+            ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
+        # Canvas callbacks belong to the figure, so survive a new canvas.
+        self.canvas.mpl_connect('draw_event', self._on_draw)
 
     def rescale(self):
         """Rescale on next update"""
         self._rescale = True
 
+    def set_fast(self, fast: bool):
+        """Enable or disable decimated, blitted rendering"""
+        self._fast = fast
+        for k, line in self._lines.items():
+            line.set_animated(fast)
+            self._set_line_data(k)
+        for envelope in self._envelopes.values():
+            envelope.set_animated(fast)
+        if self._image is not None:
+            self._image.set_animated(fast)
+        self._backgrounds = None
+
+    def set_spectrogram(self, show: bool):
+        """Show or hide the spectrogram below the spectra"""
+        self._show_spectrogram = show
+        self._layout()
+        self._backgrounds = None
+
+    def _layout(self):
+        """Stack the visible axes"""
+        axes = [self._axes_t, self._axes_f]
+        if self._show_spectrogram:
+            axes.append(self._axes_s)
+        self._axes_s.set_visible(self._show_spectrogram)
+        grid = self.add_gridspec(len(axes), 1)
+        for ax, spec in zip(axes, grid):
+            ax.set_subplotspec(spec)
+            ax.set_position(spec.get_position(self))
+
+    def redraw(self):
+        """Draw changes to the figure.
+
+        In fast mode, only the lines are redrawn, over cached backgrounds,
+        unless something else has changed."""
+        canvas = self.canvas
+        if not self._fast or self._backgrounds is None:
+            canvas.draw()
+            return
+        for ax, background in self._backgrounds.items():
+            canvas.restore_region(background)
+            self._draw_animated(ax)
+            canvas.blit(ax.bbox)
+
+    def _draw_animated(self, ax):
+        for artist in ax.get_children():
+            if artist.get_animated() and artist.get_visible():
+                ax.draw_artist(artist)
+
+    def _on_draw(self, event):
+        """Cache backgrounds after a full draw, then draw animated lines"""
+        if not self._fast:
+            self._backgrounds = None
+            return
+        canvas = self.canvas
+        self._backgrounds = {ax: canvas.copy_from_bbox(ax.bbox)
+                             for ax in (self._axes_t, self._axes_f,
+                                        self._axes_s)
+                             if ax.get_visible()}
+        for ax in self._backgrounds:
+            self._draw_animated(ax)
+
+    def _on_xlim_changed(self, ax):
+        """Decimate again for the new view, e.g. after zooming"""
+        if not self._fast:
+            return
+        for k, line in self._lines.items():
+            if line.axes is ax:
+                self._set_line_data(k)
+
+    def _set_line_data(self, k, whole=False):
+        """Set line data from full-resolution data, decimated if fast.
+
+        Decimation covers only the current view unless whole is True."""
+        line = self._lines[k]
+        x, y, scale = self._data[k]
+        envelope = self._envelopes.get(k)
+        if self._fast and len(x):
+            ax = line.axes
+            if not whole:
+                x, y = _visible(x, y, ax.get_xlim())
+            nbins = max(int(ax.bbox.width), 1)
+            if envelope is None:
+                x, y = peak_bins(x, y, nbins)
+            else:
+                reduced = minmax_envelope(x, y, nbins)
+                if reduced is not None:
+                    xb, lo, hi = reduced
+                    if scale != 1:
+                        lo, hi = scale * lo, scale * hi
+                        if scale < 0:
+                            lo, hi = hi, lo
+                    # Envelopes have no edge, which would double the cost
+                    # of drawing them: keep them at least a pixel high.
+                    y0, y1 = ax.get_ylim()
+                    hi = np.maximum(hi, lo + abs(y1 - y0) / ax.bbox.height)
+                    envelope.set_xy(np.column_stack(
+                        (np.concatenate((xb, xb[::-1])),
+                         np.concatenate((hi, lo[::-1])))))
+                    envelope.set_visible(True)
+                    line.set_data([], [])
+                    return
+        if envelope is not None:
+            envelope.set_visible(False)
+        line.set_data(x, y if scale == 1 else scale * y)
+
     def on_data(self, data={}):
-        """Update the plots with incoming data"""
-        x = np.linspace(0, data['points'] / data['rate'], data['points'])
+        """Update the plots with a frame from SpectrumProcessor"""
+        x = data['times']
         # Remove lines not found in data.
         for k in set(self._lines):
             if k.lstrip('f_') not in data['channels']:
                 self._lines.pop(k).remove()
+                self._data.pop(k)
+                if k in self._envelopes:
+                    self._envelopes.pop(k).remove()
+                self._backgrounds = None
         # Add or update line for incoming data.
-        for k, v_as_list in data['channels'].items():
-            v = np.multiply(data['prefactor'], v_as_list)
-            f, p = periodogram(v, fs=data['rate'],
-                               window='hann', scaling='density')
+        prefactor = data['prefactor']
+        for k, v in data['channels'].items():
+            v = np.asarray(v)
+            f, p = self._freq_trace(data, k)
+            self._data[k] = (x[:len(v)], v, prefactor)
+            self._data['f_' + k] = (np.asarray(f), np.asarray(p), 1)
             if k not in self._lines:
-                pts = len(v)
-                self._lines[k] = self._axes_t.plot(x[:pts], v)[0]
-                self._lines['f_' + k] = self._axes_f.plot(f, p)[0]
-            else:
-                self._lines[k].set_xdata(x)
-                self._lines[k].set_ydata(v)
-                self._lines['f_' + k].set_xdata(f)
-                self._lines['f_' + k].set_ydata(p)
-            if not k.startswith('f_'):
-                self._lines[k].set_label(k)
-            else:
-                self._lines[k].set_label(None)
-        # Update the legend.
-        self.legends = [self.legend(mode='expand', ncol=4)]
+                self._lines[k] = self._axes_t.plot([], [], label=k,
+                                                   animated=self._fast)[0]
+                self._lines['f_' + k] = self._axes_f.plot(
+                    [], [], animated=self._fast)[0]
+                self._envelopes[k] = self._axes_t.add_patch(Polygon(
+                    np.zeros((0, 2)), closed=True, visible=False,
+                    animated=self._fast, color=self._lines[k].get_color(),
+                    linewidth=0))
+                self._backgrounds = None
+            self._set_line_data(k, self._rescale)
+            self._set_line_data('f_' + k, self._rescale)
+        if 'spectrogram' in data:
+            self._add_spectrogram_rows(data['spectrogram'])
+        # Update the legend if channels have changed.
+        keys = list(data['channels'])
+        if keys != self._legend_keys:
+            for legend in list(self.legends):
+                legend.remove()
+            # At most two rows, however many channels.
+            self.legend(mode='expand', ncol=max(4, -(-len(keys) // 2)))
+            self._legend_keys = keys
+        # Update labels only if changed, so backgrounds stay valid.
+        cross = data.get('cross')
+        flabel = data['unit'] + " / $\\sqrt{\\mathrm{Hz}}$"
+        if cross is not None:
+            flabel = ("coherence with %s" if cross['mode'] == 'coherence'
+                      else "|" + cross['mode'] + "| re %s") % cross['reference']
+        for ax, label in ((self._axes_t, data['unit']),
+                          (self._axes_f, flabel)):
+            if ax.get_ylabel() != label:
+                ax.set_ylabel(label)
+                self._backgrounds = None
+        scale = ('linear' if cross is not None and cross['mode'] == 'coherence'
+                 else 'log')
+        if self._axes_f.get_yscale() != scale:
+            self._axes_f.set_yscale(scale)
+            self._rescale = True
         # Rescale if requested.
-        self._axes_t.set_ylabel(data['unit'])
-        self._axes_f.set_ylabel(data['unit'] + " / $\\sqrt{\\mathrm{Hz}}$")
         if self._rescale:
-            for ax in self.axes:
+            self._time_limits()
+            for ax in (self._axes_f, self._axes_s):
                 ax.relim()
+            for ax in self.axes:
                 ax.autoscale_view()
+            if self._rolling is not None:
+                self._rolling.autoscale()
             self._rescale = False
+            self._backgrounds = None
+
+    def _freq_trace(self, data, k):
+        """Return the trace for channel k on the frequency axes: its
+        spectrum or, in cross-spectral mode, the magnitude of its coherence
+        or transfer function against the reference"""
+        cross = data.get('cross')
+        if cross is None:
+            return data['spectra'][k]
+        estimates = cross['estimates']
+        if estimates is None or k not in estimates[cross['mode']]:
+            return np.zeros(0), np.zeros(0)
+        return cross['freqs'], np.abs(estimates[cross['mode']][k])
+
+    def _time_limits(self):
+        """Set the time axes' data limits from the full-resolution traces.
+
+        Much quicker than relim, which finds the extent of each envelope
+        from its path, vertex by vertex."""
+        traces = [xys for k, xys in self._data.items()
+                  if self._lines[k].axes is self._axes_t and len(xys[0])]
+        if not traces:
+            return
+        lims = np.array([(x[0], min(s * y.min(), s * y.max()), x[-1],
+                          max(s * y.min(), s * y.max()))
+                         for x, y, s in traces])
+        self._axes_t.dataLim.update_from_data_xy(
+            [lims[:, :2].min(axis=0), lims[:, 2:].max(axis=0)], ignore=True)
+
+    def _add_spectrogram_rows(self, sg):
+        """Scroll new rows for the first channel into the spectrogram"""
+        if not sg['rows']:
+            return
+        k, rows = next(iter(sg['rows'].items()))
+        freqs = sg['freqs']
+        key = (k, sg['nrows'], len(freqs), sg['row_period'])
+        if key != self._rolling_key:
+            # New channel or settings: start a new image.
+            self._rolling = RollingImage(sg['nrows'], len(freqs))
+            self._rolling_key = key
+            extent = (freqs[0], freqs[-1], -sg['nrows'] * sg['row_period'],
+                      0)
+            if self._image is None:
+                self._image = self._axes_s.imshow(
+                    self._rolling.image(), origin='lower', aspect='auto',
+                    interpolation='nearest', extent=extent,
+                    animated=self._fast)
+            else:
+                self._image.set_extent(extent)
+            self._axes_s.set_ylabel("%s, s" % k)
+            self._backgrounds = None
+        self._rolling.add(rows)
+        self._image.set_data(self._rolling.image())
+
+
+class ReviewWindow(tkinter.Toplevel):
+    def __init__(self, master, archive, on_load):
+        """Browse the captures in a session archive by their previews.
+
+        The slider, or the arrow keys, step through captures, showing the
+        stored min/max trace and spectrum of each channel; "Load" passes
+        the full capture to on_load."""
+        super().__init__(master)
+        from tkinter.ttk import Button, Frame, Label
+        self._archive = archive
+        self._on_load = on_load
+        self.title("Review %s" % os.path.basename(archive.path))
+        self._fig = Figure(figsize=(8, 5))
+        self._axes_t = self._fig.add_subplot(211)
+        self._axes_f = self._fig.add_subplot(212)
+        self._axes_f.set_yscale('log')
+        self._axes_t.set_xlabel('s')
+        self._axes_f.set_xlabel('Hz')
+        FigureCanvasTkAgg(self._fig, master=self)
+        self._fig.canvas.get_tk_widget().pack(side=tkinter.TOP,
+                                              fill=tkinter.BOTH, expand=1)
+        bar = Frame(self)
+        self._index = tkinter.IntVar()
+        self._scale = tkinter.Scale(bar, orient=tkinter.HORIZONTAL,
+                                    from_=0, to=max(len(archive) - 1, 0),
+                                    variable=self._index, showvalue=False,
+                                    command=lambda *_: self._show())
+        self._scale.pack(side=tkinter.LEFT, fill=tkinter.X, expand=1)
+        Button(bar, text="Load", command=self._load).pack(side=tkinter.RIGHT)
+        bar.pack(fill=tkinter.X)
+        self._label = tkinter.StringVar()
+        Label(self, textvariable=self._label, anchor=tkinter.W).pack(
+            fill=tkinter.X)
+        self.bind('<Left>', lambda evt: self._step(-1))
+        self.bind('<Right>', lambda evt: self._step(1))
+        self._show()
+
+    def _step(self, n):
+        self._index.set(min(max(self._index.get() + n, 0),
+                            len(self._archive) - 1))
+        self._show()
+
+    def _show(self):
+        """Draw the preview of the selected capture"""
+        if not len(self._archive):
+            self._label.set("No captures.")
+            return
+        i = self._index.get()
+        entry = self._archive.index[i]
+        preview = self._archive.preview(i)
+        prefactor = entry['prefactor'] or 1.0
+        for ax in (self._axes_t, self._axes_f):
+            for artist in ax.lines + ax.collections:
+                artist.remove()
+            ax.set_prop_cycle(None)
+        t = preview['times']
+        for k, p in preview['channels'].items():
+            self._axes_t.fill_between(t, prefactor * p['min'],
+                                      prefactor * p['max'], label=k)
+            self._axes_f.plot(preview['frequencies'][1:],
+                              prefactor ** 2 * p['psd'][1:])
+        for ax in (self._axes_t, self._axes_f):
+            ax.relim()
+            ax.autoscale_view()
+        self._axes_t.set_ylabel(entry['unit'] or '')
+        when = (time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(entry['time']))
+                if entry['time'] else "")
+        self._label.set("Capture %d of %d    %s    %g Hz, %d points, "
+                        "%d dropped" % (i + 1, len(self._archive), when,
+                                        entry['rate'], entry['points'],
+                                        entry['dropped'] or 0))
+        self._fig.canvas.draw_idle()
+
+    def _load(self):
+        if len(self._archive):
+            self._on_load(self._archive.load(self._index.get()))
 
 
 class LJSAApp(tkinter.ttk.Frame):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, device_factories=None, labels=None,
+                 publisher=None, **kwargs):
         super().__init__(*args, **kwargs)
         from tkinter import TOP, BOTTOM, LEFT, RIGHT, BOTH
         from tkinter.ttk import Checkbutton, Button, Label, Frame
         # Acquire continuously
         self._continuous = False
-        # Data source
-        self._source = StreamReader()
+        # Data source, from the first U6 found unless other devices are
+        # given; channels from several devices are combined.
+        if device_factories is None:
+            device_factories = [open_u6]
+        self._source = stream_source(device_factories, labels)
+        # Starting and stopping acquisition waits for the acquisition
+        # thread, so is done in order on another thread.
+        self._control = ThreadPoolExecutor(1)
         # File writer
         self._writer = DataHandler()
+        # Scaling and spectra, off the Tk thread, which is woken by an
+        # event when a frame is ready.
+        self._processor = SpectrumProcessor(on_frame=self._frame_ready)
+        # Processed frames are also sent to any subscribers.
+        self._publisher = publisher
+        self._processor.set_publisher(publisher)
+        # Opened captures have their own processor, without averaging or
+        # publishing, so that live state is only touched by its thread.
+        self._review_processor = SpectrumProcessor(workers=1)
+        self.bind('<<FrameReady>>', self._on_frame_ready)
+        # Thread handing captures from the source to the processor, so
+        # that the Tk thread never waits for acquisition.
+        self._feed_stop = threading.Event()
+        self._feed_thread = threading.Thread(target=self._feed_loop,
+                                             daemon=True)
         # Last acquired data
         self.new_data = {}
         # Sampling frequency
@@ -377,13 +531,44 @@ class LJSAApp(tkinter.ttk.Frame):
         # Sampling integration time
         self._time = tkinter.IntVar()
         self._time.set(2)
+        # Overlap between windows in continuous mode
+        self._overlap = tkinter.DoubleVar()
+        self._overlap.set(0.0)
         # Data scaling
         self._scaling = {'prefactor': 1.0, 'unit': 'V'}
-        # Flag: save all data to a folder
+        # Spectrum averaging mode and segment length
+        self._average = tkinter.StringVar()
+        self._average.set('off')
+        self._nperseg = tkinter.IntVar()
+        self._nperseg.set(4096)
+        # Cross-spectral mode, against the first channel
+        self._cross = tkinter.StringVar()
+        self._cross.set('off')
+        # Decimated, blitted rendering
+        self._fast = tkinter.BooleanVar()
+        self._fast.set(True)
+        # Show pipeline timings in the status bar
+        self._show_metrics = tkinter.BooleanVar()
+        # Spectrogram display, its history in seconds and segment length
+        self._spectrogram = tkinter.BooleanVar()
+        self._history = tkinter.IntVar()
+        self._history.set(60)
+        self._sg_nperseg = tkinter.IntVar()
+        self._sg_nperseg.set(1024)
+        # Flag: save all data to a folder, and the format to save in
         self._save_all = tkinter.BooleanVar()
-        # Channel enable flags
-        self._channels = [tkinter.BooleanVar() for i in range(4)]
-        self._channels[0].set(True)
+        self._save_format = tkinter.StringVar()
+        self._save_format.set('binary')
+        # Flag: log features of each capture, and the FeatureLog, which
+        # is fed from the handoff thread.
+        self._log_features = tkinter.BooleanVar()
+        self._features = None
+        self._features_lock = threading.Lock()
+        # Channel enable flags for each device
+        self._channels = [[tkinter.BooleanVar() for i in range(4)]
+                          for f in device_factories]
+        for flags in self._channels:
+            flags[0].set(True)
         # Status display.
         self._status_label = tkinter.StringVar()
         # Main figure
@@ -397,14 +582,18 @@ class LJSAApp(tkinter.ttk.Frame):
         # Area for channel selection, start/stop/save controls and status.
         buttonbar = Frame(self, relief=tkinter.SUNKEN)
         Label(buttonbar, text="Channels").pack(side=LEFT)
-        for i, v in enumerate(self._channels):
-            cb = Checkbutton(buttonbar, text="AIN%d" % i, variable=v,
-                             command=self._on_channel_change)
-            cb.pack(side=LEFT, expand=0, padx=4)
+        for j, flags in enumerate(self._channels):
+            if len(self._channels) > 1:
+                Label(buttonbar, text=labels[j] if labels else str(j)).pack(
+                    side=LEFT, padx=4)
+            for i, v in enumerate(flags):
+                cb = Checkbutton(buttonbar, text="AIN%d" % i, variable=v,
+                                 command=self._on_channel_change)
+                cb.pack(side=LEFT, expand=0, padx=4)
         # Buttons, right to left
         buttons = [
                    ("Save last", self._save_current),
-                   ("Stop", self._source.stop_acquisition),
+                   ("Stop", self.stop),
                    ("Start", self.start),
                    ]
         for label, fn in buttons:
@@ -430,6 +619,9 @@ class LJSAApp(tkinter.ttk.Frame):
         self._menus['freq'] = tkinter.Menu(self, tearoff=False)
         self._menus['time'] = tkinter.Menu(self, tearoff=False)
         self._menus['scaling'] = tkinter.Menu(self, tearoff=False)
+        self._menus['average'] = tkinter.Menu(self, tearoff=False)
+        self._menus['display'] = tkinter.Menu(self, tearoff=False)
+        self._menus['save'] = tkinter.Menu(self, tearoff=False)
         # Populate sample-freq menu
         self._fill_freq_menu()
         # Populate sample-time menu
@@ -437,9 +629,71 @@ class LJSAApp(tkinter.ttk.Frame):
             txt = "%.2f s" % t
             self._menus['time'].add_radiobutton(label=txt, value=t,
                                                 variable=self._time)
+        self._menus['time'].add_separator()
+        for o in [0, 0.25, 0.5, 0.75]:
+            txt = "%d%% overlap" % (100 * o)
+            self._menus['time'].add_radiobutton(label=txt, value=o,
+                                                variable=self._overlap)
+        # Populate averaging menu
+        for mode in ('off',) + SpectrumAverager.MODES:
+            self._menus['average'].add_radiobutton(label=mode, value=mode,
+                                                   variable=self._average)
+        self._menus['average'].add_separator()
+        for n in [1024, 4096, 16384, 65536]:
+            txt = "%d-point segments" % n
+            self._menus['average'].add_radiobutton(label=txt, value=n,
+                                                   variable=self._nperseg)
+        self._menus['average'].add_separator()
+        for mode, txt in (('off', 'cross-spectra off'),
+                          ('coherence', 'coherence with first channel'),
+                          ('H1', '|H1| re first channel'),
+                          ('H2', '|H2| re first channel')):
+            self._menus['average'].add_radiobutton(label=txt, value=mode,
+                                                   variable=self._cross)
+        self._menus['average'].add_separator()
+        self._menus['average'].add_command(label='zoom band',
+                                           command=self._set_zoom)
+        self._menus['average'].add_command(label='zoom off',
+                                           command=lambda: self._set_zoom(False))
+        self._menus['average'].add_separator()
+        self._menus['average'].add_command(label='reset',
+                                           command=self._reset_average)
+        # Populate display menu
+        self._menus['display'].add_checkbutton(label='fast rendering',
+                                               variable=self._fast)
+        self._menus['display'].add_checkbutton(label='show metrics',
+                                               variable=self._show_metrics)
+        self._menus['display'].add_separator()
+        self._menus['display'].add_checkbutton(label='spectrogram',
+                                               variable=self._spectrogram)
+        for t in [30, 60, 300, 1800]:
+            txt = "%d s history" % t if t < 60 else "%d min history" % (t // 60)
+            self._menus['display'].add_radiobutton(label=txt, value=t,
+                                                   variable=self._history)
+        for n in [256, 1024, 4096]:
+            txt = "%d-point segments" % n
+            self._menus['display'].add_radiobutton(label=txt, value=n,
+                                                   variable=self._sg_nperseg)
+        # Populate save menu: the format for "save all", and a trigger to
+        # save only captures around events.
+        for fmt, txt in (('binary', 'binary files'), ('json', 'text files'),
+                         ('archive', 'session archive')):
+            self._menus['save'].add_radiobutton(
+                label="save all as %s" % txt, value=fmt,
+                variable=self._save_format)
+        self._menus['save'].add_separator()
+        self._menus['save'].add_command(label='set trigger',
+                                        command=self._set_trigger)
+        self._menus['save'].add_command(
+            label='clear trigger', command=lambda: self._writer.set_trigger(None))
+        self._menus['save'].add_separator()
+        self._menus['save'].add_checkbutton(label='log features',
+                                            variable=self._log_features,
+                                            command=self._on_log_features)
         # Sampling settings menus
         menubar = tkinter.Menu(self.master)
         menubar.add_command(label="Open", command=self._on_open)
+        menubar.add_command(label="Review", command=self._on_review)
         for k, m in self._menus.items():
             menubar.add_cascade(label=k.capitalize(), menu=m)
         self._menus['scaling'].add_command(label='set unit',
@@ -451,12 +705,25 @@ class LJSAApp(tkinter.ttk.Frame):
         # Traces on sampling variables to configure hardware and rescale axes.
         self._time.trace('w', lambda *_: self._source.set_sampling(time=self._time.get()))
         self._freq.trace('w', lambda *_: self._source.set_sampling(rate=self._freq.get()))
+        self._overlap.trace('w', lambda *_: self._source.set_sampling(overlap=self._overlap.get()))
         self._time.trace('w', lambda *_: self._fig.rescale())
         self._freq.trace('w', lambda *_: self._fig.rescale())
+        self._time.trace('w', lambda *_: self._processor.clear_cache())
+        self._freq.trace('w', lambda *_: self._processor.clear_cache())
+        self._average.trace('w', lambda *_: self._processor.set_averaging(mode=self._average.get()))
+        self._nperseg.trace('w', lambda *_: self._processor.set_averaging(nperseg=self._nperseg.get()))
+        self._average.trace('w', lambda *_: self._fig.rescale())
+        self._cross.trace('w', lambda *_: self._processor.set_cross(mode=self._cross.get()))
+        self._cross.trace('w', lambda *_: self._fig.rescale())
+        self._nperseg.trace('w', lambda *_: self._fig.rescale())
+        self._fast.trace('w', lambda *_: (self._fig.set_fast(self._fast.get()), self._fig.redraw()))
+        self._save_format.trace('w', lambda *_: self._writer.set_format(self._save_format.get()))
+        for var in (self._spectrogram, self._history, self._sg_nperseg):
+            var.trace('w', lambda *_: self._on_spectrogram_change())
         # Set channels on StreamReader to match initial selection.
         self._on_channel_change()
-        # Start polling
-        self._poll()
+        self._feed_thread.start()
+        self._update_status()
 
     def _about(self):
         from tkinter.messagebox import showinfo
@@ -477,18 +744,93 @@ class LJSAApp(tkinter.ttk.Frame):
                                              initialvalue=self._scaling['prefactor'])
         if pref is not None:
             self._scaling['prefactor'] = pref
+            self._reset_average()
+
+    def _set_trigger(self):
+        text = tkinter.simpledialog.askstring(
+            "Save: trigger", "Conditions, separated by spaces, e.g.\n"
+            "level:AIN0>0.5  level:AIN0<-0.5  rms:AIN1:0.1>0.2  "
+            "band:AIN0:100-200>1e-6", parent=self)
+        if not text:
+            return
+        try:
+            conditions = [parse_condition(t) for t in text.split()]
+        except ValueError as e:
+            from tkinter import messagebox
+            messagebox.showerror("Save: trigger", str(e))
+            return
+        pre = tkinter.simpledialog.askfloat(
+            "Save: trigger", "Seconds to save before each event",
+            parent=self, initialvalue=1.0, minvalue=0)
+        post = tkinter.simpledialog.askfloat(
+            "Save: trigger", "Seconds to save after each event",
+            parent=self, initialvalue=1.0, minvalue=0)
+        if pre is not None and post is not None:
+            self._writer.set_trigger(Trigger(conditions, pre, post))
+
+    def _set_zoom(self, zoom=True):
+        """Zoom spectra to a band, asking for it, or turn zoom off"""
+        if not zoom:
+            self._processor.set_zoom(None)
             self._fig.rescale()
+            return
+        nyquist = self._freq.get() / 2
+        lo = tkinter.simpledialog.askfloat(
+            "Average: zoom", "Lowest frequency in Hz", parent=self,
+            minvalue=0, maxvalue=nyquist)
+        if lo is None:
+            return
+        hi = tkinter.simpledialog.askfloat(
+            "Average: zoom", "Highest frequency in Hz", parent=self,
+            initialvalue=min(lo + 10, nyquist), minvalue=lo,
+            maxvalue=nyquist)
+        if hi is None or hi <= lo:
+            return
+        resolution = tkinter.simpledialog.askfloat(
+            "Average: zoom", "Resolution in Hz (1 / seconds of data)",
+            parent=self, initialvalue=0.01, minvalue=1e-4)
+        if resolution is not None:
+            self._processor.set_zoom((lo, hi), resolution)
+            self._fig.rescale()
+
+    def _on_spectrogram_change(self):
+        show = self._spectrogram.get()
+        self._processor.set_spectrogram(
+            history=self._history.get() if show else None,
+            nperseg=self._sg_nperseg.get())
+        self._fig.set_spectrogram(show)
+        self._fig.redraw()
+
+    def _reset_average(self):
+        self._processor.reset_average()
+        self._fig.rescale()
 
     def _on_open(self):
         from tkinter import filedialog
         filename = filedialog.askopenfilename()
         if not filename:
             return
-        data = self._writer.load_one(filename)
+        self._show_capture(self._writer.load_one(filename))
+
+    def _on_review(self):
+        from tkinter import filedialog, messagebox
+        filename = filedialog.askopenfilename(
+            filetypes=(("session archive", "*.ljsarc"),))
+        if not filename:
+            return
+        try:
+            archive = SessionArchive(filename)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Review", str(e))
+            return
+        ReviewWindow(self, archive, self._show_capture)
+
+    def _show_capture(self, data):
+        """Display a saved capture"""
         self.new_data = {}
         self._fig.rescale()
-        self._fig.on_data(data)
-        self._fig.canvas.draw()
+        self._fig.on_data(self._review_processor.process(data))
+        self._fig.redraw()
 
     def _on_save_all(self):
         if self._save_all.get():
@@ -502,6 +844,21 @@ class LJSAApp(tkinter.ttk.Frame):
         else:
             self._writer.clear_save_all()
 
+    def _on_log_features(self):
+        features = None
+        if self._log_features.get():
+            from tkinter import filedialog
+            folder = filedialog.askdirectory(title="Choose folder for the "
+                                             "feature log")
+            if folder:
+                features = FeatureLog(folder)
+            else:
+                self._log_features.set(False)
+        with self._features_lock:
+            if self._features is not None:
+                self._features.flush()
+            self._features = features
+
     def _fill_freq_menu(self):
         menu = self._menus.get('freq', None)
         if menu is None:
@@ -509,8 +866,9 @@ class LJSAApp(tkinter.ttk.Frame):
         # Clear the menu
         while menu.index(0) == 0:
             menu.delete(0)
-        n = sum(map(lambda c: c.get(), self._channels))
-        maxfreq = MAXSAMPLERATE // n
+        # The limit applies to each device.
+        n = max(sum(c.get() for c in flags) for flags in self._channels)
+        maxfreq = MAXSAMPLERATE // max(n, 1)
 
         for f in [500, 1000, 2000, 5000] + list(range(10000, maxfreq+5000, 5000)):
             if f > 1000:
@@ -524,8 +882,10 @@ class LJSAApp(tkinter.ttk.Frame):
         if not data:
             return
         from tkinter import filedialog
-        fname = filedialog.asksaveasfilename(filetypes=(("plain text",
-                                                         "*.txt"),))
+        fname = filedialog.asksaveasfilename(
+            defaultextension=".ljsa",
+            filetypes=(("binary", "*.ljsa"), ("plain text", "*.txt"),
+                       ("add to session archive", "*.ljsarc")))
         if fname:
             self._writer.save_one(fname, data)
 
@@ -534,16 +894,37 @@ class LJSAApp(tkinter.ttk.Frame):
             self._continuous = True
         else:
             self._continuous = False
-        self._source.start_acquisition()
+        self._control.submit(self._source.start_acquisition,
+                             continuous=self._continuous)
         self._fig.rescale()
 
-    def _poll(self):
-        # Poll for new data then initiate next poll event
-        new_data = self._source.fetch_data()
-        if new_data:
-            self._on_data(new_data)
-            if self._continuous:
-                self._source.start_acquisition()
+    def stop(self):
+        self._control.submit(self._source.stop_acquisition)
+
+    def _feed_loop(self):
+        """Target for the handoff thread: pass each capture on for saving
+        and processing"""
+        while not self._feed_stop.is_set():
+            data = self._source.fetch_data()
+            if data:
+                self._on_data(data)
+
+    def _frame_ready(self):
+        """Wake the Tk thread; called from the processing thread"""
+        try:
+            self.event_generate('<<FrameReady>>', when='tail')
+        except (RuntimeError, tkinter.TclError):
+            # Tk has shut down, or is not yet running.
+            pass
+
+    def _on_frame_ready(self, evt=None):
+        frame = self._processor.fetch()
+        if frame:
+            self._on_frame(frame)
+
+    def _update_status(self):
+        # Display any frame whose wake-up event was missed.
+        self._on_frame_ready()
         streamstatus = self._source.get_status()
         filestatus = self._writer.get_status()
         if self.new_data:
@@ -552,40 +933,115 @@ class LJSAApp(tkinter.ttk.Frame):
             dropped = "    Dropped %d of %d points.    " % (ndropped, ntot)
         else:
             dropped = ""
-        self._status_label.set("\t".join((streamstatus, dropped, filestatus)))
-        self.after(100, self._poll)
+        avgstatus = self._processor.get_status()
+        status = [streamstatus, dropped, avgstatus, filestatus]
+        if self._show_metrics.get():
+            status.append(metrics.summary())
+        self._status_label.set("\t".join(status))
+        self.after(250, self._update_status)
 
     def _quit(self):
+        self._feed_stop.set()
+        self._control.shutdown()
         self._source.stop_acquisition()
+        self._writer.flush(timeout=5)
+        with self._features_lock:
+            if self._features is not None:
+                self._features.flush()
+        if self._publisher is not None:
+            self._publisher.stop()
         self.quit()
         self.destroy()
 
     def _on_channel_change(self):
         """Update source channel config"""
-        channels = [i for (i, c) in enumerate(self._channels) if c.get()]
+        channels = [[i for (i, c) in enumerate(flags) if c.get()]
+                    for flags in self._channels]
+        if len(channels) == 1:
+            channels = channels[0]
         self._source.set_channels(channels)
-        if sum(channels) > 0:
+        if any(channels):
             self._fill_freq_menu()
         self._fig.rescale()
 
     def _on_data(self, data):
-        """Process incoming data"""
+        """Process incoming data; called from the handoff thread"""
         if not data:
             return
-        self.new_data = data
-        self.new_data.update(self._scaling)
-        self._fig.on_data(data)
-        if self._save_all.get():
-            self._writer.save_continuous(data)
+        data.update(self._scaling)
+        # Channel data are views into the acquisition buffer, which will be
+        # overwritten by the next acquisition; keep a copy for "Save last",
+        # the background writer and the processor.
+        self.new_data = dict(data, channels={
+            k: v if v.flags.owndata else np.array(v)
+            for k, v in data['channels'].items()})
+        # Does nothing unless "save all" is on.
+        self._writer.save_continuous(self.new_data)
+        with self._features_lock:
+            if self._features is not None:
+                self._features.add(self.new_data)
+        self._processor.submit(self.new_data)
+
+    def _on_frame(self, frame):
+        """Display a processed frame"""
+        t0 = time.perf_counter()
+        if 'ready_time' in frame:
+            metrics.observe('wake_ms', 1000 * (time.time()
+                                                - frame['ready_time']))
+        self._fig.on_data(frame)
         try:
-            self._fig.canvas.draw()
+            self._fig.redraw()
         except Exception as e:
-            print("Error in _fig.canvas.draw():", e)
+            print("Error in _fig.redraw():", e)
+        # Have Tk update the window now, to include it in the latency.
+        self._fig.canvas.get_tk_widget().update_idletasks()
+        metrics.observe('draw_ms', 1000 * (time.perf_counter() - t0))
+        if frame.get('end_time') is not None:
+            metrics.observe('latency_ms', 1000 * (time.time()
+                                                  - frame['end_time']))
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="LabJack spectrum analyzer")
+    parser.add_argument('--serial', type=int, nargs='+', metavar='SERIAL',
+                        help="serial numbers of U6 devices to stream from "
+                             "(default: the first found)")
+    parser.add_argument('--simulate', type=int, nargs='?', const=1,
+                        default=0, metavar='N',
+                        help="use N simulated U6 devices rather than hardware")
+    parser.add_argument('--metrics-log', metavar='FILE',
+                        help="append metrics to FILE as JSON lines")
+    parser.add_argument('--metrics-interval', type=float, default=10,
+                        help="seconds between metrics log entries")
+    parser.add_argument('--metrics-address', metavar='PORT|PATH',
+                        help="serve metrics over HTTP on a localhost port "
+                             "or Unix socket")
+    parser.add_argument('--publish', metavar='PORT|PATH',
+                        help="publish frames to subscribers on a localhost "
+                             "port or Unix socket")
+    args = parser.parse_args()
+    factories = labels = publisher = None
+    if args.simulate:
+        from ljsasim import SimulatedU6
+        labels = ["sim%d" % i for i in range(args.simulate)]
+        factories = [SimulatedU6] * args.simulate
+    elif args.serial:
+        import functools
+        labels = [str(s) for s in args.serial]
+        factories = [functools.partial(open_u6, s) for s in args.serial]
+    if args.metrics_log:
+        MetricsLogger(args.metrics_log, args.metrics_interval)
+    if args.metrics_address:
+        address = args.metrics_address
+        MetricsServer(int(address) if address.isdigit() else address)
+    if args.publish:
+        address = args.publish
+        publisher = FramePublisher(int(address) if address.isdigit()
+                                   else address)
     root = tkinter.Tk()
-    app = LJSAApp(root)
+    app = LJSAApp(root, device_factories=factories, labels=labels,
+                  publisher=publisher)
     app.pack(fill=tkinter.BOTH, expand=tkinter.YES)
     root.wm_title("LJSA")
     root.protocol("WM_DELETE_WINDOW", app._quit)
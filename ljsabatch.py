@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Batch process folders of LabJackSpectrumAnalyzer captures.
+
+    python ljsabatch.py [--output FILE] [--nperseg N] [--bands LO:HI ...]
+        FOLDER
+
+Computes a Welch power spectrum, band powers and summary statistics for
+each channel of every capture in FOLDER and its subfolders, using a pool of
+processes, along with the ensemble-averaged spectrum of each channel over
+all captures at the most common sampling rate. Results are written to one
+.npz file, by default FOLDER/ljsabatch.npz. Run again to add captures saved
+since: files already processed, and not changed since, are skipped. Each
+capture in a session archive is processed as ARCHIVE#N, for the Nth capture.
+
+Copyright (C) 2019 Mick Phillips <mick.phillips@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ljsacore import DataHandler, SessionArchive, parse_band
+
+# Summary statistics for each channel of each capture, in scaled units.
+STATS = ('mean', 'std', 'rms', 'min', 'max', 'peak_frequency',
+         'peak_density', 'power')
+# Seconds between saving partial results during a long run.
+CHECKPOINT = 60
+
+
+@functools.lru_cache(maxsize=4)
+def _open_archive(path, size):
+    """Archives open in this process, so that each index is read once.
+
+    Keyed on size as well as path, so that an archive appended to since it
+    was opened is opened again with its new captures."""
+    return SessionArchive(path)
+
+
+def load_capture(path):
+    """Load a capture file, or capture N of a session archive as ARCHIVE#N"""
+    base, sep, n = path.rpartition('#')
+    if sep and n.isdigit() and base.lower().endswith(
+            DataHandler.EXTENSIONS['archive']):
+        return _open_archive(base, os.path.getsize(base)).load(int(n))
+    return DataHandler().load_one(path)
+
+
+def analyse(path, nperseg, bands, window='hann'):
+    """Return spectra, band powers and statistics for one capture"""
+    from scipy.signal import welch
+    data = load_capture(path)
+    rate = data['rate']
+    result = {'rate': rate, 'points': data['points'],
+              'dropped': data.get('dropped', 0), 'channels': {}}
+    for k, v in data['channels'].items():
+        if len(v) < nperseg:
+            raise ValueError("%s has %d points, fewer than nperseg."
+                             % (k, len(v)))
+        v = np.multiply(data.get('prefactor', 1.0), v)
+        f, psd = welch(v, fs=rate, window=window, nperseg=nperseg)
+        df = f[1] - f[0]
+        peak = 1 + np.argmax(psd[1:])
+        stats = [v.mean(), v.std(), np.sqrt(np.mean(v * v)), v.min(),
+                 v.max(), f[peak], psd[peak], psd.sum() * df]
+        band_powers = [psd[(f >= lo) & (f < hi)].sum() * df
+                       for lo, hi in bands]
+        result['channels'][k] = {'psd': psd.astype(np.float32),
+                                 'stats': np.array(stats),
+                                 'bands': np.array(band_powers)}
+    return result
+
+
+def _analyse(path, **kwargs):
+    """analyse, returning errors rather than raising them, so that one bad
+    file does not stop the pool."""
+    try:
+        return analyse(path, **kwargs)
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+
+
+def find_captures(folder):
+    """Return (relative path, size, mtime) of captures under folder.
+
+    Archived captures never change, so each is given the size and offset
+    of its record in place of the file's size and mtime."""
+    extensions = set(DataHandler.EXTENSIONS.values())
+    found = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() not in extensions:
+                continue
+            path = os.path.join(root, name)
+            if name.lower().endswith(DataHandler.EXTENSIONS['archive']):
+                for i, e in enumerate(SessionArchive(path).index):
+                    found.append(("%s#%d" % (os.path.relpath(path, folder), i),
+                                  e['nbytes'], e['offset']))
+                continue
+            st = os.stat(path)
+            found.append((os.path.relpath(path, folder), st.st_size,
+                          st.st_mtime_ns))
+    return found
+
+
+def load_results(fpath):
+    """Load settings and per-file records from a results file.
+
+    Returns (settings, records), with records keyed by relative path, or
+    (None, {}) if there is no results file."""
+    if not os.path.exists(fpath):
+        return None, {}
+    with np.load(fpath, allow_pickle=False) as npz:
+        # Each access to an npz item reads it from the file.
+        arrays = {k: npz[k] for k in npz.files}
+    settings = json.loads(str(arrays['settings']))
+    names = [str(n) for n in arrays['files']]
+    records = {}
+    for i, name in enumerate(names):
+        records[name] = {
+            'size': int(arrays['sizes'][i]),
+            'mtime': int(arrays['mtimes'][i]),
+            'rate': float(arrays['rates'][i]),
+            'points': int(arrays['points'][i]),
+            'dropped': int(arrays['dropped'][i]), 'channels': {}}
+    for k in settings['channels']:
+        psd, stats, bands = (arrays[k + suffix]
+                             for suffix in ('_psd', '_stats', '_bands'))
+        for i, name in enumerate(names):
+            if not np.isnan(psd[i, 0]):
+                records[name]['channels'][k] = {
+                    'psd': psd[i], 'stats': stats[i], 'bands': bands[i]}
+    return settings, records
+
+
+def save_results(fpath, settings, records):
+    """Write settings, per-file records and ensemble spectra to fpath.
+
+    The file is replaced atomically, so an interrupted run leaves the last
+    complete results. Arrays for each channel have one row per file, NaN
+    where the file has no such channel. Ensemble spectra are over files at
+    the most common rate, for which frequencies are given; spectra for a
+    file at another rate have frequencies rfftfreq(nperseg, 1 / rate)."""
+    names = sorted(records)
+    channels = sorted({k for r in records.values() for k in r['channels']})
+    settings = dict(settings, channels=channels)
+    nfreq = settings['nperseg'] // 2 + 1
+    rates = np.array([records[n]['rate'] for n in names])
+    values, counts = np.unique(rates, return_counts=True)
+    rate = values[np.argmax(counts)]
+    arrays = {
+        'settings': np.array(json.dumps(settings)),
+        'files': np.array(names, dtype=str),
+        'sizes': np.array([records[n]['size'] for n in names], np.int64),
+        'mtimes': np.array([records[n]['mtime'] for n in names], np.int64),
+        'rates': rates,
+        'ensemble_rate': rate,
+        'points': np.array([records[n]['points'] for n in names], np.int64),
+        'dropped': np.array([records[n]['dropped'] for n in names],
+                            np.int64),
+        'frequencies': np.fft.rfftfreq(settings['nperseg'], 1 / rate),
+        'bands': np.array(settings['bands'], dtype=float).reshape(-1, 2),
+        'stat_names': np.array(STATS)}
+    for k in channels:
+        psd = np.full((len(names), nfreq), np.nan, np.float32)
+        stats = np.full((len(names), len(STATS)), np.nan)
+        bands = np.full((len(names), len(settings['bands'])), np.nan)
+        for i, n in enumerate(names):
+            r = records[n]['channels'].get(k)
+            if r is not None:
+                psd[i], stats[i], bands[i] = r['psd'], r['stats'], r['bands']
+        valid = ~np.isnan(psd[:, 0]) & (rates == rate)
+        arrays[k + '_psd'] = psd
+        arrays[k + '_stats'] = stats
+        arrays[k + '_bands'] = bands
+        arrays[k + '_count'] = np.count_nonzero(valid)
+        # Ensemble spectra over all captures with this channel.
+        if valid.any():
+            arrays[k + '_mean_psd'] = psd[valid].mean(axis=0,
+                                                      dtype=np.float64)
+            arrays[k + '_max_psd'] = psd[valid].max(axis=0)
+        else:
+            arrays[k + '_mean_psd'] = np.full(nfreq, np.nan)
+            arrays[k + '_max_psd'] = np.full(nfreq, np.nan, np.float32)
+    tmp = fpath + '.tmp'
+    with open(tmp, 'wb') as fh:
+        np.savez(fh, **arrays)
+    os.replace(tmp, fpath)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('folder', metavar='FOLDER')
+    parser.add_argument('--output', metavar='FILE',
+                        help="results file (default: FOLDER/ljsabatch.npz)")
+    parser.add_argument('--nperseg', type=int, default=4096,
+                        help="Welch segment length")
+    parser.add_argument('--bands', type=parse_band, nargs='+',
+                        metavar='LO:HI',
+                        default=[[0, 10], [10, 100], [100, 1000],
+                                 [1000, 10000]],
+                        help="frequency bands in Hz for band powers")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of processes (default: one per CPU)")
+    parser.add_argument('--recompute', action='store_true',
+                        help="process all files, not just new ones")
+    args = parser.parse_args(argv)
+    output = args.output or os.path.join(args.folder, 'ljsabatch.npz')
+
+    settings = {'nperseg': args.nperseg, 'bands': args.bands,
+                'window': 'hann'}
+    previous, records = load_results(output)
+    if previous is not None:
+        same = all(previous[k] == settings[k]
+                   for k in ('nperseg', 'bands', 'window'))
+        if args.recompute or not same:
+            if not same:
+                print("Settings changed: processing all files.")
+            records = {}
+    found = find_captures(args.folder)
+    todo = [(name, size, mtime) for name, size, mtime in found
+            if name not in records or records[name]['size'] != size
+            or records[name]['mtime'] != mtime]
+    print("%d captures, %d to process." % (len(found), len(todo)))
+    if not todo:
+        return 0
+
+    work = functools.partial(_analyse, nperseg=args.nperseg,
+                             bands=args.bands, window=settings['window'])
+    paths = [os.path.join(args.folder, name) for name, _, _ in todo]
+    failed = 0
+    done = 0
+    t_start = last_save = time.time()
+    workers = args.workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        # Large chunks amortize task overhead; small enough to balance.
+        chunksize = max(1, min(64, len(paths) // (8 * workers)))
+        for (name, size, mtime), result in zip(
+                todo, pool.map(work, paths, chunksize=chunksize)):
+            if isinstance(result, str):
+                print("%s: error: %s" % (name, result), file=sys.stderr)
+                failed += 1
+                continue
+            result.update(size=size, mtime=mtime)
+            records[name] = result
+            done += 1
+            if time.time() - last_save > CHECKPOINT:
+                save_results(output, settings, records)
+                last_save = time.time()
+    if records:
+        save_results(output, settings, records)
+    dt = time.time() - t_start
+    print("Processed %d captures in %.1f s with %d processes; %d failed." % (
+        done, dt, workers, failed))
+    print("Results for %d captures in %s." % (len(records), output))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""LabJackSpectrumAnalyzer headless acquisition
+
+Streams continuously from a LabJack U6 without a display, computes power
+spectra and optionally saves captures and spectra, reporting progress as
+one JSON object per line on stdout.
+
+    python ljsacli.py --channels 0 1 --rate 10000 --time 2 \
+        --save-captures captures --save-spectra spectra
+
+With --trigger, only captures around events are saved: each is
+--pre-trigger seconds before the first sample to meet a condition to
+--post-trigger seconds after it. Progress reports count the events and the
+samples checked and saved.
+
+With --features, features of each capture are appended to a columnar
+time series instead: the rms, peak and crest factor of each channel, the
+power in each of --bands and the --peaks largest spectral peaks. This takes
+a few hundred bytes per capture, so weeks of monitoring fit in a few
+megabytes; raw captures are then saved only if --save-captures is also
+given. Read the series with ljsacore.load_features.
+
+With --publish, each processed frame is also sent to any number of local
+subscribers, such as dashboards or loggers, over TCP on localhost or a Unix
+socket; see ljsacore.subscribe. A subscriber that cannot keep up misses
+frames rather than holding up acquisition.
+
+With --serial, streams from the U6 devices with the given serial numbers,
+combining their channels into one capture with channel names such as
+320012345/AIN0; progress reports then include counts for each device.
+
+Runs until interrupted, or until --count windows have been processed.
+Exits with status 0 on SIGINT or SIGTERM, or 1 if acquisition fails, so
+that a supervisor can restart it.
+
+Copyright (C) 2019 Mick Phillips <mick.phillips@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import numpy as np
+
+from ljsacore import (MAXSAMPLERATE, DataHandler, FeatureExtractor,
+                      FeatureLog, FramePublisher, MetricsLogger,
+                      MetricsServer, SpectrumAverager, SpectrumProcessor,
+                      Trigger, metrics, open_u6, parse_band,
+                      parse_condition, stream_source)
+
+
+def report(event, **kwargs):
+    """Write a progress record as a line of JSON on stdout"""
+    kwargs['event'] = event
+    kwargs['time'] = time.time()
+    sys.stdout.write(json.dumps(kwargs) + '\n')
+    sys.stdout.flush()
+
+
+def save_spectra(path, frame):
+    """Save spectra from a processed frame to a timestamped .npz file,
+    with any cross-spectral estimates as MODE_CHANNEL"""
+    ts = datetime.datetime.now().strftime('%Y-%m-%dT%H%M%S.%f')
+    fpath = os.path.join(path, "%s_psd.npz" % ts)
+    arrays = {k: p for k, (f, p) in frame['spectra'].items()}
+    cross = frame.get('cross')
+    if cross is not None and cross['estimates'] is not None:
+        arrays.update(cross_frequencies=cross['freqs'],
+                      reference=cross['reference'])
+        for mode, values in cross['estimates'].items():
+            arrays.update({"%s_%s" % (mode, k): v
+                           for k, v in values.items()})
+    freqs = next(iter(frame['spectra'].values()))[0]
+    np.savez(fpath, frequencies=freqs, rate=frame['rate'],
+             prefactor=frame['prefactor'], **arrays)
+    return fpath
+
+
+def _device_report(data, dropped):
+    """Counts for each device in a combined capture, with total dropped
+    samples, or None for a single device"""
+    if 'devices' not in data:
+        return None
+    return {k: dict(d, dropped=dropped[k])
+            for k, d in data['devices'].items()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--channels', type=int, nargs='+', default=[0],
+                        metavar='N', help="analog inputs to stream")
+    parser.add_argument('--rate', type=int, default=5000,
+                        help="per-channel sampling rate in Hz")
+    parser.add_argument('--time', type=float, default=2,
+                        help="window length in seconds")
+    parser.add_argument('--overlap', type=float, default=0,
+                        help="fractional overlap between windows")
+    parser.add_argument('--average', default='off',
+                        choices=('off',) + SpectrumAverager.MODES,
+                        help="spectrum averaging mode")
+    parser.add_argument('--nperseg', type=int, default=4096,
+                        help="segment length for spectrum averaging and "
+                             "cross-spectra")
+    parser.add_argument('--zoom', type=parse_band, metavar='LO:HI',
+                        help="compute spectra of this band only, in Hz, at "
+                             "--resolution")
+    parser.add_argument('--resolution', type=float, default=0.01,
+                        help="zoom resolution in Hz")
+    parser.add_argument('--cross', action='store_true',
+                        help="save the coherence and H1 and H2 transfer "
+                             "functions of each channel against the first "
+                             "with each spectrum")
+    parser.add_argument('--prefactor', type=float, default=1.0,
+                        help="data scaling prefactor")
+    parser.add_argument('--unit', default='V', help="data scaling unit")
+    parser.add_argument('--save-captures', metavar='DIR',
+                        help="save every capture to DIR")
+    parser.add_argument('--format', default='binary',
+                        choices=sorted(DataHandler.EXTENSIONS),
+                        help="capture file format")
+    parser.add_argument('--trigger', type=parse_condition, nargs='+',
+                        metavar='CONDITION',
+                        help="save only captures around events where a "
+                             "condition is met: level:CH>X, level:CH<X, "
+                             "rms:CH:SECONDS>X or band:CH:LO-HI>X")
+    parser.add_argument('--pre-trigger', type=float, default=1,
+                        help="seconds saved before each event")
+    parser.add_argument('--post-trigger', type=float, default=1,
+                        help="seconds saved after each event")
+    parser.add_argument('--save-spectra', metavar='DIR',
+                        help="save every spectrum to DIR")
+    parser.add_argument('--features', metavar='DIR',
+                        help="log features of every capture to DIR")
+    parser.add_argument('--bands', type=parse_band, nargs='+',
+                        metavar='LO:HI',
+                        default=[[0, 10], [10, 100], [100, 1000],
+                                 [1000, 10000]],
+                        help="frequency bands in Hz for feature band powers")
+    parser.add_argument('--peaks', type=int, default=5,
+                        help="number of spectral peaks in features")
+    parser.add_argument('--count', type=int, default=0,
+                        help="stop after this many windows (0: never)")
+    parser.add_argument('--progress', type=float, default=10,
+                        help="seconds between progress reports")
+    parser.add_argument('--serial', type=int, nargs='+', metavar='SERIAL',
+                        help="serial numbers of U6 devices to stream from "
+                             "(default: the first found)")
+    parser.add_argument('--simulate', type=int, nargs='?', const=1,
+                        default=0, metavar='N',
+                        help="use N simulated U6 devices rather than hardware")
+    parser.add_argument('--metrics-log', metavar='FILE',
+                        help="append pipeline metrics to FILE as JSON lines")
+    parser.add_argument('--metrics-interval', type=float, default=10,
+                        help="seconds between metrics log entries")
+    parser.add_argument('--metrics-address', metavar='PORT|PATH',
+                        help="serve metrics over HTTP on a localhost port "
+                             "or Unix socket")
+    parser.add_argument('--publish', metavar='PORT|PATH',
+                        help="publish frames to subscribers on a localhost "
+                             "port or Unix socket")
+    parser.add_argument('--publish-content', nargs='+',
+                        choices=FramePublisher.CONTENT,
+                        default=list(FramePublisher.CONTENT),
+                        help="what to publish: raw samples and/or spectra")
+    parser.add_argument('--publish-queue', type=int, default=4,
+                        help="frames queued for each subscriber before the "
+                             "oldest are dropped")
+    args = parser.parse_args(argv)
+    # The limit is for each device; channels are the same on all of them.
+    if args.rate * len(args.channels) > MAXSAMPLERATE:
+        parser.error("sample rate too high for %d channels"
+                     % len(args.channels))
+    if args.trigger and not args.save_captures:
+        parser.error("--trigger requires --save-captures")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for path in (args.save_captures, args.save_spectra):
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    if args.simulate:
+        from ljsasim import SimulatedU6
+        labels = ["sim%d" % i for i in range(args.simulate)]
+        factories = [SimulatedU6] * args.simulate
+    elif args.serial:
+        labels = [str(s) for s in args.serial]
+        factories = [functools.partial(open_u6, s) for s in args.serial]
+    else:
+        labels = None
+        factories = [open_u6]
+    source = stream_source(factories, labels)
+    source.set_channels(args.channels)
+    source.set_sampling(rate=args.rate, time=args.time,
+                        overlap=args.overlap)
+    writer = DataHandler(fmt=args.format)
+    if args.save_captures:
+        writer.set_save_all(args.save_captures)
+    if args.trigger:
+        writer.set_trigger(Trigger(args.trigger, args.pre_trigger,
+                                   args.post_trigger))
+    features = None
+    if args.features:
+        features = FeatureLog(args.features,
+                              FeatureExtractor(args.bands, args.peaks))
+    processor = SpectrumProcessor()
+    processor.set_averaging(mode=args.average, nperseg=args.nperseg)
+    if args.cross:
+        processor.set_cross('coherence')
+    if args.zoom:
+        processor.set_zoom(tuple(args.zoom), args.resolution)
+    scaling = {'prefactor': args.prefactor, 'unit': args.unit}
+    logger = server = publisher = None
+    if args.publish:
+        address = args.publish
+        publisher = FramePublisher(
+            int(address) if address.isdigit() else address,
+            args.publish_content, args.publish_queue)
+        processor.set_publisher(publisher)
+    if args.metrics_log:
+        logger = MetricsLogger(args.metrics_log, args.metrics_interval)
+    if args.metrics_address:
+        address = args.metrics_address
+        server = MetricsServer(int(address) if address.isdigit()
+                               else address)
+
+    if not source.start_acquisition(continuous=True):
+        report('error', status=source.get_status())
+        return 1
+    report('start', channels=args.channels, devices=labels, rate=args.rate,
+           window=args.time, overlap=args.overlap, pid=os.getpid(),
+           metrics_address=server.address if server else None,
+           publish_address=publisher.address if publisher else None)
+    windows = 0
+    dropped = 0
+    # Dropped samples for each device, with several.
+    device_dropped = {}
+    last_report = time.time()
+    status = 0
+    while not stop.is_set():
+        data = source.fetch_data()
+        if not data:
+            if not source.is_running():
+                report('error', status=source.get_status())
+                status = 1
+                break
+            continue
+        data.update(scaling)
+        windows += 1
+        dropped += data['dropped']
+        for k, d in data.get('devices', {}).items():
+            device_dropped[k] = device_dropped.get(k, 0) + d['dropped']
+        if args.save_captures:
+            writer.save_continuous(data)
+        if features is not None:
+            features.add(data)
+        frame = processor.process(data)
+        if args.save_spectra:
+            save_spectra(args.save_spectra, frame)
+        if time.time() - last_report >= args.progress:
+            last_report = time.time()
+            report('progress', windows=windows, sequence=data['sequence'],
+                   dropped=dropped, duty=data['duty'], gaps=data['gaps'],
+                   skipped=data['skipped'], writer=writer.get_stats(),
+                   metrics=metrics.summary(), status=source.get_status(),
+                   devices=_device_report(data, device_dropped),
+                   features=features.stats if features else None,
+                   publisher=(dict(publisher.stats,
+                                   subscribers=publisher.subscribers)
+                              if publisher else None))
+        if args.count and windows >= args.count:
+            break
+    source.stop_acquisition()
+    writer.flush(timeout=30)
+    if features is not None:
+        features.flush()
+    if logger is not None:
+        logger.stop()
+    if server is not None:
+        server.stop()
+    if publisher is not None:
+        publisher.stop()
+    report('stop', windows=windows, dropped=dropped,
+           writer=writer.get_stats(),
+           features=features.stats if features else None,
+           status=source.get_status())
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Convert LabJackSpectrumAnalyzer capture files between formats.
+
+    python ljsaconvert.py [--to archive|binary|json] [--force] FILE [FILE ...]
+
+Each file is loaded in whichever format it was saved, and written alongside
+the original with the extension for the target format; for an archive, a
+session archive holding that one capture.
+
+Copyright (C) 2019 Mick Phillips <mick.phillips@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import os
+import sys
+
+from ljsacore import DataHandler, SessionArchive
+
+
+def convert(handler, src, fmt='binary', force=False):
+    """Convert one file, returning the output path or None if skipped"""
+    dst = os.path.splitext(src)[0] + DataHandler.EXTENSIONS[fmt]
+    if dst == src or (os.path.exists(dst) and not force):
+        return None
+    data = handler.load_one(src)
+    if fmt == 'archive':
+        # Saving adds to an archive: replace it, and its index, instead.
+        for path in (dst, dst + SessionArchive.INDEX_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+    if handler.save_one(dst, data, fmt=fmt):
+        raise IOError(handler.get_status())
+    return dst
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('--to', choices=sorted(DataHandler.EXTENSIONS),
+                        default='binary', help="target format")
+    parser.add_argument('--force', action='store_true',
+                        help="overwrite existing output files")
+    args = parser.parse_args(argv)
+    handler = DataHandler()
+    failed = 0
+    for src in args.files:
+        try:
+            dst = convert(handler, src, args.to, args.force)
+        except Exception as e:
+            print("%s: error: %s" % (src, e), file=sys.stderr)
+            failed += 1
+            continue
+        if dst is None:
+            print("%s: skipped" % src)
+        else:
+            print("%s -> %s" % (src, dst))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,3197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""LabJackSpectrumAnalyzer core
+
+Acquisition, processing and storage for the LabJack spectrum analyzer,
+without any GUI dependencies, for use by both the GUI and headless tools.
+
+Copyright (C) 2019 Mick Phillips <mick.phillips@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import numpy as np
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import os
+import bisect
+from collections import OrderedDict
+# scipy.signal is imported where it is used, as it is slow to import and
+# not every tool needs it.
+
+from typing import List, Optional
+
+MAXSAMPLERATE = 50000
+
+
+class Histogram():
+    # Upper bounds of buckets, ten per decade from 1e-3 to 1e5, with a
+    # final bucket for anything larger.
+    BOUNDS = [10 ** (k / 10) for k in range(-30, 51)]
+
+    def __init__(self):
+        """Counts of values in fixed, logarithmically spaced buckets.
+
+        Percentiles are estimated as the upper bound of the bucket where
+        they fall, so are accurate to about 25%."""
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.last = None
+
+    def add(self, value: float):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.last = value
+
+    def percentile(self, q: float):
+        """Estimate the qth percentile, or None if there are no values"""
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        n = 0
+        for i, c in enumerate(self.buckets):
+            n += c
+            if c and n >= rank:
+                break
+        bound = self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return min(max(bound, self.min), self.max)
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total / self.count,
+                'min': self.min, 'max': self.max, 'last': self.last,
+                'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'buckets': [[self.BOUNDS[i] if i < len(self.BOUNDS)
+                             else None, c]
+                            for i, c in enumerate(self.buckets) if c]}
+
+
+class Metrics():
+    # Histograms shown in the one-line summary, with labels.
+    SUMMARY = [('read_ms', 'read'), ('decode_ms', 'decode'),
+               ('psd_ms', 'psd'), ('draw_ms', 'draw'), ('save_ms', 'save'),
+               ('latency_ms', 'latency'), ('reconfigure_ms', 'reconfigure')]
+
+    def __init__(self):
+        """Counters, gauges and histograms for the acquisition pipeline.
+
+        Updates are cheap and may come from any thread. Timings are
+        recorded in milliseconds in histograms named with an _ms suffix."""
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+            self._started = time.time()
+
+    def count(self, name: str, n: int = 1):
+        """Add n to a counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name: str, value: float):
+        """Set the current value of a gauge"""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        """Add a value to a histogram"""
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = Histogram()
+            hist.add(value)
+
+    def snapshot(self):
+        """Return all metrics as a dict that can be dumped as JSON"""
+        with self._lock:
+            now = time.time()
+            return {'time': now, 'uptime': now - self._started,
+                    'counters': dict(self._counters),
+                    'gauges': dict(self._gauges),
+                    'histograms': {k: h.summary()
+                                   for k, h in self._histograms.items()}}
+
+    def summary(self):
+        """Return a one-line summary of the main timings and queues"""
+        with self._lock:
+            times = []
+            for name, label in self.SUMMARY:
+                hist = self._histograms.get(name)
+                if hist is not None and hist.count:
+                    times.append("%s %.3g" % (label, hist.percentile(95)))
+            gauges = dict(self._gauges)
+            counters = dict(self._counters)
+        sstr = "p95 ms: " + ", ".join(times) if times else ""
+        others = []
+        if 'backlog' in gauges:
+            others.append("backlog %d" % gauges['backlog'])
+        if 'save_queue' in gauges:
+            others.append("save queue %d" % gauges['save_queue'])
+        for name in ('missed', 'errors'):
+            if counters.get(name):
+                others.append("%s %d" % (name, counters[name]))
+        if others:
+            sstr += ("; " if sstr else "") + ", ".join(others)
+        return sstr
+
+
+# Metrics shared by everything in this process.
+metrics = Metrics()
+
+
+class MetricsLogger():
+    def __init__(self, path: str, interval: float = 10.,
+                 source: Optional[Metrics] = None):
+        """Append a snapshot of metrics to a file as a line of JSON
+        every interval seconds, from a background thread."""
+        self._path = path
+        self._interval = interval
+        self._metrics = source or metrics
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._log_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop logging, after writing a last snapshot"""
+        self._stop.set()
+        self._thread.join()
+
+    def _log_loop(self):
+        """Target for logging thread"""
+        with open(self._path, 'a') as fh:
+            while not self._stop.wait(self._interval):
+                fh.write(json.dumps(self._metrics.snapshot()) + '\n')
+                fh.flush()
+            fh.write(json.dumps(self._metrics.snapshot()) + '\n')
+
+
+class MetricsServer():
+    def __init__(self, address, source: Optional[Metrics] = None):
+        """Serve a snapshot of metrics as JSON over HTTP.
+
+        If address is a port number, listens on that port on localhost
+        only; port 0 picks a free port, which is given by the address
+        attribute. Otherwise, address is the path of a Unix socket to
+        create. Any GET request returns the snapshot."""
+        import http.server
+        import socketserver
+        source = source or metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(source.snapshot()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                # Unix socket clients have no address.
+                return str(self.client_address or 'local')
+
+            def log_message(self, *args):
+                pass
+
+        if isinstance(address, int):
+            self._server = http.server.ThreadingHTTPServer(
+                ('127.0.0.1', address), Handler)
+            self.address = self._server.server_address[1]
+        else:
+            class UnixServer(socketserver.ThreadingMixIn,
+                             socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            if os.path.exists(address):
+                os.unlink(address)
+            self._server = UnixServer(address, Handler)
+            self.address = address
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class FramePublisher():
+    # Messages start with this, followed by the header length as a
+    # little-endian uint32, a JSON header, then the arrays it lists.
+    MAGIC = b'LJSAFRM\x01'
+    # Frame values copied to each message header.
+    HEADER_KEYS = ('sequence', 'rate', 'points', 'new', 'dropped', 'duty',
+                   'gaps', 'skipped', 'end_time', 'prefactor', 'unit',
+                   'devices')
+    CONTENT = ('raw', 'psd')
+
+    def __init__(self, address, content=CONTENT, maxqueue: int = 4):
+        """Publish processed frames to any number of local subscribers.
+
+        address is as for MetricsServer: a port on localhost, 0 for a free
+        one given by the address attribute, or the path of a Unix socket.
+        An asyncio event loop in a background thread accepts connections
+        and sends each frame passed to publish to every subscriber, as a
+        message with the raw samples of each channel ('raw') and/or its
+        power spectrum ('psd'), written straight from the frame's arrays
+        unless they are read-only views into a reused buffer.
+        Each subscriber has a queue of up to maxqueue messages; when a slow
+        subscriber's queue is full, its oldest message is dropped, so that
+        no subscriber holds up acquisition or the others. Subscribers
+        need only read; see subscribe."""
+        import asyncio
+        self._content = tuple(content)
+        self._maxqueue = maxqueue
+        # Message queue and task for each subscriber, used in the loop.
+        self._queues = set()
+        self._tasks = set()
+        self.stats = {'published': 0, 'sent': 0, 'dropped': 0}
+        self._loop = asyncio.new_event_loop()
+        if isinstance(address, int):
+            start = asyncio.start_server(self._serve, '127.0.0.1', address)
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            start = asyncio.start_unix_server(self._serve, address)
+        self._server = self._loop.run_until_complete(start)
+        if isinstance(address, int):
+            self.address = self._server.sockets[0].getsockname()[1]
+        else:
+            self.address = address
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    @property
+    def subscribers(self):
+        return len(self._queues)
+
+    def publish(self, frame):
+        """Send a frame to all subscribers; may be called from any thread"""
+        if not self._queues:
+            return
+        message = self._message(frame)
+        try:
+            self._loop.call_soon_threadsafe(self._broadcast, message)
+        except RuntimeError:
+            # Stopped.
+            return
+        self.stats['published'] += 1
+
+    def stop(self):
+        """Disconnect subscribers and stop serving"""
+        import asyncio
+        future = asyncio.run_coroutine_threadsafe(self._close(), self._loop)
+        future.result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _message(self, frame):
+        """Return a message for frame as a list of buffers.
+
+        The header lists the arrays that follow, each with its name, kind,
+        dtype, shape and size in bytes. Kinds are 'raw' for samples as
+        read (multiply by prefactor for scaled units), 'psd' for a scaled
+        power spectrum and 'frequencies' for the frequencies of the psd
+        arrays after it."""
+        header = {k: frame[k] for k in self.HEADER_KEYS if k in frame}
+        entries = []
+        arrays = []
+
+        def add(name, kind, a):
+            a = np.ascontiguousarray(a)
+            if not a.flags.writeable and not a.flags.owndata:
+                # A view into a buffer that is reused, such as the samples
+                # of a single acquisition: the message may be sent after
+                # it has been overwritten.
+                a = a.copy()
+            entries.append({'name': name, 'kind': kind, 'dtype': a.dtype.str,
+                            'shape': list(a.shape), 'nbytes': a.nbytes})
+            arrays.append(memoryview(a).cast('B'))
+
+        if 'raw' in self._content:
+            for k, v in frame['channels'].items():
+                add(k, 'raw', v)
+        if 'psd' in self._content:
+            freqs = None
+            for k, (f, p) in frame.get('spectra', {}).items():
+                if f is not freqs:
+                    add(k, 'frequencies', f)
+                    freqs = f
+                add(k, 'psd', p)
+        header['arrays'] = entries
+        raw_header = json.dumps(header).encode('utf-8')
+        return [self.MAGIC + len(raw_header).to_bytes(4, 'little')
+                + raw_header] + arrays
+
+    def _broadcast(self, message):
+        """Queue a message for every subscriber; called in the loop"""
+        for q in self._queues:
+            if q.full():
+                q.get_nowait()
+                self.stats['dropped'] += 1
+                metrics.count('publish_dropped')
+            q.put_nowait(message)
+
+    async def _serve(self, reader, writer):
+        """Send queued messages to one subscriber until it disconnects"""
+        import asyncio
+
+        async def closed():
+            # Anything the subscriber sends is ignored.
+            while await reader.read(4096):
+                pass
+
+        q = asyncio.Queue(self._maxqueue)
+        eof = asyncio.ensure_future(closed())
+        get = None
+        self._queues.add(q)
+        self._tasks.add(asyncio.current_task())
+        metrics.gauge('subscribers', len(self._queues))
+        try:
+            while True:
+                get = asyncio.ensure_future(q.get())
+                await asyncio.wait((get, eof),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    break
+                writer.writelines(get.result())
+                await writer.drain()
+                self.stats['sent'] += 1
+        except (ConnectionError, asyncio.CancelledError):
+            # Disconnected, or stopping.
+            pass
+        finally:
+            self._queues.discard(q)
+            self._tasks.discard(asyncio.current_task())
+            metrics.gauge('subscribers', len(self._queues))
+            for task in (get, eof):
+                if task is not None:
+                    task.cancel()
+            writer.close()
+
+    async def _close(self):
+        import asyncio
+        self._server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+
+def subscribe(address):
+    """Yield frames from a FramePublisher at address, a port on localhost
+    or the path of a Unix socket, until it stops.
+
+    Each frame is a dict of the header values, with raw samples of each
+    channel in 'channels' and (frequencies, psd) in 'spectra', as
+    published."""
+    import socket
+    if isinstance(address, int):
+        sock = socket.create_connection(('127.0.0.1', address))
+    else:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(address)
+    magic = FramePublisher.MAGIC
+    with sock, sock.makefile('rb') as fh:
+        while True:
+            prefix = fh.read(len(magic) + 4)
+            if len(prefix) < len(magic) + 4:
+                return
+            if prefix[:len(magic)] != magic:
+                raise IOError("Not a frame message.")
+            nheader = int.from_bytes(prefix[len(magic):], 'little')
+            header = json.loads(fh.read(nheader).decode('utf-8'))
+            frame = dict(header, channels={}, spectra={})
+            freqs = None
+            for entry in frame.pop('arrays'):
+                raw = fh.read(entry['nbytes'])
+                if len(raw) < entry['nbytes']:
+                    return
+                a = np.frombuffer(raw, dtype=entry['dtype']).reshape(
+                    entry['shape'])
+                if entry['kind'] == 'raw':
+                    frame['channels'][entry['name']] = a
+                elif entry['kind'] == 'frequencies':
+                    freqs = a
+                else:
+                    frame['spectra'][entry['name']] = (freqs, a)
+            yield frame
+
+
+def open_u6(serial: Optional[int] = None):
+    """Open and set up the U6 with the given serial number, or the first
+    found.
+
+    This is the default device factory for StreamReader; use
+    functools.partial(open_u6, serial) for a particular device. A factory
+    takes no arguments and returns an open device with the U6 streaming
+    interface: streamConfig, streamStart, streamData(convert=False),
+    streamStop and close, the streamSamplesPerPacket, packetsPerRequest,
+    streamChannelNumbers and streamChannelOptions attributes set by
+    streamConfig, and getCalibratedSlopesCenter."""
+    # Import here, so that tools that never open hardware need not
+    # load LabJackPython.
+    import u6
+    if serial is None:
+        device = u6.U6()
+    else:
+        device = u6.U6(firstFound=False, serial=serial)
+    device.getCalibrationData()
+    # Set up a frequency source for testing.
+    device.configIO(NumberTimersEnabled=1)
+    # 1MHz / 250 = 4 kHz
+    device.configTimerClock(3, 250)
+    # 4KHz / 2 * 16 = 125 Hz
+    device.getFeedback(u6.Timer0Config(7, 16))
+    return device
+
+
+class StreamDecoder():
+    # Stream packet layout: 12-byte header, 2-byte samples, 2-byte footer.
+    HEADER_SIZE = 12
+    FOOTER_SIZE = 2
+
+    def __init__(self, device, dtype=np.float64):
+        """Bulk decoder for raw U6 stream data.
+
+        Produces the same values as device.processStreamData, but decodes
+        many streamData results at once using array operations. Must be
+        created after streamConfig, as it takes a copy of the stream
+        configuration and calibration from the device."""
+        self._dtype = np.dtype(dtype)
+        self._channels = list(device.streamChannelNumbers)
+        self._samples_per_packet = device.streamSamplesPerPacket
+        self._packet_size = (self.HEADER_SIZE + self.FOOTER_SIZE
+                             + 2 * self._samples_per_packet)
+        # (negSlope, posSlope, center) for each entry in the scan list.
+        # processStreamData uses resolutionIndex=1 for stream calibration.
+        self._calibration = []
+        for ch, opt in zip(self._channels, device.streamChannelOptions):
+            if ch < 193:
+                gain = (opt >> 4) & 0x3
+                self._calibration.append(
+                    device.getCalibratedSlopesCenter(gain, 1))
+            else:
+                self._calibration.append(None)
+        # Position in scan list of the next sample.
+        self._offset = 0
+
+    def decode(self, results):
+        """Decode a list of raw streamData results.
+
+        Returns a dict mapping channel names to arrays of samples."""
+        if isinstance(results, (bytes, bytearray)):
+            results = [results]
+        buf = b''.join(results)
+        nch = len(self._channels)
+        npackets = len(buf) // self._packet_size
+        # View whole packets as 16-bit words, then strip header and footer.
+        words = np.frombuffer(buf, dtype='<u2',
+                              count=npackets * self._packet_size // 2)
+        words = words.reshape(npackets, self._packet_size // 2)
+        first = self.HEADER_SIZE // 2
+        samples = words[:, first:first + self._samples_per_packet].ravel()
+        # Gather strided samples for each scan list entry.
+        per_channel = {}
+        for i in range(min(len(samples), nch)):
+            j = (self._offset + i) % nch
+            ch = self._channels[j]
+            counts = samples[i::nch]
+            if ch in (193, 194):
+                values = np.ascontiguousarray(counts).view(np.uint8)
+                values = values.reshape(-1, 2)
+            elif ch >= 200:
+                values = counts.copy()
+            else:
+                neg, pos, center = self._calibration[j]
+                bits = counts.astype(np.float64)
+                values = np.where(bits < center,
+                                  (center - bits) * neg,
+                                  (bits - center) * pos)
+                if values.dtype != self._dtype:
+                    values = values.astype(self._dtype)
+            per_channel.setdefault("AIN%s" % ch, []).append(values)
+        self._offset = (self._offset + len(samples)) % nch
+        data = {}
+        for k, parts in per_channel.items():
+            if len(parts) == 1:
+                data[k] = parts[0]
+            else:
+                # Channel appears more than once in the scan list:
+                # interleave its samples in acquisition order.
+                out = np.empty((sum(map(len, parts)),) + parts[0].shape[1:],
+                               dtype=parts[0].dtype)
+                for i, part in enumerate(parts):
+                    out[i::len(parts)] = part
+                data[k] = out
+        return data
+
+
+class RingBuffer():
+    def __init__(self, nrows: int, capacity: int, dtype=np.float64):
+        """Fixed-capacity ring buffer for multi-channel sample data.
+
+        Each row holds one channel. Samples are written twice, at i and
+        i + capacity, so the latest window of up to capacity samples is
+        always available as a contiguous, zero-copy view."""
+        self.capacity = capacity
+        self._data = np.zeros((nrows, 2 * capacity), dtype=dtype)
+        # Next write position in each row.
+        self._head = np.zeros(nrows, dtype=np.intp)
+        # Total samples written to each row.
+        self._count = np.zeros(nrows, dtype=np.int64)
+
+    @property
+    def shape(self):
+        return (self._data.shape[0], self.capacity)
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    def clear(self):
+        """Discard buffered samples"""
+        self._head[:] = 0
+        self._count[:] = 0
+
+    def written(self, row: int):
+        """Return the total number of samples written to a row"""
+        return int(self._count[row])
+
+    def write(self, row: int, values):
+        """Append values to a row, overwriting the oldest samples"""
+        cap = self.capacity
+        n = len(values)
+        self._count[row] += n
+        if n > cap:
+            values = values[-cap:]
+            n = cap
+        head = self._head[row]
+        d = self._data[row]
+        first = min(n, cap - head)
+        d[head:head + first] = values[:first]
+        d[head + cap:head + cap + first] = values[:first]
+        rest = n - first
+        if rest:
+            d[:rest] = values[first:]
+            d[cap:cap + rest] = values[first:]
+        self._head[row] = (head + n) % cap
+
+    def latest(self, row: int, n: Optional[int] = None):
+        """Return a read-only view of the latest n samples in a row.
+
+        The view is only valid until those samples are overwritten."""
+        available = min(int(self._count[row]), self.capacity)
+        if n is None or n > available:
+            n = available
+        end = self._head[row] + self.capacity
+        view = self._data[row, end - n:end]
+        view.flags.writeable = False
+        return view
+
+
+class SpectralEngine():
+    # Number of plans kept; the least recently used is dropped first.
+    MAXPLANS = 8
+
+    def __init__(self, workers: Optional[int] = None):
+        """Power spectral densities with cached plans.
+
+        Gives the same result as scipy.signal.periodogram with density
+        scaling and constant detrending. A plan, keyed on (npoints, rate,
+        window), holds the window, frequencies and the weights that
+        normalize and fold the one-sided spectrum, so these are only
+        computed when the sampling settings change. Data are detrended and
+        windowed into a buffer reused by each thread, then transformed
+        with scipy.fft.rfft, spreading rows across workers."""
+        self._workers = workers or os.cpu_count() or 1
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        # Per-thread buffer for windowed data.
+        self._local = threading.local()
+
+    def clear(self):
+        """Discard cached plans"""
+        with self._lock:
+            self._plans.clear()
+
+    def plan(self, npoints: int, rate: float, window: str = 'hann'):
+        """Return (window, frequencies, weights) for a transform length"""
+        key = (npoints, rate, window)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+        from scipy.signal import get_window
+        win = get_window(window, npoints)
+        freqs = np.fft.rfftfreq(npoints, 1 / rate)
+        # Density scaling, doubled for the one-sided spectrum except at
+        # zero and Nyquist frequencies.
+        weights = np.full(len(freqs), 2 / (rate * np.sum(win * win)))
+        weights[0] /= 2
+        if npoints % 2 == 0:
+            weights[-1] /= 2
+        for a in (win, freqs, weights):
+            a.flags.writeable = False
+        plan = (win, freqs, weights)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.MAXPLANS:
+                self._plans.popitem(last=False)
+        return plan
+
+    def _buffer(self, nrows, npoints):
+        """Return this thread's buffer for nrows of npoints samples"""
+        buf = getattr(self._local, 'buf', None)
+        if buf is None or buf.shape[1] != npoints or buf.shape[0] < nrows:
+            buf = self._local.buf = np.empty((nrows, npoints))
+        return buf[:nrows]
+
+    def psd(self, x, rate: float, window: str = 'hann', scale: float = 1.,
+            out=None):
+        """Return (frequencies, psd) of x, multiplied by scale.
+
+        x may be one array, or several of equal length as a 2-d array or a
+        sequence, giving one spectrum per row. If out is given, spectra
+        are written into it."""
+        from scipy import fft
+        single = isinstance(x, np.ndarray) and x.ndim == 1
+        rows = [x] if single else x
+        nrows = len(rows)
+        npoints = len(rows[0]) if nrows else 0
+        win, freqs, weights = self.plan(npoints, rate, window)
+        buf = self._buffer(nrows, npoints)
+        if isinstance(rows, np.ndarray):
+            np.subtract(rows, rows.mean(axis=-1, keepdims=True), out=buf)
+        else:
+            for i, row in enumerate(rows):
+                np.subtract(row, np.mean(row), out=buf[i])
+        buf *= win
+        spectrum = fft.rfft(buf, axis=-1, workers=min(self._workers, nrows))
+        if out is None:
+            out = np.empty((nrows, len(freqs)))
+        np.abs(spectrum, out=out)
+        np.square(out, out=out)
+        out *= weights if scale == 1 else scale * weights
+        return freqs, (out[0] if single else out)
+
+
+# Shared by everything in this process, so plans are reused.
+_engine = SpectralEngine()
+
+
+def _segment_spectra(tails, name, samples, nperseg, step, rate, window,
+                     contiguous=True):
+    """Return periodograms of the half-overlapping segments completed by
+    new samples for a channel, one per row.
+
+    Samples left over for the next segment are kept in tails[name]."""
+    samples = np.asarray(samples)
+    tail = tails.get(name)
+    if contiguous and tail is not None and len(tail):
+        samples = np.concatenate((tail, samples))
+    nseg = max(0, (len(samples) - nperseg) // step + 1)
+    if nseg == 0:
+        tails[name] = samples[-nperseg:].copy()
+        return np.zeros((0, nperseg // 2 + 1))
+    segments = np.lib.stride_tricks.sliding_window_view(
+        samples, nperseg)[::step][:nseg]
+    _, psd = _engine.psd(segments, rate, window)
+    # Keep samples not yet consumed by a complete segment.
+    tails[name] = samples[nseg * step:].copy()
+    return psd
+
+
+class SpectrumAverager():
+    MODES = ('linear', 'exponential', 'peak')
+
+    def __init__(self, rate: float, nperseg: int = 4096,
+                 navg: int = 16, window: str = 'hann'):
+        """Incremental Welch spectrum estimate for each channel.
+
+        Samples are cut into half-overlapping segments of nperseg points
+        as they arrive; the periodogram of each segment updates a linear
+        average, an exponential average over navg segments and a peak
+        hold. Memory use depends only on nperseg, not on how long the
+        average runs."""
+        self.rate = rate
+        self.nperseg = nperseg
+        self.navg = navg
+        self.window = window
+        self._step = nperseg // 2
+        self.freqs = np.fft.rfftfreq(nperseg, 1 / rate)
+        # Per channel: samples left over from the last update, and
+        # accumulated spectra.
+        self._tail = {}
+        self._sum = {}
+        self._exp = {}
+        self._peak = {}
+        self._count = {}
+
+    def reset(self):
+        """Discard all accumulated data"""
+        for d in (self._tail, self._sum, self._exp, self._peak, self._count):
+            d.clear()
+
+    def count(self, name=None):
+        """Return number of segments averaged for a channel, or for all"""
+        if name is None:
+            return min(self._count.values(), default=0)
+        return self._count.get(name, 0)
+
+    def add(self, name: str, samples, contiguous: bool = True):
+        """Add samples to the average for a channel.
+
+        Set contiguous False if samples do not follow on directly from the
+        previous call for this channel, to start a new set of segments."""
+        psd = _segment_spectra(self._tail, name, samples, self.nperseg,
+                               self._step, self.rate, self.window,
+                               contiguous)
+        nseg = len(psd)
+        if nseg == 0:
+            return 0
+        count = self._count.get(name, 0)
+        if count == 0:
+            self._sum[name] = np.zeros_like(psd[0])
+            self._exp[name] = np.zeros_like(psd[0])
+            self._peak[name] = np.zeros_like(psd[0])
+        self._sum[name] += psd.sum(axis=0)
+        np.maximum(self._peak[name], psd.max(axis=0), out=self._peak[name])
+        exp = self._exp[name]
+        for p in psd:
+            # Linear until navg segments have been seen, so the exponential
+            # average is not biased towards its initial value.
+            count += 1
+            exp += (p - exp) / min(count, self.navg)
+        self._count[name] = count
+        return nseg
+
+    def spectrum(self, name: str, mode: str = 'linear'):
+        """Return (frequencies, psd) for a channel, or None if no data.
+
+        The psd is a new array, not changed by later calls to add."""
+        if not self._count.get(name):
+            return None
+        if mode == 'linear':
+            psd = self._sum[name] / self._count[name]
+        elif mode == 'exponential':
+            psd = self._exp[name].copy()
+        elif mode == 'peak':
+            psd = self._peak[name].copy()
+        else:
+            raise ValueError("Unknown averaging mode %s." % mode)
+        return self.freqs, psd
+
+
+class CrossSpectrum():
+    MODES = ('coherence', 'H1', 'H2')
+
+    def __init__(self, rate: float, nperseg: int = 4096,
+                 window: str = 'hann'):
+        """Averaged auto- and cross-spectra of a set of channels.
+
+        As SpectrumAverager, samples are cut into half-overlapping
+        segments as they arrive, but the segments of all channels are
+        transformed in one batched FFT, and the cross-spectral matrix of
+        each frequency is accumulated with one batched matrix product, so
+        there is no loop over channels or pairs. The linear average over
+        all segments gives the coherence and the H1 and H2 transfer
+        function estimates of each channel against a reference."""
+        self.rate = rate
+        self.nperseg = nperseg
+        self.window = window
+        self._step = nperseg // 2
+        self.freqs = np.fft.rfftfreq(nperseg, 1 / rate)
+        # Channel names, samples left over from the last update, and the
+        # summed matrix, indexed [frequency, i, j].
+        self.names = None
+        self._tail = None
+        self._sum = None
+        self._count = 0
+
+    def reset(self):
+        """Discard all accumulated data"""
+        self.names = None
+        self._tail = None
+        self._sum = None
+        self._count = 0
+
+    def count(self):
+        """Return number of segments averaged"""
+        return self._count
+
+    def add(self, names: List[str], samples, contiguous: bool = True):
+        """Add samples, one row per channel, to the average.
+
+        A change of channels starts a new average. Set contiguous False
+        if samples do not follow on directly from the previous call."""
+        from scipy import fft
+        names = list(names)
+        if names != self.names:
+            self.reset()
+            self.names = names
+        samples = np.asarray(samples, dtype=np.float64)
+        if contiguous and self._tail is not None and self._tail.shape[1]:
+            samples = np.concatenate((self._tail, samples), axis=1)
+        nseg = max(0, (samples.shape[1] - self.nperseg) // self._step + 1)
+        # Keep samples not yet consumed by a complete segment.
+        self._tail = samples[:, nseg * self._step:][:, -self.nperseg:].copy()
+        if nseg == 0:
+            return 0
+        win, freqs, weights = _engine.plan(self.nperseg, self.rate,
+                                           self.window)
+        segments = np.lib.stride_tricks.sliding_window_view(
+            samples, self.nperseg, axis=1)[:, ::self._step][:, :nseg]
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+        segments *= win
+        spectra = fft.rfft(segments, axis=-1, workers=_engine._workers)
+        # [frequency, channel, segment] @ [frequency, segment, channel]
+        x = spectra.transpose(2, 0, 1)
+        s = np.matmul(x.conj(), x.transpose(0, 2, 1))
+        s *= weights[:, None, None]
+        if self._sum is None:
+            self._sum = s
+        else:
+            self._sum += s
+        self._count += nseg
+        return nseg
+
+    def estimates(self, reference: Optional[str] = None):
+        """Return the coherence, H1 and H2 of each channel against the
+        reference channel, by default the first.
+
+        Gives a dict of mode to a dict of channel to array, or None if no
+        data. Transfer functions are complex."""
+        if not self._count:
+            return None
+        if reference is None:
+            reference = self.names[0]
+        r = self.names.index(reference)
+        s = self._sum / self._count
+        auto = np.einsum('fii->fi', s).real
+        cross = s[:, r, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coherence = np.abs(cross) ** 2 / (auto[:, r:r + 1] * auto)
+            h1 = cross / auto[:, r:r + 1]
+            h2 = auto / cross.conj()
+        result = {m: {} for m in self.MODES}
+        for i, k in enumerate(self.names):
+            if i == r:
+                continue
+            result['coherence'][k] = coherence[:, i]
+            result['H1'][k] = h1[:, i]
+            result['H2'][k] = h2[:, i]
+        return result
+
+
+class ZoomSpectrum():
+    # Largest decimation factor of one stage.
+    MAXSTAGE = 10
+
+    def __init__(self, rate: float, lo: float, hi: float,
+                 resolution: float = 0.01, window: str = 'hann'):
+        """High-resolution power spectrum of the band from lo to hi Hz.
+
+        Samples of all channels are shifted down by the band's centre
+        frequency, then low-pass filtered and decimated, in stages of at
+        most MAXSTAGE with the anti-aliasing filter of
+        scipy.signal.decimate, down to a complex rate of at least 1.25
+        times the bandwidth. Filter state and oscillator phase carry over
+        from one call to the next, so data are processed once, as they
+        arrive. The spectrum is the FFT of the latest decimated samples
+        that span 1 / resolution seconds, so fine resolution costs memory
+        and CPU in proportion to the bandwidth, not the sampling rate."""
+        from scipy.signal import cheby1
+        if not 0 <= lo < hi <= rate / 2:
+            raise ValueError("Zoom band must be within 0 to %g Hz." %
+                             (rate / 2))
+        self.rate = rate
+        self.band = (lo, hi)
+        self.window = window
+        self.center = (lo + hi) / 2
+        # Decimate while the band stays within 0.4 of the output rate,
+        # the passband of each stage's filter.
+        limit = rate / (1.25 * (hi - lo))
+        self._stages = []
+        self.decimation = 1
+        while True:
+            q = min(self.MAXSTAGE, int(limit // self.decimation))
+            if q < 2:
+                break
+            sos = cheby1(8, 0.05, 0.8 / q, output='sos')
+            # Unity gain at zero frequency, the centre of the band, rather
+            # than the bottom of the passband ripple.
+            sos[0, :3] /= np.prod(sos[:, :3].sum(axis=1)
+                                  / sos[:, 3:].sum(axis=1))
+            self._stages.append((q, sos))
+            self.decimation *= q
+        self.out_rate = rate / self.decimation
+        self.npoints = int(np.ceil(self.out_rate / resolution))
+        self.names = None
+        # Oscillator phase in cycles, filter state and next sample to keep
+        # for each stage, and decimated samples.
+        self._cycles = 0.
+        self._state = []
+        self._buffer = None
+        # Window and frequencies for the last transform length.
+        self._plan = (None, None, None)
+
+    def reset(self):
+        """Discard filter state and buffered samples"""
+        self.names = None
+        self._buffer = None
+
+    def duration(self):
+        """Return the seconds of data in the spectrum"""
+        if self._buffer is None:
+            return 0.
+        return min(self._buffer.written(0), self.npoints) / self.out_rate
+
+    def add(self, names: List[str], samples, contiguous: bool = True):
+        """Add samples, one row per channel.
+
+        A change of channels, or samples that do not follow on directly
+        from the previous call, start a new spectrum."""
+        from scipy.signal import sosfilt
+        names = list(names)
+        samples = np.asarray(samples, dtype=np.float64)
+        if names != self.names or not contiguous or self._buffer is None:
+            self.names = names
+            self._cycles = 0.
+            self._state = [
+                [np.zeros((len(sos), len(names), 2), complex), 0]
+                for q, sos in self._stages]
+            self._buffer = RingBuffer(len(names), self.npoints, complex)
+        n = samples.shape[1]
+        phase = self._cycles + self.center / self.rate * np.arange(n)
+        z = samples * np.exp(-2j * np.pi * phase)
+        self._cycles = (self._cycles + self.center * n / self.rate) % 1.
+        for (q, sos), state in zip(self._stages, self._state):
+            z, state[0] = sosfilt(sos, z, axis=-1, zi=state[0])
+            offset = state[1]
+            # Keep every qth sample, continuing from the last block.
+            state[1] = (offset - z.shape[1]) % q
+            z = z[:, offset::q]
+        for row, values in enumerate(z):
+            self._buffer.write(row, values)
+
+    def spectra(self):
+        """Return (frequencies, psd) for the band, one row per channel, or
+        None if there are too few samples.
+
+        Densities are one-sided, as from periodogram, from up to npoints
+        of the latest decimated samples."""
+        from scipy.signal import get_window
+        if self._buffer is None:
+            return None
+        n = min(self._buffer.written(0), self.npoints)
+        if n < 16:
+            return None
+        key, win, freqs = self._plan
+        if key != n:
+            win = get_window(self.window, n)
+            freqs = self.center + np.fft.fftshift(
+                np.fft.fftfreq(n, 1 / self.out_rate))
+            self._plan = (n, win, freqs)
+        z = np.stack([self._buffer.latest(i, n)
+                      for i in range(len(self.names))])
+        spectrum = np.fft.fftshift(np.fft.fft(z * win, axis=-1), axes=-1)
+        lo, hi = self.band
+        i0, i1 = np.searchsorted(freqs, (lo, hi), side='left')
+        # Twice the two-sided density of the shifted signal.
+        psd = np.abs(spectrum[:, i0:i1]) ** 2
+        psd *= 2 / (self.out_rate * np.sum(win * win))
+        return freqs[i0:i1], psd
+
+
+class Spectrogram():
+    def __init__(self, rate: float, nperseg: int = 1024,
+                 history: float = 60., rows: int = 512,
+                 window: str = 'hann'):
+        """Incremental short-time spectra for each channel.
+
+        Samples are cut into half-overlapping segments as they arrive, as
+        for SpectrumAverager. Segment periodograms are averaged in groups
+        to give rows at a fixed period, chosen so that about rows rows span
+        history seconds. Only the rows completed by new samples are
+        returned, so the cost of an update does not depend on history."""
+        self.rate = rate
+        self.nperseg = nperseg
+        self.history = history
+        self.window = window
+        self._step = nperseg // 2
+        self.freqs = np.fft.rfftfreq(nperseg, 1 / rate)
+        # Segments averaged into each row, time between rows, and rows
+        # needed to cover the history.
+        self.per_row = max(1, int(round(history * rate
+                                        / (self._step * rows))))
+        self.row_period = self.per_row * self._step / rate
+        self.nrows = int(np.ceil(history / self.row_period))
+        # Per channel: samples left over from the last update, and sum and
+        # count of segment spectra in the row being built.
+        self._tail = {}
+        self._sum = {}
+        self._nsum = {}
+
+    def reset(self):
+        """Discard partial segments and rows"""
+        for d in (self._tail, self._sum, self._nsum):
+            d.clear()
+
+    def add(self, name: str, samples, contiguous: bool = True):
+        """Add samples for a channel and return the rows they complete.
+
+        Returns an array of power spectral densities, with one row per
+        row period, oldest first."""
+        psd = _segment_spectra(self._tail, name, samples, self.nperseg,
+                               self._step, self.rate, self.window,
+                               contiguous)
+        rows = []
+        n = self._nsum.get(name, 0)
+        i = 0
+        if n:
+            # Finish the row in progress.
+            i = min(self.per_row - n, len(psd))
+            self._sum[name] += psd[:i].sum(axis=0)
+            n += i
+            if n == self.per_row:
+                rows.append(self._sum[name] / n)
+                n = 0
+        nfull = (len(psd) - i) // self.per_row
+        if nfull:
+            whole = psd[i:i + nfull * self.per_row]
+            rows.extend(whole.reshape(nfull, self.per_row, -1).mean(axis=1))
+            i += nfull * self.per_row
+        if i < len(psd):
+            self._sum[name] = psd[i:].sum(axis=0)
+            n = len(psd) - i
+        self._nsum[name] = n
+        if not rows:
+            return np.zeros((0, len(self.freqs)), dtype=np.float32)
+        return np.array(rows, dtype=np.float32)
+
+
+def _merge_rows(old, new):
+    """Prepend spectrogram rows from a frame that will not be displayed to
+    those of the frame replacing it, so no rows are lost."""
+    try:
+        before = old['spectrogram']['rows']
+        after = new['spectrogram']['rows']
+    except KeyError:
+        return
+    if (old['spectrogram']['row_period'] != new['spectrogram']['row_period']
+            or len(old['spectrogram']['freqs'])
+            != len(new['spectrogram']['freqs'])):
+        return
+    for k, rows in before.items():
+        if k in after:
+            after[k] = np.concatenate((rows, after[k]))
+
+
+class SpectrumProcessor():
+    def __init__(self, workers: Optional[int] = None, on_frame=None):
+        """Scales data and computes spectra for all channels in parallel.
+
+        Frames passed to submit are processed by a background thread, which
+        calls on_frame, if given, when a frame is ready to fetch. It is not
+        called again until that frame has been fetched, so it need only
+        wake the consumer.
+        Spectra of whole captures are computed for all channels at once by
+        a SpectralEngine; averaging and spectrograms are spread across a
+        thread pool, one channel per thread, as scipy releases the GIL in
+        its FFTs. Only the latest frame is kept at each stage: a frame that
+        is replaced before it is processed, or before its result is
+        fetched, is dropped and counted as stale. Settings may be changed
+        from any thread, and take effect from the next frame processed."""
+        self._workers = workers or min(4, os.cpu_count() or 1)
+        self._pool = None
+        self._engine = SpectralEngine(self._workers)
+        # Time axis for the last (points, rate), reused while they persist.
+        self._times = (None, None)
+        self._thread = None
+        # Latest submitted and finished frames, guarded by a condition.
+        self._pending = None
+        self._done = None
+        self._cond = threading.Condition()
+        self._stale = 0
+        # Called from the processing thread when a frame is ready.
+        self.on_frame = on_frame
+        # Spectrum averaging mode: None, or one of SpectrumAverager.MODES.
+        self._average = None
+        # Segment length for averaging.
+        self._nperseg = 4096
+        self._averager = None
+        # Cross-spectral mode: None, or one of CrossSpectrum.MODES, with
+        # the reference channel, or None for the first.
+        self._cross_mode = None
+        self._reference = None
+        self._cross = None
+        # Zoom band (lo, hi) in Hz, or None for the full band, its
+        # resolution, and its ZoomSpectrum.
+        self._zoom_band = None
+        self._resolution = 0.01
+        self._zoom = None
+        # Spectrogram history in seconds, or None for no spectrogram, and
+        # its segment length.
+        self._history = None
+        self._sg_nperseg = 1024
+        self._spectrogram = None
+        # Sequence number of the last continuous window processed.
+        self._sequence = None
+        # FramePublisher sent each processed frame, if any.
+        self._publisher = None
+        # Settings changed by other threads, applied by process before the
+        # next frame, so that they never change during one.
+        self._requested = {}
+
+    def set_publisher(self, publisher: Optional[FramePublisher]):
+        """Send each processed frame to a FramePublisher, or None to stop"""
+        self._publisher = publisher
+
+    def set_averaging(self, mode: Optional[str] = None,
+                      nperseg: Optional[int] = None):
+        """Set spectrum averaging mode and segment length.
+
+        A mode of 'off' gives the periodogram of each capture alone."""
+        if mode is not None:
+            self._request(average=mode)
+        if nperseg is not None:
+            self._request(nperseg=nperseg)
+
+    def set_cross(self, mode: Optional[str] = None,
+                  reference: Optional[str] = None):
+        """Set cross-spectral mode, and the reference channel.
+
+        A mode of 'off' turns it off. When on, the cross-spectra of all
+        channels are averaged over segments of the averaging length, and
+        each frame has the coherence and H1 and H2 transfer functions of
+        each channel against the reference in 'cross', with the
+        frequencies, mode, reference and count of segments."""
+        self._request(cross=(mode, reference))
+
+    def set_zoom(self, band=None, resolution: Optional[float] = None):
+        """Set a zoom band (lo, hi) in Hz, or None for the full band, and
+        the zoom resolution in Hz.
+
+        When zoomed, the spectra of each frame cover only the band, at the
+        given resolution, from a ZoomSpectrum fed with new samples as they
+        arrive, in place of the spectrum of the whole capture and any
+        averaging."""
+        self._request(zoom=(band, resolution))
+
+    def set_spectrogram(self, history: Optional[float] = None,
+                        nperseg: Optional[int] = None):
+        """Set spectrogram history in seconds, or None to turn it off, and
+        segment length.
+
+        When on, each frame has the spectrogram rows completed by its new
+        data in 'spectrogram', with the frequencies, row period and number
+        of rows to span the history."""
+        self._request(spectrogram=(history, nperseg))
+
+    def clear_cache(self):
+        """Discard cached plans and time axes, e.g. when sampling changes"""
+        self._request(clear=True)
+
+    def reset_average(self):
+        """Discard accumulated spectra, including the zoom spectrum"""
+        self._request(reset=True)
+
+    def _request(self, **settings):
+        """Queue settings for process to apply; may be called from any
+        thread"""
+        with self._cond:
+            self._requested.update(settings)
+
+    def _apply_requested(self):
+        """Apply queued settings, in the thread that runs process"""
+        with self._cond:
+            requested, self._requested = self._requested, {}
+        if 'average' in requested:
+            mode = requested['average']
+            self._average = None if mode == 'off' else mode
+        nperseg = requested.get('nperseg')
+        if nperseg is not None and nperseg != self._nperseg:
+            self._nperseg = nperseg
+            self._averager = None
+        if 'cross' in requested:
+            mode, self._reference = requested['cross']
+            self._cross_mode = None if mode == 'off' else mode
+            if self._cross_mode is None:
+                self._cross = None
+        if 'zoom' in requested:
+            band, resolution = requested['zoom']
+            if resolution is not None and resolution != self._resolution:
+                self._resolution = resolution
+                self._zoom = None
+            if band != self._zoom_band:
+                self._zoom_band = band
+                self._zoom = None
+        if 'spectrogram' in requested:
+            history, nperseg = requested['spectrogram']
+            if nperseg is not None and nperseg != self._sg_nperseg:
+                self._sg_nperseg = nperseg
+                self._spectrogram = None
+            if history != self._history:
+                self._history = history
+                self._spectrogram = None
+        if requested.get('clear'):
+            self._engine.clear()
+            self._times = (None, None)
+        if requested.get('reset'):
+            for state in (self._averager, self._cross, self._zoom):
+                if state is not None:
+                    state.reset()
+
+    def get_status(self):
+        status = ""
+        if self._average is not None and self._averager is not None:
+            status = "Averaging %s: %d segments." % (self._average,
+                                                     self._averager.count())
+        if self._cross_mode is not None and self._cross is not None:
+            status += " Cross-spectra: %d segments." % self._cross.count()
+        zoom = self._zoom if self._zoom_band is not None else None
+        if zoom is not None:
+            status += " Zoom %g-%g Hz: %.3g Hz resolution, %.0f of %.0f s." % (
+                zoom.band + (self._resolution, zoom.duration(),
+                             zoom.npoints / zoom.out_rate))
+        if self._stale:
+            status += " %d stale frames dropped." % self._stale
+        return status.strip()
+
+    def submit(self, data):
+        """Queue data for processing, replacing any unprocessed frame"""
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._process_loop,
+                                                daemon=True)
+                self._thread.start()
+            if self._pending is not None:
+                self._stale += 1
+                metrics.count('frames_stale')
+            self._pending = data
+            self._cond.notify_all()
+
+    def fetch(self):
+        """Return the latest processed frame, or None if there is none"""
+        with self._cond:
+            frame, self._done = self._done, None
+        return frame
+
+    def process(self, data):
+        """Process data now, returning a new frame.
+
+        The frame is a copy of data with the time axis of its traces in
+        'times', and (frequencies, psd) for each channel in 'spectra'. The
+        traces are not copied: multiply them by the prefactor for scaled
+        units, while spectra are already scaled."""
+        t0 = time.perf_counter()
+        self._apply_requested()
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self._workers)
+        rate = data['rate']
+        if self._average is not None:
+            if self._averager is None or self._averager.rate != rate:
+                self._averager = SpectrumAverager(rate, self._nperseg)
+        if self._history is not None:
+            if self._spectrogram is None or self._spectrogram.rate != rate:
+                self._spectrogram = Spectrogram(rate, self._sg_nperseg,
+                                                self._history)
+        # Only the samples that were not in the last window are new; if a
+        # window was missed, the data are no longer contiguous.
+        sequence = data.get('sequence')
+        contiguous = (sequence is not None and self._sequence is not None
+                      and sequence == self._sequence + 1
+                      and not data.get('dropped'))
+        self._sequence = sequence
+        frame = dict(data)
+        frame['times'] = self._time_axis(data['points'], rate)
+        names = list(data['channels'])
+        prefactor = data['prefactor']
+        frame['spectra'] = {}
+        if self._zoom_band is not None:
+            frame['spectra'] = self._process_zoom(frame, names, contiguous)
+        elif self._average is None:
+            # Transform channels of each length together, scaling the
+            # spectra rather than the data.
+            lengths = {}
+            for k in names:
+                lengths.setdefault(len(data['channels'][k]), []).append(k)
+            for keys in lengths.values():
+                freqs, psd = self._engine.psd(
+                    [data['channels'][k] for k in keys], rate,
+                    scale=prefactor ** 2)
+                for k, p in zip(keys, psd):
+                    frame['spectra'][k] = (freqs, p)
+        rows = {}
+        if self._average is not None or self._history is not None:
+            results = self._pool.map(
+                lambda k: self._process_channel(frame, k, contiguous), names)
+            for k, (spectrum, r) in zip(names, results):
+                if spectrum is not None:
+                    frame['spectra'][k] = spectrum
+                if r is not None:
+                    rows[k] = r
+        if self._cross_mode is not None and names:
+            frame['cross'] = self._process_cross(frame, names, contiguous)
+        sg = self._spectrogram if self._history is not None else None
+        if sg is not None:
+            frame['spectrogram'] = {
+                'freqs': sg.freqs, 'row_period': sg.row_period,
+                'nrows': sg.nrows, 'rows': rows}
+        metrics.observe('psd_ms', 1000 * (time.perf_counter() - t0))
+        if self._publisher is not None:
+            self._publisher.publish(frame)
+        return frame
+
+    def _time_axis(self, npoints, rate):
+        """Return times for npoints samples at rate, cached"""
+        key, times = self._times
+        if key != (npoints, rate):
+            times = np.linspace(0, npoints / rate, npoints)
+            times.flags.writeable = False
+            self._times = ((npoints, rate), times)
+        return times
+
+    def _process_zoom(self, frame, names, contiguous):
+        """Add the new samples of all channels to the zoom spectrum, and
+        return (frequencies, psd) for each channel"""
+        rate = frame['rate']
+        lo, hi = self._zoom_band
+        if lo >= rate / 2:
+            # Nothing to show above the Nyquist frequency.
+            return {k: (np.zeros(0), np.zeros(0)) for k in names}
+        zoom = self._zoom
+        if zoom is None or zoom.rate != rate:
+            zoom = self._zoom = ZoomSpectrum(rate, lo, min(hi, rate / 2),
+                                             self._resolution)
+        if names:
+            raw = [np.asarray(frame['channels'][k]) for k in names]
+            n = min(len(v) for v in raw)
+            new = min(frame.get('new', n), n) if contiguous else n
+            zoom.add(names, np.stack([v[len(v) - new:] for v in raw]),
+                     contiguous)
+        spectra = zoom.spectra()
+        if spectra is None:
+            return {k: (np.zeros(0), np.zeros(0)) for k in names}
+        freqs, psd = spectra
+        psd *= frame['prefactor'] ** 2
+        return {k: (freqs, p) for k, p in zip(names, psd)}
+
+    def _process_cross(self, frame, names, contiguous):
+        """Add the new samples of all channels to the cross-spectra, and
+        return their estimates for the frame"""
+        rate = frame['rate']
+        cross = self._cross
+        if (cross is None or cross.rate != rate
+                or cross.nperseg != self._nperseg):
+            cross = self._cross = CrossSpectrum(rate, self._nperseg)
+        # Coherence and transfer functions are ratios of spectra, the same
+        # whatever the prefactor, so the unscaled data will do.
+        raw = [np.asarray(frame['channels'][k]) for k in names]
+        n = min(len(v) for v in raw)
+        new = min(frame.get('new', n), n) if contiguous else n
+        cross.add(names, np.stack([v[len(v) - new:] for v in raw]),
+                  contiguous)
+        reference = self._reference
+        if reference not in names:
+            reference = names[0] if names else None
+        return {'mode': self._cross_mode, 'reference': reference,
+                'freqs': cross.freqs, 'count': cross.count(),
+                'estimates': cross.estimates(reference)}
+
+    def _process_channel(self, frame, k, contiguous):
+        """Return averaged (f, psd) and new spectrogram rows for one
+        channel, either None if not in use. Both are computed from the
+        unscaled samples, then scaled."""
+        v = np.asarray(frame['channels'][k])
+        scale = frame['prefactor'] ** 2
+        new = frame.get('new', len(v))
+        latest = v[len(v) - new:] if contiguous else v
+        rows = None
+        sg = self._spectrogram if self._history is not None else None
+        if sg is not None:
+            rows = sg.add(k, latest, contiguous)
+            rows *= scale
+        avg = self._averager if self._average is not None else None
+        if avg is None or self._zoom_band is not None:
+            return None, rows
+        avg.add(k, latest, contiguous)
+        spectrum = avg.spectrum(k, self._average)
+        if spectrum is None:
+            return (np.zeros(0), np.zeros(0)), rows
+        freqs, psd = spectrum
+        psd *= scale
+        return (freqs, psd), rows
+
+    def _process_loop(self):
+        """Target for processing thread"""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                data, self._pending = self._pending, None
+            try:
+                frame = self.process(data)
+            except Exception:
+                import traceback
+                import sys
+                traceback.print_exc(file=sys.stderr)
+                continue
+            frame['ready_time'] = time.time()
+            with self._cond:
+                # A frame still waiting has already woken the consumer.
+                notify = self._done is None
+                if self._done is not None:
+                    self._stale += 1
+                    metrics.count('frames_stale')
+                    _merge_rows(self._done, frame)
+                self._done = frame
+            if notify and self.on_frame is not None:
+                self.on_frame()
+
+
+class StreamReader():
+    # Seconds to wait for other devices to restart together.
+    SYNC_TIMEOUT = 2.
+
+    def __init__(self, device_factory=open_u6):
+        # A buffer for decoded samples, sized from the sampling settings.
+        self.buffer = None
+        # Channel names for each row in the buffer, and the reverse mapping.
+        self._names = []
+        self._rows = {}
+        # Number of points dropped during the current acquisition.
+        self._dropped = 0
+        # Integration time in seconds
+        self._t_integrate = 2
+        # Data required
+        self.data_request = threading.Event()
+        # Data ready for processing
+        self.data_ready = threading.Event()
+        # Collection thread should stop
+        self.data_stop = threading.Event()
+        # Connecton to U6 hardware, and a function to open it.
+        self._device = None
+        self._device_factory = device_factory
+        # Data collection thread.
+        self._acq_thread = None
+        # List of channels to collect
+        self._channels = []
+        # Sampling rate
+        self._rate = 5000
+        # Decoder for raw stream data, set up when streaming is configured.
+        self._decoder = None
+        # Stream continuously, rather than stopping after each acquisition.
+        self._continuous = False
+        # Fractional overlap between successive windows in continuous mode.
+        self._overlap = 0.0
+        # Latest window from continuous mode, and lock for handoff to client.
+        self._frame = None
+        self._frame_lock = threading.Lock()
+        # Windows replaced before the client collected them.
+        self._skipped = 0
+        # Extra samples per channel kept before each continuous window, so
+        # that windows from several devices can be aligned in time.
+        self._margin = 0
+        # Wall-clock time at which the stream started, and time of the end
+        # of the last single acquisition.
+        self._t_stream = None
+        self._end_time = None
+        # Settings requested while acquiring, applied by the acquisition
+        # thread at the next read, with the time of the first request.
+        self._requested = {}
+        self._config_lock = threading.Lock()
+        self._reconfigure = threading.Event()
+        # Seconds from the last reconfiguration request to streaming with
+        # the new settings.
+        self.reconfigure_latency = None
+        # Status callback
+        self.status = ""
+
+    def connect(self):
+        self._device = self._device_factory()
+
+    def __del__(self):
+        """Close connection to hardware"""
+        if self._device is not None:
+            try:
+                self._device.streamStop()
+            except Exception:
+                pass
+            self._device.close()
+
+    def is_running(self):
+        """Return True if acquisition thread is running"""
+        return self._acq_thread is not None and self._acq_thread.is_alive()
+
+    def set_channels(self, channels: List[int]):
+        """Set list of channels to acquire"""
+        self.reconfigure(channels=channels)
+
+    def set_sampling(self, rate: Optional[int] = None,
+                     time: Optional[float] = None,
+                     overlap: Optional[float] = None):
+        self.reconfigure(rate=rate, time=time, overlap=overlap)
+
+    def reconfigure(self, channels: Optional[List[int]] = None,
+                    rate: Optional[int] = None, time: Optional[float] = None,
+                    overlap: Optional[float] = None,
+                    sync: Optional[threading.Barrier] = None):
+        """Change channels and sampling settings without blocking.
+
+        While the acquisition thread runs, the settings are queued for it
+        to apply after its current read: it discards any partial capture,
+        stops the stream, and starts it again with the new settings on the
+        same device, from the same thread. Otherwise, they apply at once.
+        If sync is given, the thread waits there before streaming with the
+        new settings, so that several devices restart together."""
+        settings = {k: v for k, v in (('channels', channels), ('rate', rate),
+                                      ('time', time), ('overlap', overlap))
+                    if v is not None}
+        self._request(settings, sync)
+
+    def _request(self, settings, sync):
+        with self._config_lock:
+            self._requested.setdefault('t_request', time.perf_counter())
+            self._requested.update(settings)
+            if sync is not None:
+                self._requested['sync'] = sync
+            self._reconfigure.set()
+            if not self.is_running():
+                self._apply_idle()
+
+    def _apply_idle(self):
+        """Apply queued settings with no acquisition thread to do so,
+        keeping any barrier for when acquisition starts. Call with
+        _config_lock held."""
+        requested, self._requested = self._requested, {}
+        self._apply(requested)
+        if 'sync' in requested:
+            self._requested = {k: requested[k]
+                               for k in ('t_request', 'sync')}
+        else:
+            self._reconfigure.clear()
+
+    def _apply(self, settings):
+        if not settings:
+            return
+        # A window not yet fetched has the old settings.
+        with self._frame_lock:
+            self._frame = None
+        self.data_ready.clear()
+        if 'channels' in settings:
+            self._channels = list(settings['channels'])
+        if 'rate' in settings:
+            self._rate = settings['rate']
+        if 'time' in settings:
+            self._t_integrate = settings['time']
+        if 'overlap' in settings:
+            self._overlap = min(max(settings['overlap'], 0.0), 0.95)
+
+    def _apply_requested(self):
+        """Apply queued settings in the acquisition thread.
+
+        Returns the time of the request and the barrier to wait at, or
+        (None, None) if there were none."""
+        with self._config_lock:
+            requested, self._requested = self._requested, {}
+            self._reconfigure.clear()
+        if not requested:
+            return None, None
+        t_request = requested.pop('t_request')
+        sync = requested.pop('sync', None)
+        self._apply(requested)
+        return t_request, sync
+
+    def _check_settings(self, channels, rate):
+        """Return why settings cannot be used, or None if they can"""
+        if len(channels) == 0:
+            return "No channels selected."
+        if rate > (MAXSAMPLERATE / len(channels)):
+            return "Sample rate too high for %d channels." % len(channels)
+        return None
+
+    def set_margin(self, samples: int):
+        """Keep samples per channel more than the integration time at the
+        start of each continuous window, for alignment with other devices.
+        Takes effect when acquisition next starts."""
+        self._margin = max(0, int(samples))
+
+    def start_acquisition(self, continuous: Optional[bool] = None):
+        """Start data acquisition thread
+
+        If continuous is True, the stream is left running and successive
+        windows are published until stop_acquisition is called. If None,
+        the last mode is used."""
+        if continuous is not None and continuous != self._continuous:
+            if self.is_running():
+                self.stop_acquisition()
+            self._continuous = continuous
+        if self._device is None:
+            try:
+                self.connect()
+            except Exception:
+                self.status = "No hardware connected."
+                return False
+        if not self.is_running():
+            # Settings queued for a thread that has since stopped.
+            with self._config_lock:
+                self._apply_idle()
+        error = self._check_settings(self._channels, self._rate)
+        if error is not None:
+            self.status = error
+            return False
+        if self._acq_thread is None or not self._acq_thread.is_alive():
+            self.data_stop.clear()
+            self._acq_thread = threading.Thread(target=self._acquire_loop,
+                                                daemon=True)
+            self._acq_thread.start()
+        self.data_request.set()
+        return True
+
+    def stop_acquisition(self):
+        """Stop data acquisition thread"""
+        self.data_request.clear()
+        self.data_stop.set()
+        if self._acq_thread:
+            self._acq_thread.join(2*self._t_integrate)
+            if self._acq_thread.is_alive():
+                self.status = "Acquisiton thread timed out"
+
+    def fetch_data(self):
+        """Fetch data from the last completed acquisition.
+
+        For single acquisitions, channel data are views into the acquisition
+        buffer, valid until the next acquisition starts: copy them to keep
+        them any longer. In continuous mode, each window is a copy taken by
+        the acquisition thread, and the latest window replaces any that has
+        not been fetched."""
+        if not self.data_ready.wait(0.05):
+            return {}
+        self.data_ready.clear()
+        with self._frame_lock:
+            frame, self._frame = self._frame, None
+        if frame is not None:
+            return frame
+        data = {k: self.buffer.latest(i) for i, k in enumerate(self._names)}
+        npoints = max(map(len, data.values()))
+        return {'rate': self._rate, 'points': npoints,
+                'channels': data, 'dropped': self._dropped,
+                'end_time': self._end_time}
+
+    def get_status(self):
+        return self.status
+
+    def _prepare_buffer(self, channels, rate):
+        """Size the sample buffer for one acquisition and clear it.
+
+        The buffer is only reallocated if the settings need a new size."""
+        self._names = list(dict.fromkeys("AIN%d" % c for c in channels))
+        self._rows = {k: i for i, k in enumerate(self._names)}
+        # Acquisition ends on the first read that completes the integration
+        # time, so allow for one whole read more than that per channel.
+        dev = self._device
+        capacity = (int(np.ceil(self._t_integrate * rate)) + self._margin
+                    + dev.packetsPerRequest * dev.streamSamplesPerPacket)
+        shape = (len(self._names), capacity)
+        if self.buffer is None or self.buffer.shape != shape:
+            self.buffer = None
+            self.buffer = RingBuffer(*shape)
+        else:
+            self.buffer.clear()
+        self._dropped = 0
+
+    def _read(self, stream):
+        """Read the next raw result from the stream, recording how long
+        the read blocked."""
+        t0 = time.perf_counter()
+        raw = next(stream)
+        metrics.observe('read_ms', 1000 * (time.perf_counter() - t0))
+        if raw is None:
+            metrics.count('empty_reads')
+        return raw
+
+    def _store(self, raw):
+        """Decode a raw streamData result into the sample buffer.
+
+        Returns the number of samples read, summed over channels."""
+        self._dropped += raw['missed']
+        t0 = time.perf_counter()
+        for k, v in self._decoder.decode(raw['result']).items():
+            self.buffer.write(self._rows[k], v)
+        metrics.observe('decode_ms', 1000 * (time.perf_counter() - t0))
+        self._record_packets(raw)
+        return raw['numPackets'] * self._device.streamSamplesPerPacket
+
+    def _record_packets(self, raw):
+        """Record packet counts, errors and device backlog for a read"""
+        npackets = raw['numPackets']
+        metrics.count('reads')
+        metrics.count('packets', npackets)
+        metrics.observe('missed_per_read', raw['missed'])
+        if raw['missed']:
+            metrics.count('missed', raw['missed'])
+        if raw['errors']:
+            metrics.count('errors', raw['errors'])
+        # Each packet has its error code in byte 11 and the device's
+        # stream backlog in the first byte of the footer.
+        size = (StreamDecoder.HEADER_SIZE + StreamDecoder.FOOTER_SIZE
+                + 2 * self._device.streamSamplesPerPacket)
+        packets = np.frombuffer(raw['result'], dtype=np.uint8,
+                                count=npackets * size).reshape(npackets, size)
+        for code in packets[:, 11][packets[:, 11] != 0]:
+            metrics.count('error_%d' % code)
+        backlog = int(packets[-1, size - 2]) if npackets else 0
+        metrics.gauge('backlog', backlog)
+        metrics.observe('backlog', backlog)
+
+    def _publish_window(self, rate, nwindow, dropped, stats):
+        """Copy the latest window from the buffer for collection by client"""
+        data = {k: np.array(self.buffer.latest(i, nwindow + self._margin))
+                for i, k in enumerate(self._names)}
+        frame = {'rate': rate, 'points': max(map(len, data.values())),
+                 'channels': data, 'dropped': dropped}
+        frame.update(stats)
+        with self._frame_lock:
+            if self._frame is not None:
+                self._skipped += 1
+                metrics.count('windows_skipped')
+            self._frame = frame
+        metrics.count('windows')
+        self.data_ready.set()
+
+    def _stream_continuous(self, stream, rate, nchannels):
+        """Stream without stopping, publishing successive windows.
+
+        A window of the integration time is published each time enough new
+        samples have arrived to advance by (1 - overlap) windows. Returns
+        after the read during which a reconfiguration was requested,
+        leaving that partial window unpublished. Returns an exception if
+        the stream failed, else None."""
+        nwindow = int(np.ceil(self._t_integrate * rate))
+        hop = max(1, int(round(nwindow * (1 - self._overlap))))
+        # Samples per channel at the last window, and missed samples.
+        published = nwindow - hop
+        # Samples per channel at the end of the last window.
+        last_end = 0
+        missed_at_window = 0
+        # Reads that reported missed samples.
+        gaps = 0
+        windows = 0
+        self._skipped = 0
+        t_start = time.time()
+        while not self.data_stop.is_set():
+            try:
+                raw = self._read(stream)
+            except Exception as e:
+                import traceback
+                import sys
+                traceback.print_exc(file=sys.stderr)
+                return e
+            if raw is None:
+                self.status = "Error: no data"
+                continue
+            self._store(raw)
+            if self._reconfigure.is_set():
+                break
+            if raw['missed']:
+                gaps += 1
+            n = min(map(self.buffer.written, range(len(self._names))))
+            if n - published < hop:
+                continue
+            # Keep to the hop cadence on average, even though windows can
+            # only end on read boundaries.
+            published += hop * ((n - published) // hop)
+            windows += 1
+            # Fraction of the signal since the stream started that reached
+            # the buffer.
+            acquired = n * nchannels
+            duty = acquired / (acquired + self._dropped)
+            # Samples at the end of this window not in the previous one.
+            # Windows end on read boundaries, so without overlap two
+            # window ends can be more than a window apart: widen the
+            # window to include them all, rather than skip samples.
+            new = min(n - last_end, nwindow) if windows == 1 else n - last_end
+            last_end = n
+            stats = {'sequence': windows, 'overlap': self._overlap,
+                     'new': new, 'duty': duty, 'gaps': gaps,
+                     'skipped': self._skipped,
+                     'elapsed': time.time() - t_start,
+                     'end_time': self._sample_time(n, nchannels, rate)}
+            self._publish_window(rate, max(nwindow, new),
+                                 self._dropped - missed_at_window, stats)
+            missed_at_window = self._dropped
+            self.status = ("Streaming continuously: duty %.1f%%, "
+                           "%d gaps, %d of %d windows skipped." %
+                           (100 * duty, gaps, self._skipped, windows))
+        return None
+
+    def _sample_time(self, n, nchannels, rate):
+        """Estimated wall-clock time at the end of n samples per channel,
+        counting samples lost on the device"""
+        return self._t_stream + (n + self._dropped / nchannels) / rate
+
+    def _acquire_loop(self):
+        """Target for data acquisition thread."""
+        dev = self._device
+        try:
+            dev.streamStop()
+        except Exception:
+            pass
+        error = None
+        # Time of a reconfiguration request not yet streaming, and the
+        # barrier to wait at before streaming.
+        t_request = sync = None
+        while not self.data_stop.is_set():
+            t, barrier = self._apply_requested()
+            if t is not None:
+                t_request, sync = min(t, t_request or t), barrier
+            if not self.data_request.wait(0.01):
+                # Nothing to restart until the next acquisition.
+                t_request = sync = None
+                self.status = "Waiting"
+                continue
+            # Do acquisition
+            # Prevent data collection by client.
+            self.data_ready.clear()
+            # Grab and store local copy of current sampling settings, as
+            # these may change.
+            channels = self._channels
+            rate = self._rate
+            continuous = self._continuous
+            nchannels = len(self._channels)
+            invalid = self._check_settings(channels, rate)
+            if invalid is not None:
+                # Wait for settings that can be used.
+                self.status = invalid
+                if sync is not None:
+                    sync.abort()
+                    sync = None
+                self._reconfigure.wait(0.05)
+                continue
+            try:
+                dev.streamConfig(NumChannels=nchannels,
+                                 ChannelNumbers=channels,
+                                 ChannelOptions=[0]*nchannels,
+                                 ResolutionIndex=0, ScanFrequency=rate)
+            except Exception as e:
+                self.status = "Error: %s" % e
+                self._reconfigure.wait(0.05)
+                continue
+            self._decoder = StreamDecoder(dev)
+            self._prepare_buffer(channels, rate)
+            npts = 0
+            stream = dev.streamData(convert=False)
+            if sync is not None:
+                # Start together with the other devices.
+                try:
+                    sync.wait(self.SYNC_TIMEOUT)
+                except threading.BrokenBarrierError:
+                    pass
+                sync = None
+            self.status = "Streaming"
+            dev.streamStart()
+            self._t_stream = time.time()
+            if t_request is not None:
+                self.reconfigure_latency = time.perf_counter() - t_request
+                metrics.observe('reconfigure_ms',
+                                1000 * self.reconfigure_latency)
+                t_request = None
+            if continuous:
+                error = self._stream_continuous(stream, rate, nchannels)
+                dev.streamStop()
+                if error is not None:
+                    self.data_stop.set()
+                continue
+            while npts < self._t_integrate * self._rate * nchannels:
+                if self.data_stop.is_set() or self._reconfigure.is_set():
+                    break
+                try:
+                    raw = self._read(stream)
+                except Exception as e:
+                    import traceback
+                    import sys
+                    traceback.print_exc(file=sys.stderr)
+                    self.data_stop.set()
+                    error = e
+                    break
+                if raw is None:
+                    self.status = "Error: no data"
+                    continue
+                npts += self._store(raw)
+            dev.streamStop()
+            if self._reconfigure.is_set():
+                # Discard the partial capture, and acquire again with the
+                # new settings.
+                continue
+            self._end_time = self._sample_time(
+                min(map(self.buffer.written, range(len(self._names)))),
+                nchannels, rate)
+            if error is None:
+                self.data_request.clear()
+            if not self.data_stop.is_set():
+                # set event
+                self.data_ready.set()
+        if error is None:
+            self.status = "Stopped."
+        else:
+            self.status = "Aborted: %s" % error
+
+
+class MultiStreamReader():
+    # Most samples per channel in one read: 48 packets of 25 samples.
+    MAXREAD = 48 * 25
+    # Allowance in seconds for the difference in start times of devices.
+    START_SKEW = 0.05
+
+    def __init__(self, device_factories, labels=None):
+        """Acquire from several devices at once, as one capture.
+
+        Each device has its own StreamReader, with its own acquisition
+        thread and buffer, and the same interface is offered here. When
+        every device has a new capture, they are aligned on the estimated
+        time of their last samples, trimmed to a common length, and
+        combined. Channel names are prefixed with the device label, as in
+        '320012345/AIN0', and counts of dropped samples, duty, gaps and
+        skipped windows for each device are given under 'devices'.
+
+        The devices are not synchronized in hardware: alignment is to
+        within the jitter of USB transfers, and their clocks drift apart
+        over a long stream. Restart acquisition to realign them."""
+        self.readers = [StreamReader(f) for f in device_factories]
+        if labels is None:
+            labels = [str(i) for i in range(len(self.readers))]
+        self.labels = list(labels)
+        # Channels for each device.
+        self._channels = [[] for r in self.readers]
+        self._rate = 5000
+        self._t_integrate = 2
+        self._continuous = False
+        # Latest capture from each device, waiting for the others.
+        self._pending = [None] * len(self.readers)
+        # Sequence number of the last capture from each device.
+        self._device_sequence = [None] * len(self.readers)
+        # Sequence, end time and number of combined windows, and device
+        # windows replaced while waiting for other devices.
+        self._sequence = 0
+        self._last_end = None
+        self._skipped = 0
+        self.status = ""
+
+    def _active(self):
+        """Indices of devices with channels to acquire"""
+        return [i for i, c in enumerate(self._channels) if c]
+
+    def _margin(self):
+        """Samples per channel kept for alignment: the difference between
+        the ends of devices' windows is at most one read and the skew in
+        start times."""
+        return self.MAXREAD + int(np.ceil(self.START_SKEW * self._rate))
+
+    def is_running(self):
+        """Return True if acquisition is running on every active device"""
+        active = self._active()
+        return bool(active) and all(self.readers[i].is_running()
+                                    for i in active)
+
+    def set_channels(self, channels):
+        """Set channels to acquire: a list of channels for all devices, or
+        a list of such lists, one per device"""
+        if not channels or not isinstance(channels[0], (list, tuple)):
+            channels = [channels] * len(self.readers)
+        running = self.is_running()
+        self._channels = [list(c) for c in channels]
+        self._reconfigure(running, [{'channels': c} for c in self._channels])
+
+    def set_sampling(self, rate: Optional[int] = None,
+                     time: Optional[float] = None,
+                     overlap: Optional[float] = None):
+        if rate is not None:
+            self._rate = rate
+        if time is not None:
+            self._t_integrate = time
+        settings = {'rate': rate, 'time': time, 'overlap': overlap}
+        self._reconfigure(self.is_running(),
+                          [settings] * len(self.readers))
+
+    def _reconfigure(self, running, settings):
+        """Reconfigure each device without blocking.
+
+        If acquiring, every active device restarts with its new settings
+        at the same time, and devices newly given channels join them. The
+        next combined capture is marked as not contiguous with the last."""
+        active = self._active()
+        sync = None
+        if running and len(active) > 1:
+            sync = threading.Barrier(len(active))
+        self._pending = [None] * len(self.readers)
+        if self._last_end is not None:
+            self._last_end = None
+            self._sequence += 1
+        for i, (reader, s) in enumerate(zip(self.readers, settings)):
+            reader.set_margin(self._margin())
+            reader.reconfigure(sync=sync if i in active else None, **s)
+            if running and i in active and not reader.is_running():
+                reader.start_acquisition(self._continuous)
+
+    def start_acquisition(self, continuous: Optional[bool] = None):
+        """Start acquisition on every device with channels selected"""
+        if continuous is not None:
+            self._continuous = continuous
+        if not self.is_running():
+            self._sequence = 0
+            self._last_end = None
+            self._skipped = 0
+            self._device_sequence = [None] * len(self.readers)
+        self._pending = [None] * len(self.readers)
+        active = self._active()
+        if not active:
+            self.status = "No channels selected."
+            return False
+        for i in active:
+            reader = self.readers[i]
+            reader.set_margin(self._margin())
+            if not reader.start_acquisition(self._continuous):
+                self.status = "%s: %s" % (self.labels[i], reader.get_status())
+                self.stop_acquisition()
+                return False
+        return True
+
+    def stop_acquisition(self):
+        """Stop acquisition on all devices"""
+        for reader in self.readers:
+            reader.stop_acquisition()
+
+    def fetch_data(self):
+        """Fetch a capture combined from all active devices.
+
+        Returns an empty dict until every active device has a new capture.
+        As for StreamReader, channel data may be views into the devices'
+        acquisition buffers."""
+        active = self._active()
+        if not active:
+            time.sleep(0.05)
+            return {}
+        missing = [i for i in active if self._pending[i] is None]
+        if missing:
+            self.readers[missing[0]].data_ready.wait(0.05)
+        for i in active:
+            reader = self.readers[i]
+            if not reader.data_ready.is_set():
+                continue
+            frame = reader.fetch_data()
+            # Drop a capture made before the rate last changed.
+            if frame and frame['rate'] == self._rate:
+                if self._pending[i] is not None:
+                    self._skipped += 1
+                self._pending[i] = frame
+        frames = [self._pending[i] for i in active]
+        if any(f is None for f in frames):
+            return {}
+        if self._continuous:
+            # A device too far behind the others to align within the
+            # margin will soon publish a later window: wait for it.
+            ends = [f['end_time'] for f in frames]
+            lag = self._margin() / self._rate
+            stale = [i for i, e in zip(active, ends) if max(ends) - e > lag]
+            if stale:
+                for i in stale:
+                    self._pending[i] = None
+                    self._skipped += 1
+                return {}
+        self._pending = [None] * len(self.readers)
+        return self._combine(active, frames)
+
+    def _combine(self, active, frames):
+        """Align device captures on their end times and combine them"""
+        rate = frames[0]['rate']
+        end = min(f['end_time'] for f in frames)
+        trimmed = []
+        for f in frames:
+            cut = int(round((f['end_time'] - end) * rate))
+            trimmed.append({k: v[:len(v) - cut]
+                            for k, v in f['channels'].items()})
+        npoints = min(len(v) for data in trimmed for v in data.values())
+        first = self._last_end is None
+        if self._continuous:
+            # As for one device, widened to include every new sample.
+            nwindow = int(np.ceil(self._t_integrate * rate))
+            if not first:
+                nwindow = max(nwindow,
+                              int(round((end - self._last_end) * rate)))
+            npoints = min(npoints, nwindow)
+        channels = {}
+        for i, data in zip(active, trimmed):
+            for k, v in data.items():
+                channels['%s/%s' % (self.labels[i], k)] = v[len(v) - npoints:]
+        devices = {}
+        for i, f in zip(active, frames):
+            devices[self.labels[i]] = {
+                k: f[k] for k in ('dropped', 'duty', 'gaps', 'skipped')
+                if k in f}
+            devices[self.labels[i]]['status'] = self.readers[i].get_status()
+        frame = {'rate': rate, 'points': npoints, 'channels': channels,
+                 'dropped': sum(f['dropped'] for f in frames),
+                 'end_time': end, 'devices': devices}
+        if self._continuous:
+            # As for one device, a jump in sequence marks missed data.
+            consecutive = first or all(
+                self._device_sequence[i] is not None
+                and f['sequence'] == self._device_sequence[i] + 1
+                for i, f in zip(active, frames))
+            for i, f in zip(active, frames):
+                self._device_sequence[i] = f['sequence']
+            new = npoints
+            if not first:
+                new = min(max(int(round((end - self._last_end) * rate)), 0),
+                          npoints)
+            self._sequence += 1 if consecutive else 2
+            frame.update({
+                'sequence': self._sequence, 'overlap': frames[0]['overlap'],
+                'new': new, 'duty': min(f['duty'] for f in frames),
+                'gaps': sum(f['gaps'] for f in frames),
+                'skipped': self._skipped + sum(f['skipped'] for f in frames),
+                'elapsed': max(f['elapsed'] for f in frames)})
+        self._last_end = end
+        return frame
+
+    def get_status(self):
+        return "; ".join("%s: %s" % (self.labels[i], self.readers[i].status)
+                         for i in self._active() or range(len(self.readers)))
+
+
+def stream_source(device_factories, labels=None):
+    """A StreamReader for one device factory, or a MultiStreamReader for
+    several"""
+    if len(device_factories) == 1:
+        return StreamReader(device_factories[0])
+    return MultiStreamReader(device_factories, labels)
+
+
+class TriggerCondition():
+    def __init__(self, channel: str, limit: float):
+        """Base for conditions that start a triggered capture.
+
+        A condition watches one channel, in scaled units, and keeps any
+        state it needs between successive blocks of samples."""
+        self.channel = channel
+        self.limit = limit
+
+    def reset(self):
+        """Forget past samples, as after a gap in the stream"""
+
+    def hits(self, samples, rate):
+        """Return indices in samples at which the condition is met"""
+        raise NotImplementedError
+
+
+class LevelCondition(TriggerCondition):
+    def __init__(self, channel: str, limit: float, below: bool = False):
+        """Met where the channel crosses above limit, or below it"""
+        super().__init__(channel, limit)
+        self.below = below
+        self._last = None
+
+    def __str__(self):
+        return "level:%s%s%g" % (self.channel, '<' if self.below else '>',
+                                 self.limit)
+
+    def reset(self):
+        self._last = None
+
+    def hits(self, samples, rate):
+        beyond = samples < self.limit if self.below else samples > self.limit
+        if not len(beyond):
+            return np.zeros(0, dtype=np.intp)
+        # Crossings only: a sample beyond the limit after one that is not.
+        before = np.empty_like(beyond)
+        before[0] = True if self._last is None else self._last
+        before[1:] = beyond[:-1]
+        self._last = beyond[-1]
+        return np.flatnonzero(beyond & ~before)
+
+
+class RmsCondition(TriggerCondition):
+    def __init__(self, channel: str, window: float, limit: float):
+        """Met where the rms over the last window seconds exceeds limit"""
+        super().__init__(channel, limit)
+        self.window = window
+        self._tail = np.zeros(0)
+
+    def __str__(self):
+        return "rms:%s:%g>%g" % (self.channel, self.window, self.limit)
+
+    def reset(self):
+        self._tail = np.zeros(0)
+
+    def hits(self, samples, rate):
+        n = max(1, int(round(self.window * rate)))
+        x = np.concatenate((self._tail, samples))
+        self._tail = x[-(n - 1):] if n > 1 else x[:0]
+        # Running sums of squares give the mean square over each window.
+        sums = np.concatenate(([0.], np.cumsum(x * x)))
+        ends = np.arange(len(x) - len(samples), len(x)) + 1
+        valid = ends >= n
+        meansq = (sums[ends[valid]] - sums[ends[valid] - n]) / n
+        offset = len(samples) - np.count_nonzero(valid)
+        return offset + np.flatnonzero(meansq > self.limit ** 2)
+
+
+class BandPowerCondition(TriggerCondition):
+    def __init__(self, channel: str, lo: float, hi: float, limit: float,
+                 nperseg: int = 1024):
+        """Met at the end of each segment of nperseg samples whose power
+        between lo and hi Hz exceeds limit, in units squared"""
+        super().__init__(channel, limit)
+        self.lo = lo
+        self.hi = hi
+        self.nperseg = nperseg
+        self._tail = np.zeros(0)
+
+    def __str__(self):
+        return "band:%s:%g-%g>%g" % (self.channel, self.lo, self.hi,
+                                     self.limit)
+
+    def reset(self):
+        self._tail = np.zeros(0)
+
+    def hits(self, samples, rate):
+        x = np.concatenate((self._tail, samples))
+        nseg = len(x) // self.nperseg
+        self._tail = x[nseg * self.nperseg:]
+        if nseg == 0:
+            return np.zeros(0, dtype=np.intp)
+        freqs, psd = _engine.psd(
+            x[:nseg * self.nperseg].reshape(nseg, self.nperseg), rate)
+        band = (freqs >= self.lo) & (freqs < self.hi)
+        power = psd[:, band].sum(axis=1) * (freqs[1] - freqs[0])
+        ends = (np.arange(1, nseg + 1) * self.nperseg - 1
+                - (len(x) - len(samples)))
+        return ends[power > self.limit]
+
+
+def parse_condition(text: str):
+    """Make a trigger condition from text, as one of
+
+        level:CHANNEL>LIMIT or level:CHANNEL<LIMIT
+        rms:CHANNEL:WINDOW>LIMIT, with the window in seconds
+        band:CHANNEL:LO-HI>LIMIT, with the band in Hz
+    """
+    import re
+    m = re.match(r'^(level|rms|band):([^:<>]+)(?::([^<>]+))?([<>])(.+)$',
+                 text.strip())
+    if m is None:
+        raise ValueError("Bad trigger condition: %s" % text)
+    kind, channel, arg, op, limit = m.groups()
+    limit = float(limit)
+    if kind == 'level' and arg is None:
+        return LevelCondition(channel, limit, below=(op == '<'))
+    if op == '>' and arg is not None:
+        if kind == 'rms':
+            return RmsCondition(channel, float(arg), limit)
+        if kind == 'band':
+            lo, hi = arg.split('-')
+            return BandPowerCondition(channel, float(lo), float(hi), limit)
+    raise ValueError("Bad trigger condition: %s" % text)
+
+
+def parse_band(text: str):
+    """Return [lo, hi] in Hz from a band given as LO:HI"""
+    lo, hi = text.split(':')
+    return [float(lo), float(hi)]
+
+
+class Trigger():
+    def __init__(self, conditions: List[TriggerCondition], pre: float = 1.,
+                 post: float = 1.):
+        """Pick out windows around events in a stream of captures.
+
+        Captures are passed to feed as they arrive. Only the samples new in
+        each capture are checked; any of the conditions starts an event.
+        The last pre seconds of every channel are kept in a ring buffer,
+        and once post seconds more have arrived, the event is returned as
+        a capture of pre + post seconds. Conditions are not checked again
+        until the end of the event. Counts of samples checked and samples
+        returned are kept in stats."""
+        self.conditions = list(conditions)
+        self.pre = pre
+        self.post = post
+        self._buffer = None
+        self._names = []
+        self._rate = None
+        self._sequence = None
+        # Samples per channel fed since the last reset, the position and
+        # condition of each event waiting for its post-trigger samples,
+        # and the position from which conditions are checked again.
+        self._n = 0
+        self._pending = []
+        self._rearm = 0
+        self.stats = {'events': 0, 'evaluated': 0, 'saved': 0}
+
+    def _reset(self, names, rate, nnew):
+        """Start again, as for new settings or after a gap"""
+        self._names = names
+        self._rate = rate
+        npre = int(np.ceil(self.pre * rate))
+        npost = int(np.ceil(self.post * rate))
+        capacity = npre + npost + 2 * nnew
+        if (self._buffer is None or self._buffer.shape[0] != len(names)
+                or self._buffer.capacity < capacity):
+            self._buffer = RingBuffer(len(names), capacity)
+        else:
+            self._buffer.clear()
+        self._n = 0
+        self._pending = []
+        self._rearm = 0
+        for c in self.conditions:
+            c.reset()
+
+    def feed(self, data):
+        """Check the new samples in a capture, returning a list of the
+        captures for any events completed."""
+        channels = data['channels']
+        names = list(channels)
+        rate = data['rate']
+        new = min(data.get('new', data['points']), data['points'])
+        sequence = data.get('sequence')
+        contiguous = (sequence is not None and self._sequence is not None
+                      and sequence == self._sequence + 1)
+        self._sequence = sequence
+        done = []
+        if (not contiguous or names != self._names or rate != self._rate
+                or new > self._buffer.capacity // 2):
+            # A gap: events waiting for more samples get what there is.
+            done = self._flush(data)
+            self._reset(names, rate, data['points'])
+            new = data['points']
+        start = self._n
+        for i, k in enumerate(names):
+            v = channels[k]
+            self._buffer.write(i, v[len(v) - new:])
+        self._n += new
+        self.stats['evaluated'] += new * len(names)
+        prefactor = data.get('prefactor', 1.0)
+        hits = []
+        which = []
+        for j, c in enumerate(self.conditions):
+            if c.channel in channels:
+                v = channels[c.channel]
+                hits.append(start + c.hits(
+                    prefactor * np.asarray(v[len(v) - new:]), rate))
+                which.append(np.full(len(hits[-1]), j))
+        if hits:
+            hits = np.concatenate(hits)
+            order = np.argsort(hits, kind='stable')
+            hits, which = hits[order], np.concatenate(which)[order]
+            npost = int(np.ceil(self.post * rate))
+            while True:
+                i = np.searchsorted(hits, self._rearm)
+                if i == len(hits):
+                    break
+                self._pending.append((int(hits[i]), int(which[i])))
+                self._rearm = int(hits[i]) + npost
+        return done + self._flush(data, complete=True)
+
+    def _flush(self, data, complete=False):
+        """Return captures for pending events, only those with all their
+        post-trigger samples if complete"""
+        if self._buffer is None:
+            return []
+        npre = int(np.ceil(self.pre * self._rate))
+        npost = int(np.ceil(self.post * self._rate))
+        events = []
+        while self._pending:
+            t, j = self._pending[0]
+            if complete and t + npost > self._n:
+                break
+            self._pending.pop(0)
+            end = min(t + npost, self._n)
+            begin = max(t - npre, self._n - self._buffer.capacity, 0)
+            channels = {k: np.array(self._buffer.latest(i, self._n - begin)
+                                    [:end - begin])
+                        for i, k in enumerate(self._names)}
+            capture = {k: data[k] for k in ('prefactor', 'unit') if k in data}
+            capture.update({'rate': self._rate, 'points': end - begin,
+                            'channels': channels, 'dropped': 0,
+                            'trigger': {'pre': (t - begin) / self._rate,
+                                        'condition': str(self.conditions[j])}})
+            if data.get('end_time') is not None and complete:
+                # Time of the trigger sample.
+                capture['trigger']['time'] = (data['end_time']
+                                              - (self._n - t) / self._rate)
+                capture['end_time'] = (data['end_time']
+                                       - (self._n - end) / self._rate)
+            self.stats['events'] += 1
+            self.stats['saved'] += (end - begin) * len(self._names)
+            events.append(capture)
+        return events
+
+
+class DataHandler():
+    # Binary capture files start with this, followed by the header length as
+    # a little-endian uint32, a JSON header, then channel arrays.
+    BINARY_MAGIC = b'LJSABIN\x01'
+    # Channel arrays start on multiples of this many bytes.
+    BINARY_ALIGN = 64
+    # File extension for each format. An archive holds many captures.
+    EXTENSIONS = {'binary': '.ljsa', 'json': '.txt', 'archive': '.ljsarc'}
+
+    def __init__(self, fmt='binary', maxqueue=8, timeout=0.5):
+        self._path = None
+        self._status = (None, "")
+        # Format for "save all".
+        self._format = fmt
+        # Captures waiting to be saved by the writer thread. save_continuous
+        # waits up to timeout for space, then drops the capture.
+        self._queue = queue.Queue(maxqueue)
+        self._timeout = timeout
+        self._writer = None
+        # Last timestamp and index used for a "save all" filename.
+        self._last_name = (None, -1)
+        # Session archive for "save all" in the archive format.
+        self._archive = None
+        # If set, "save all" saves only captures of triggered events.
+        self._trigger = None
+        # Writer statistics.
+        self._written = 0
+        self._bytes = 0
+        self._dropped = 0
+        self._latency = 0.
+
+    def get_status(self):
+        if self._status[0] is None:
+            return ""
+        elif time.time() - self._status[0] > 5:
+            if self._path:
+                sstr = self._save_all_status()
+                self._status = (time.time(), sstr)
+            else:
+                self._status = (None, "")
+        return self._status[1]
+
+    def get_stats(self):
+        """Return writer queue depth, files and bytes written, and the
+        number of captures dropped because the queue was full."""
+        stats = {'queued': self._queue.qsize(), 'written': self._written,
+                 'bytes': self._bytes, 'dropped': self._dropped,
+                 'latency': self._latency}
+        if self._trigger is not None:
+            stats['trigger'] = dict(self._trigger.stats)
+        return stats
+
+    def _save_all_status(self, path=None):
+        path = path or self._path
+        sstr = "Saving all to %s: %d queued, %d files, %.1f MB, %d ms/file" % (
+            os.path.basename(path), self._queue.qsize(), self._written,
+            self._bytes / 2**20, 1000 * self._latency)
+        if self._dropped:
+            sstr += ", %d dropped" % self._dropped
+        if self._trigger is not None:
+            t = self._trigger.stats
+            sstr += ", %d events, %.2g%% of %d samples kept" % (
+                t['events'], 100 * t['saved'] / max(t['evaluated'], 1),
+                t['evaluated'])
+        return sstr + "."
+
+    def save_continuous(self, data):
+        """Queue data to be saved to the "save all" folder.
+
+        Only a reference to data is kept, so it must not be modified
+        afterwards. If the writer has fallen behind, this blocks for a
+        short time, then drops the data. With a trigger set, data are
+        checked for events and only their captures are queued."""
+        if self._path is None:
+            return
+        if self._trigger is not None:
+            for event in self._trigger.feed(data):
+                self._enqueue(event)
+            return
+        self._enqueue(data)
+
+    def _enqueue(self, data):
+        """Queue data for the writer thread"""
+        import datetime
+        ts = datetime.datetime.now().replace(microsecond=0).isoformat()
+        ts = ts.replace(':', '')
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop,
+                                            daemon=True)
+            self._writer.start()
+        try:
+            self._queue.put((self._path, ts, data), timeout=self._timeout)
+        except queue.Full:
+            self._dropped += 1
+            metrics.count('saves_dropped')
+            self._status = (time.time(), self._save_all_status())
+        metrics.gauge('save_queue', self._queue.qsize())
+
+    def flush(self, timeout: Optional[float] = None):
+        """Wait for queued data to be written.
+
+        Returns True if the queue was emptied within timeout."""
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(
+                lambda: not self._queue.unfinished_tasks, timeout)
+
+    def _write_loop(self):
+        """Target for writer thread"""
+        while True:
+            path, ts, data = self._queue.get()
+            t0 = time.time()
+            try:
+                nbytes = self._save_new(path, ts, data)
+                if nbytes is not None:
+                    self._written += 1
+                    self._bytes += nbytes
+            except Exception:
+                self._status = (time.time(), "Error writing to %s." %
+                                os.path.basename(path))
+            else:
+                # Smoothed write latency.
+                dt = time.time() - t0
+                self._latency += 0.2 * (dt - self._latency)
+                metrics.observe('save_ms', 1000 * dt)
+                if nbytes is not None:
+                    self._status = (time.time(), self._save_all_status(path))
+            finally:
+                self._queue.task_done()
+                metrics.gauge('save_queue', self._queue.qsize())
+
+    def _save_new(self, path, ts, data):
+        """Save data to a new file named from timestamp ts, or append it
+        to the session archive in path, which is named from the first ts.
+
+        Files are created exclusively, rather than checking whether each
+        candidate name exists. Returns the number of bytes written, or None
+        on error."""
+        if self._format == 'archive':
+            archive = self._archive
+            if archive is None or os.path.dirname(archive.path) != path:
+                archive = self._archive = SessionArchive(os.path.join(
+                    path, ts + self.EXTENSIONS['archive']),
+                    writable=True)
+            return archive.append(data)
+        last_ts, i = self._last_name
+        i = i + 1 if ts == last_ts else 0
+        while True:
+            fpath = os.path.join(path, "{:s}_{:02d}{:s}".format(
+                ts, i, self.EXTENSIONS[self._format]))
+            try:
+                error = self.save_one(fpath, data, self._format,
+                                      exclusive=True)
+            except FileExistsError:
+                i += 1
+                continue
+            self._last_name = (ts, i)
+            return None if error else os.path.getsize(fpath)
+
+    def load_one(self, fpath):
+        """Load a capture saved in either format, or the last capture in a
+        session archive"""
+        with open(fpath, 'rb') as fh:
+            magic = fh.read(len(self.BINARY_MAGIC))
+        if magic == self.BINARY_MAGIC:
+            return self._load_binary(fpath)
+        if magic == SessionArchive.MAGIC:
+            archive = SessionArchive(fpath)
+            if not len(archive):
+                raise ValueError("%s holds no captures." % fpath)
+            return archive.load(len(archive) - 1)
+        with open(fpath, 'r') as fh:
+            return json.load(fh)
+
+    def save_one(self, fpath, data_in, fmt=None, exclusive=False):
+        """Save a capture to fpath.
+
+        If fmt is None, the format is chosen from the file extension:
+        binary for .ljsa, archive for .ljsarc, otherwise JSON. A capture
+        saved to an archive is added to it. If exclusive is True, raises
+        FileExistsError rather than overwriting an existing file. Returns
+        True if there was an error writing the data."""
+        if fmt is None:
+            ext = os.path.splitext(fpath)[1].lower()
+            fmt = {v: k for k, v in self.EXTENSIONS.items()}.get(ext, 'json')
+        if fmt == 'archive':
+            try:
+                SessionArchive(fpath, writable=True).append(data_in)
+            except Exception:
+                self._status = (time.time(), "Error writing to %s." %
+                                os.path.basename(fpath))
+                return True
+            self._status = (time.time(), "Save complete.")
+            return False
+        # Set key order for output.
+        data = dict.fromkeys(['prefactor', 'unit', 'rate',
+                              'points', 'dropped', 'channels'])
+        data.update(data_in)
+        status = "Writing to file %s." % os.path.basename(fpath)
+        error = True
+        mode = ('x' if exclusive else 'w') + ('b' if fmt == 'binary' else '')
+        with open(fpath, mode) as fh:
+            try:
+                if fmt == 'binary':
+                    self._dump_binary(data, fh)
+                else:
+                    data['channels'] = {k: np.asarray(v).tolist()
+                                        for k, v in data['channels'].items()}
+                    json.dump(data, fh)
+                status = "Save complete."
+                error = False
+            except Exception:
+                status = "Error writing to %s." % os.path.basename(fpath)
+        self._status = (time.time(), status)
+        return error
+
+    def _dump_binary(self, data, fh, preview=None):
+        """Write data to an open file in the binary capture format.
+
+        A channel with at most 2**16 distinct values -- as for any channel
+        read from the 16-bit ADC -- is stored as a table of those values
+        and a uint16 index into it for each sample. This is exact, and a
+        quarter the size of storing float64 samples. Other channels are
+        stored as float64. A 2-d preview array, as for SessionArchive, is
+        stored as float32 after the channels.
+
+        Returns the number of bytes written."""
+        header = {k: v for k, v in data.items() if k != 'channels'}
+        arrays = []
+        layout = []
+        for name, v in data['channels'].items():
+            v = np.asarray(v, dtype=np.float64)
+            levels, codes = np.unique(v, return_inverse=True)
+            if len(levels) <= 2**16:
+                entry = {'name': name, 'encoding': 'levels',
+                         'length': len(v), 'nlevels': len(levels)}
+                arrays.extend((levels.astype('<f8'), codes.astype('<u2')))
+            else:
+                entry = {'name': name, 'encoding': 'float64',
+                         'length': len(v)}
+                arrays.append(v.astype('<f8'))
+            layout.append(entry)
+        # Offsets are relative to the start of the data section.
+        offset = 0
+        offsets = []
+        for a in arrays:
+            offsets.append(offset)
+            offset += -(-a.nbytes // self.BINARY_ALIGN) * self.BINARY_ALIGN
+        i = 0
+        for entry in layout:
+            if entry['encoding'] == 'levels':
+                entry['offsets'] = offsets[i:i + 2]
+                i += 2
+            else:
+                entry['offsets'] = offsets[i:i + 1]
+                i += 1
+        header['channels'] = layout
+        if preview is not None:
+            arrays.append(np.asarray(preview, dtype='<f4'))
+            header['preview'] = {'offset': offset,
+                                 'shape': list(arrays[-1].shape)}
+        raw_header = json.dumps(header).encode('utf-8')
+        start = len(self.BINARY_MAGIC) + 4 + len(raw_header)
+        pad = -start % self.BINARY_ALIGN
+        fh.write(self.BINARY_MAGIC)
+        fh.write(np.uint32(len(raw_header) + pad).astype('<u4').tobytes())
+        fh.write(raw_header + b' ' * pad)
+        for a in arrays:
+            fh.write(a.tobytes())
+            fh.write(b'\0' * (-a.nbytes % self.BINARY_ALIGN))
+        return start + pad + sum(-(-a.nbytes // self.BINARY_ALIGN)
+                                 * self.BINARY_ALIGN for a in arrays)
+
+    def _load_binary(self, fpath, base=0):
+        """Load a binary capture.
+
+        Channels stored as float64 are memory-mapped. Channels stored as
+        levels, as for any channel read from the ADC, are decoded into
+        float64 arrays in memory as they are loaded, reading their codes
+        through a memory map. The capture starts base bytes into the
+        file."""
+        with open(fpath, 'rb') as fh:
+            fh.seek(base + len(self.BINARY_MAGIC))
+            nheader = int(np.frombuffer(fh.read(4), dtype='<u4')[0])
+            data = json.loads(fh.read(nheader).decode('utf-8'))
+        start = base + len(self.BINARY_MAGIC) + 4 + nheader
+        layout = data['channels']
+        data['channels'] = {}
+        for entry in layout:
+            n = entry['length']
+            offsets = [start + o for o in entry['offsets']]
+            if n == 0:
+                values = np.zeros(0)
+            elif entry['encoding'] == 'levels':
+                levels = np.memmap(fpath, dtype='<f8', mode='r',
+                                   offset=offsets[0],
+                                   shape=(entry['nlevels'],))
+                codes = np.memmap(fpath, dtype='<u2', mode='r',
+                                  offset=offsets[1], shape=(n,))
+                values = np.asarray(levels)[codes]
+            else:
+                values = np.memmap(fpath, dtype='<f8', mode='r',
+                                   offset=offsets[0], shape=(n,))
+            data['channels'][entry['name']] = values
+        data.pop('preview', None)
+        return data
+
+    def set_trigger(self, trigger: Optional[Trigger]):
+        """Set a Trigger for "save all", or None to save every capture"""
+        self._trigger = trigger
+
+    def set_format(self, fmt: str):
+        """Set the format for "save all", one of EXTENSIONS"""
+        self._format = fmt
+
+    def set_save_all(self, fpath):
+        self._path = fpath
+        # Start a new archive, as for a new session.
+        self._archive = None
+        self._status = (time.time(), self._save_all_status())
+        if not os.path.exists(fpath):
+            try:
+                os.makedirs(fpath)
+            except Exception:
+                self._status = (time.time(), "Error creating folders.")
+
+    def clear_save_all(self):
+        self._path = None
+
+
+class SessionArchive():
+    # Archives start with MAGIC, padded to ALIGN bytes. Each record is a
+    # capture in the binary capture format, preceded by RECORD_MAGIC and
+    # the capture's length as a little-endian uint64, padded to ALIGN bytes.
+    MAGIC = b'LJSAARC\x01'
+    RECORD_MAGIC = b'LJSAREC\x01'
+    ALIGN = DataHandler.BINARY_ALIGN
+    # The index is kept beside the archive, as a line of JSON per capture.
+    INDEX_SUFFIX = '.idx'
+    # Preview spectra are Welch estimates with segments of this length;
+    # preview traces are the min and max of each channel in this many bins.
+    PREVIEW_NPERSEG = 1024
+    PREVIEW_BINS = 512
+    # Capture settings copied into the index.
+    INDEX_KEYS = ('rate', 'points', 'dropped', 'prefactor', 'unit')
+
+    def __init__(self, fpath: str, writable: bool = False):
+        """An append-only file of captures, indexed for review.
+
+        Each capture is stored in full with a small preview: a spectrum
+        and a min/max trace of each channel. The index gives the time,
+        settings, dropped samples and file offset of each capture, so
+        captures can be listed and previewed without reading the rest of
+        the archive, and loaded in full one at a time.
+
+        If the index is missing or behind the archive, as after a crash,
+        it is rebuilt from the records. If writable, a new archive is
+        created if needed, and a partly written record at the end is
+        discarded."""
+        self.path = fpath
+        # Index entry for each capture, in order.
+        self.index = []
+        self._writable = writable
+        # For the binary capture format.
+        self._handler = DataHandler()
+        if not os.path.exists(fpath):
+            if not writable:
+                raise FileNotFoundError(fpath)
+            with open(fpath, 'xb') as fh:
+                fh.write(self.MAGIC.ljust(self.ALIGN, b'\0'))
+            open(fpath + self.INDEX_SUFFIX, 'w').close()
+            return
+        with open(fpath, 'rb') as fh:
+            if fh.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("%s is not a session archive." % fpath)
+        self._load_index()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _load_index(self):
+        """Read the index, then add any records it is missing"""
+        try:
+            with open(self.path + self.INDEX_SUFFIX, 'r') as fh:
+                for line in fh:
+                    try:
+                        self.index.append(json.loads(line))
+                    except ValueError:
+                        # A partly written last line.
+                        break
+        except FileNotFoundError:
+            pass
+        size = os.path.getsize(self.path)
+        end = self.ALIGN
+        if self.index:
+            end = self.index[-1]['offset'] + self.index[-1]['nbytes']
+        if end > size:
+            # Index for a different or truncated archive.
+            self.index = []
+            end = self.ALIGN
+        found = []
+        with open(self.path, 'rb') as fh:
+            while end + self.ALIGN <= size:
+                fh.seek(end)
+                prefix = fh.read(self.ALIGN)
+                nbytes = int(np.frombuffer(prefix, '<u8', 1, 8)[0])
+                offset = end + self.ALIGN
+                if (prefix[:len(self.RECORD_MAGIC)] != self.RECORD_MAGIC
+                        or offset + nbytes > size):
+                    break
+                found.append(self._entry(fh, offset, nbytes))
+                end = offset + nbytes
+        self.index.extend(found)
+        if self._writable:
+            if end < size:
+                with open(self.path, 'r+b') as fh:
+                    fh.truncate(end)
+            if found or not os.path.exists(self.path + self.INDEX_SUFFIX):
+                with open(self.path + self.INDEX_SUFFIX, 'w') as fh:
+                    fh.writelines(json.dumps(e) + '\n' for e in self.index)
+
+    def _entry(self, fh, offset, nbytes):
+        """Make the index entry for a capture at offset in fh"""
+        fh.seek(offset + len(DataHandler.BINARY_MAGIC))
+        nheader = int(np.frombuffer(fh.read(4), dtype='<u4')[0])
+        header = json.loads(fh.read(nheader).decode('utf-8'))
+        entry = {'offset': offset, 'nbytes': nbytes,
+                 'time': header.get('time'),
+                 'channels': [c['name'] for c in header['channels']]}
+        entry.update((k, header.get(k)) for k in self.INDEX_KEYS)
+        entry['preview'] = {
+            'offset': (offset + len(DataHandler.BINARY_MAGIC) + 4 + nheader
+                       + header['preview']['offset']),
+            'shape': header['preview']['shape'],
+            'nperseg': header['preview_nperseg'],
+            'bins': header['preview_bins']}
+        return entry
+
+    def _make_preview(self, data):
+        """Preview spectra and min/max traces, one row per channel"""
+        channels = data['channels']
+        n = min(map(len, channels.values())) if channels else 0
+        nperseg = min(self.PREVIEW_NPERSEG, n)
+        bins = min(self.PREVIEW_BINS, n)
+        rows = []
+        if n:
+            starts = np.arange(bins) * n // bins
+            for name, v in channels.items():
+                v = np.asarray(v)[:n]
+                psd = _segment_spectra({}, name, v, nperseg,
+                                       max(1, nperseg // 2), data['rate'],
+                                       'hann').mean(axis=0)
+                rows.append(np.concatenate((
+                    psd, np.minimum.reduceat(v, starts),
+                    np.maximum.reduceat(v, starts))))
+        return np.array(rows).reshape(len(channels), -1), nperseg, bins
+
+    def append(self, data, timestamp: Optional[float] = None):
+        """Add a capture, with its preview, and index it.
+
+        The time in the index is timestamp, or the capture's end_time, or
+        now. Returns the number of bytes added."""
+        import io
+        if not self._writable:
+            raise IOError("Archive %s is not writable." % self.path)
+        if timestamp is None:
+            timestamp = data.get('end_time') or time.time()
+        preview, nperseg, bins = self._make_preview(data)
+        record = dict(data, time=timestamp, preview_nperseg=nperseg,
+                      preview_bins=bins)
+        buf = io.BytesIO()
+        nbytes = self._handler._dump_binary(record, buf, preview)
+        with open(self.path, 'ab') as fh:
+            offset = fh.tell() + self.ALIGN
+            fh.write((self.RECORD_MAGIC + np.uint64(nbytes).astype(
+                '<u8').tobytes()).ljust(self.ALIGN, b'\0'))
+            fh.write(buf.getbuffer())
+        buf.seek(0)
+        entry = self._entry(buf, 0, nbytes)
+        entry['offset'] = offset
+        entry['preview']['offset'] += offset
+        with open(self.path + self.INDEX_SUFFIX, 'a') as fh:
+            fh.write(json.dumps(entry) + '\n')
+        self.index.append(entry)
+        return self.ALIGN + nbytes
+
+    def load(self, i: int):
+        """Load capture i in full.
+
+        As for a binary file, float64 channels are memory-mapped, while
+        channels stored as levels are decoded into memory."""
+        data = self._handler._load_binary(self.path, self.index[i]['offset'])
+        for k in ('preview_nperseg', 'preview_bins'):
+            data.pop(k, None)
+        return data
+
+    def preview(self, i: int):
+        """Return the preview of capture i.
+
+        Gives 'frequencies' and 'times', and for each channel in
+        'channels', its 'psd', and its 'min' and 'max' in each bin
+        starting at those times. Values are unscaled, as the channel data:
+        scale traces by the prefactor, and spectra by its square."""
+        entry = self.index[i]
+        p = entry['preview']
+        nch, ncols = p['shape']
+        block = np.fromfile(self.path, dtype='<f4', count=nch * ncols,
+                            offset=p['offset']).reshape(nch, ncols)
+        nfreq = p['nperseg'] // 2 + 1 if p['nperseg'] else 0
+        bins = p['bins']
+        npoints = entry['points'] or 0
+        return {'frequencies': np.fft.rfftfreq(p['nperseg'],
+                                               1 / entry['rate']),
+                'times': (np.arange(bins) * npoints // max(bins, 1))
+                / entry['rate'],
+                'channels': {
+                    k: {'psd': row[:nfreq],
+                        'min': row[nfreq:nfreq + bins],
+                        'max': row[nfreq + bins:nfreq + 2 * bins]}
+                    for k, row in zip(entry['channels'], block)}}
+
+
+class FeatureExtractor():
+    # Features of each channel, followed by a power for each band and the
+    # frequency and density of each peak.
+    FEATURES = ('rms', 'peak', 'crest')
+
+    def __init__(self, bands=((0, 10), (10, 100), (100, 1000),
+                              (1000, 10000)),
+                 npeaks: int = 5, window: str = 'hann'):
+        """Reduce each capture to a few features of each channel.
+
+        Features are the rms, peak absolute value and crest factor (peak
+        over rms), the power in each (lo, hi) band in Hz, and the
+        frequency and density of the npeaks largest local maxima of the
+        power spectrum, largest first. Values are in scaled units. The
+        spectrum is that of the whole capture, computed for all channels
+        at once by the shared SpectralEngine, and each feature is computed
+        for all channels together."""
+        self.bands = [(float(lo), float(hi)) for lo, hi in bands]
+        self.npeaks = npeaks
+        self.window = window
+
+    def names(self):
+        """Return the name of each feature of a channel"""
+        names = list(self.FEATURES)
+        names += ["band_%g-%g" % b for b in self.bands]
+        for i in range(self.npeaks):
+            names += ["peak%d_freq" % i, "peak%d_psd" % i]
+        return names
+
+    def extract(self, data):
+        """Return (channel names, features), with a row of features in the
+        order given by names for each channel"""
+        names = list(data['channels'])
+        n = min(len(v) for v in data['channels'].values())
+        x = np.empty((len(names), n))
+        for i, k in enumerate(names):
+            v = data['channels'][k]
+            x[i] = v[len(v) - n:]
+        x *= data.get('prefactor', 1.)
+        rms = np.sqrt(np.einsum('ij,ij->i', x, x) / max(n, 1))
+        peak = np.abs(x).max(axis=1)
+        crest = np.divide(peak, rms, out=np.full_like(peak, np.nan),
+                          where=rms > 0)
+        freqs, psd = _engine.psd(x, data['rate'], self.window)
+        # Band powers from the cumulative spectrum, bins lo <= f < hi.
+        cum = np.zeros((len(names), len(freqs) + 1))
+        np.cumsum(psd, axis=1, out=cum[:, 1:])
+        df = freqs[1] - freqs[0] if len(freqs) > 1 else 0.
+        edges = np.searchsorted(freqs, np.ravel(self.bands) if self.bands
+                                else np.zeros(0)).reshape(-1, 2)
+        powers = (cum[:, edges[:, 1]] - cum[:, edges[:, 0]]) * df
+        # Largest interior local maxima of each spectrum.
+        inner = psd[:, 1:-1]
+        maxima = np.where((inner > psd[:, :-2]) & (inner >= psd[:, 2:]),
+                          inner, -np.inf)
+        k = min(self.npeaks, maxima.shape[1])
+        peak_f = np.full((len(names), self.npeaks), np.nan)
+        peak_p = np.full((len(names), self.npeaks), np.nan)
+        if k:
+            idx = np.argpartition(-maxima, k - 1, axis=1)[:, :k]
+            values = np.take_along_axis(maxima, idx, axis=1)
+            order = np.argsort(-values, axis=1)
+            idx = np.take_along_axis(idx, order, axis=1)
+            values = np.take_along_axis(values, order, axis=1)
+            found = np.isfinite(values)
+            peak_f[:, :k] = np.where(found, freqs[idx + 1], np.nan)
+            peak_p[:, :k] = np.where(found, values, np.nan)
+        peaks = np.stack((peak_f, peak_p), axis=2).reshape(len(names), -1)
+        return names, np.column_stack((rms, peak, crest, powers, peaks))
+
+
+class FeatureLog():
+    # Each segment has a schema file and a file per column, to which
+    # values are appended as raw little-endian arrays.
+    SCHEMA = 'features.json'
+    # Columns for each capture, before the features of each channel.
+    COLUMNS = (('time', '<f8'), ('sequence', '<i8'), ('dropped', '<i8'))
+    FEATURE_DTYPE = '<f4'
+
+    def __init__(self, path: str, extractor: Optional[FeatureExtractor] = None,
+                 maxrows: int = 64, interval: float = 10.):
+        """A columnar time series of features of each capture, in path.
+
+        Rows of features are held in a fixed buffer, then appended to the
+        column files when it has maxrows rows, or interval seconds after
+        the first row in it, so memory use is bounded however long the
+        log. Each column is named CHANNEL:FEATURE, as 'AIN0:rms', besides
+        'time' (of the last sample, or of extraction), 'sequence' and
+        'dropped'. A new segment, a folder named for the time it starts,
+        is begun for the first capture and whenever the channels, rate or
+        unit change. Read with load_features."""
+        self.path = path
+        self.extractor = extractor or FeatureExtractor()
+        self._maxrows = maxrows
+        self._interval = interval
+        os.makedirs(path, exist_ok=True)
+        # Segment folder, its settings and columns, and buffered rows.
+        self._segment = None
+        self._key = None
+        self._columns = []
+        self._buffer = None
+        self._nrows = 0
+        self._t_first = None
+        self.stats = {'rows': 0, 'bytes': 0, 'segments': 0}
+
+    def add(self, data):
+        """Extract features of a capture and add them to the log"""
+        names, features = self.extractor.extract(data)
+        key = (names, data['rate'], data.get('unit'))
+        if key != self._key:
+            self.flush()
+            self._start_segment(key, data)
+        row = self._buffer[self._nrows]
+        row[0] = data.get('end_time') or time.time()
+        row[1] = data.get('sequence', -1)
+        row[2] = data.get('dropped', 0)
+        row[len(self.COLUMNS):] = features.ravel()
+        self._nrows += 1
+        if self._t_first is None:
+            self._t_first = time.time()
+        if (self._nrows == self._maxrows
+                or time.time() - self._t_first >= self._interval):
+            self.flush()
+
+    def flush(self):
+        """Append buffered rows to the column files"""
+        if not self._nrows:
+            return
+        rows = self._buffer[:self._nrows]
+        for j, (fname, dtype) in enumerate(self._columns):
+            values = rows[:, j].astype(dtype)
+            with open(os.path.join(self._segment, fname), 'ab') as fh:
+                fh.write(values.tobytes())
+            self.stats['bytes'] += values.nbytes
+        self.stats['rows'] += self._nrows
+        self._nrows = 0
+        self._t_first = None
+
+    def _start_segment(self, key, data):
+        import datetime
+        names, rate, unit = key
+        ts = datetime.datetime.now().replace(microsecond=0).isoformat()
+        ts = ts.replace(':', '')
+        i = 0
+        while True:
+            segment = os.path.join(self.path, "{:s}_{:02d}".format(ts, i))
+            try:
+                os.mkdir(segment)
+                break
+            except FileExistsError:
+                i += 1
+        columns = [n for n, _ in self.COLUMNS]
+        dtypes = [d for _, d in self.COLUMNS]
+        for k in names:
+            columns += ["%s:%s" % (k, f) for f in self.extractor.names()]
+        dtypes += [self.FEATURE_DTYPE] * (len(columns) - len(dtypes))
+        # Channel names may hold characters not allowed in file names.
+        self._columns = [("%04d.bin" % j, d) for j, d in enumerate(dtypes)]
+        schema = {'columns': [{'name': c, 'file': f, 'dtype': d}
+                              for c, (f, d) in zip(columns, self._columns)],
+                  'channels': names, 'rate': rate, 'unit': unit,
+                  'prefactor': data.get('prefactor', 1.),
+                  'points': data['points'],
+                  'bands': self.extractor.bands,
+                  'npeaks': self.extractor.npeaks}
+        with open(os.path.join(segment, self.SCHEMA), 'w') as fh:
+            json.dump(schema, fh)
+        self._segment = segment
+        self._key = key
+        self._buffer = np.empty((self._maxrows, len(columns)))
+        self.stats['segments'] += 1
+
+
+def load_features(path: str, columns: Optional[List[str]] = None,
+                  start: Optional[float] = None,
+                  stop: Optional[float] = None):
+    """Return columns of a FeatureLog as a dict of arrays.
+
+    Gives the given columns, or all of them, for rows with start <= time
+    < stop, over all segments in time order; a column is NaN in rows from
+    segments without it. Only the rows and columns asked for are read."""
+    segments = []
+    for name in sorted(os.listdir(path)):
+        fpath = os.path.join(path, name, FeatureLog.SCHEMA)
+        if os.path.exists(fpath):
+            with open(fpath) as fh:
+                segments.append((os.path.join(path, name), json.load(fh)))
+    if columns is None:
+        columns = list(OrderedDict(
+            (c['name'], None) for _, s in segments for c in s['columns']))
+    parts = {c: [] for c in columns}
+    for segment, schema in segments:
+        entries = {c['name']: c for c in schema['columns']}
+        # A row is complete once all its columns are written.
+        nrows = min(os.path.getsize(os.path.join(segment, c['file']))
+                    // np.dtype(c['dtype']).itemsize
+                    for c in schema['columns'])
+        times = np.fromfile(os.path.join(segment, entries['time']['file']),
+                            dtype='<f8', count=nrows)
+        lo = 0 if start is None else int(np.searchsorted(times, start))
+        hi = nrows if stop is None else int(np.searchsorted(times, stop))
+        hi = max(lo, hi)
+        for c in columns:
+            entry = entries.get(c)
+            if entry is None:
+                parts[c].append(np.full(hi - lo, np.nan))
+                continue
+            dtype = np.dtype(entry['dtype'])
+            parts[c].append(np.fromfile(
+                os.path.join(segment, entry['file']), dtype=dtype,
+                count=hi - lo, offset=lo * dtype.itemsize))
+    return {c: np.concatenate(p) if p else np.zeros(0)
+            for c, p in parts.items()}
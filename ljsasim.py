@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""LabJackSpectrumAnalyzer simulated device
+
+A stand-in for a LabJack U6 that produces raw stream packets from synthetic
+signals, for development, testing and benchmarking without hardware.
+
+Copyright (C) 2019 Mick Phillips <mick.phillips@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import time
+
+import numpy as np
+
+from typing import List, Optional, Tuple
+
+
+class SimulatedU6():
+    # Nominal U6 calibration for each gain index: positive slope, negative
+    # slope and center, as in LabJackPython's u6.CalibrationInfo.
+    AIN_SLOPE = [3.1580578e-4, 3.1580578e-5, 3.1580578e-6, 3.1580578e-7]
+    AIN_NEG_SLOPE = [-3.158058e-4, -3.158058e-5, -3.158058e-6, -3.158058e-7]
+    AIN_CENTER = [33523.0] * 4
+    # LabJack stream error codes.
+    STREAM_OVERFLOW = 59
+    STREAM_BUFFER_FULL = 60
+
+    def __init__(self, signals: Optional[List[Tuple[float, float]]] = None,
+                 noise: float = 0.01, realtime: bool = True,
+                 overflow_rate: float = 0., error_rate: float = 0.,
+                 empty_rate: float = 0., fail_after: Optional[int] = None,
+                 seed: Optional[int] = None):
+        """Simulated U6 with the streaming interface used by StreamReader.
+
+        Each channel carries the sum of sine waves given as (frequency,
+        amplitude) in signals, with a phase offset per channel, plus
+        Gaussian noise of the given rms. The voltages are quantized and
+        packed into stream packets using the nominal calibration.
+
+        With realtime True, streamData waits until each read would be
+        available from hardware, and reports a backlog in each packet if
+        the reader has fallen behind; otherwise, reads return immediately.
+
+        Faults are injected at random into a fraction of reads: overflow
+        (samples lost on the device, reported with error 60 and a missed
+        count), packet errors (error 59) and empty reads (None). If
+        fail_after is set, streamData raises IOError after that many
+        reads."""
+        if signals is None:
+            signals = [(125., 1.)]
+        self.signals = signals
+        self.noise = noise
+        self.realtime = realtime
+        self.overflow_rate = overflow_rate
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.fail_after = fail_after
+        self._rng = np.random.default_rng(seed)
+        self.streamSamplesPerPacket = 25
+        self.packetsPerRequest = 1
+        self.streamChannelNumbers = [0]
+        self.streamChannelOptions = [0]
+        self.streamStarted = False
+        self.scanRate = 0.
+        # Samples generated since the stream started, including lost ones.
+        self._samples = 0
+        self._t_start = None
+        self._packet_counter = 0
+        self._reads = 0
+
+    def close(self):
+        self.streamStarted = False
+
+    def getCalibratedSlopesCenter(self, gainIndex, resolutionIndex):
+        return (self.AIN_NEG_SLOPE[gainIndex], self.AIN_SLOPE[gainIndex],
+                self.AIN_CENTER[gainIndex])
+
+    def streamConfig(self, NumChannels=1, ResolutionIndex=0,
+                     SamplesPerPacket=25, ChannelNumbers=[0],
+                     ChannelOptions=[0], ScanFrequency=None, **kwargs):
+        """Configure streaming, as U6.streamConfig"""
+        if NumChannels != len(ChannelNumbers) or \
+                NumChannels != len(ChannelOptions):
+            raise ValueError("NumChannels must match length of "
+                             "ChannelNumbers and ChannelOptions")
+        if ScanFrequency is None:
+            raise ValueError("ScanFrequency must be set.")
+        if ScanFrequency < 25:
+            SamplesPerPacket = ScanFrequency
+        self.streamSamplesPerPacket = min(max(int(SamplesPerPacket), 1), 25)
+        self.streamChannelNumbers = list(ChannelNumbers)
+        self.streamChannelOptions = list(ChannelOptions)
+        self.scanRate = float(ScanFrequency)
+        # As U6.streamConfig: about 1 s of packets per read, up to 48.
+        self.packetsPerRequest = min(
+            max(1, int(ScanFrequency / self.streamSamplesPerPacket)), 48)
+
+    def streamStart(self):
+        if self.streamStarted:
+            raise IOError("Stream already started.")
+        self.streamStarted = True
+        self._samples = 0
+        self._t_start = time.time()
+
+    def streamStop(self):
+        self.streamStarted = False
+
+    def _counts(self, index):
+        """16-bit counts for samples at the given positions in the stream"""
+        nch = len(self.streamChannelNumbers)
+        scan, entry = np.divmod(index, nch)
+        t = scan / self.scanRate
+        volts = self.noise * self._rng.standard_normal(len(index))
+        for f, a in self.signals:
+            volts += a * np.sin(2 * np.pi * f * t + entry * np.pi / 4)
+        # Quantize with the calibration for each entry's gain.
+        cal = np.array([self.getCalibratedSlopesCenter((opt >> 4) & 0x3, 1)
+                        for opt in self.streamChannelOptions])
+        neg, pos, center = cal[entry].T
+        counts = np.where(volts < 0, center - volts / neg,
+                          center + volts / pos)
+        return np.clip(np.round(counts), 0, 0xFFFF).astype('<u2')
+
+    def streamData(self, convert=False):
+        """Yield raw stream reads, as U6.streamData(convert=False)"""
+        if not self.streamStarted:
+            raise IOError("Stream has not been started.")
+        spp = self.streamSamplesPerPacket
+        nch = len(self.streamChannelNumbers)
+        packet_words = 7 + spp
+        while True:
+            self._reads += 1
+            if self.fail_after is not None and self._reads > self.fail_after:
+                raise IOError("Simulated device failure.")
+            npackets = self.packetsPerRequest
+            nsamples = npackets * spp
+            # Packets need not end on a scan boundary, but samples are lost
+            # in whole scans.
+            first_sample = self._samples
+            missed = 0
+            if self._rng.random() < self.overflow_rate:
+                missed = nch * int(self._rng.integers(1, 4 * nsamples // nch
+                                                      + 2))
+            backlog = 0
+            if self.realtime:
+                due = self._t_start + (first_sample + missed + nsamples) / (
+                    self.scanRate * nch)
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Data waiting on the device, in units of 256 bytes.
+                    backlog = min(255, int(-delay * self.scanRate * nch / 128))
+            if self._rng.random() < self.empty_rate:
+                yield None
+                continue
+            # Overflowed samples are lost before this read's data.
+            first_sample += missed
+            counts = self._counts(first_sample + np.arange(nsamples))
+            self._samples = first_sample + nsamples
+            packets = np.zeros((npackets, packet_words), dtype='<u2')
+            packets[:, 6:6 + spp] = counts.reshape(npackets, spp)
+            raw = packets.view(np.uint8)
+            raw[:, 10] = (self._packet_counter
+                          + np.arange(npackets)) % 256
+            raw[:, -2] = backlog
+            self._packet_counter += npackets
+            errors = 0
+            if missed:
+                raw[0, 11] = self.STREAM_BUFFER_FULL
+                raw[0, 6:10] = np.frombuffer(
+                    np.uint32(missed).astype('<u4').tobytes(), np.uint8)
+                errors += 1
+            if self._rng.random() < self.error_rate:
+                raw[-1, 11] = self.STREAM_OVERFLOW
+                errors += 1
+            yield dict(numPackets=npackets, result=raw.tobytes(),
+                       errors=errors, missed=missed,
+                       firstPacket=int(raw[0, 10]))
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+from scipy.signal import welch
+
+import ljsabatch
+from ljsacore import DataHandler, SessionArchive
+
+
+def make_capture(seed, npoints=2048):
+    rng = np.random.default_rng(seed)
+    return {'prefactor': 2.0, 'unit': 'V', 'rate': 1000, 'points': npoints,
+            'dropped': 0, 'end_time': 1000. + seed,
+            'channels': {'AIN0': rng.standard_normal(npoints) * (1 + seed)}}
+
+
+def run(folder, capsys):
+    """Run ljsabatch over folder, returning (found, to process) and the
+    records it saved"""
+    assert ljsabatch.main([folder, '--nperseg', '256', '--workers', '1',
+                           '--bands', '0:100', '100:500']) == 0
+    line = capsys.readouterr().out.splitlines()[0]
+    found, todo = (int(w) for w in line.replace(',', '').split()
+                   if w.isdigit())
+    output = os.path.join(folder, 'ljsabatch.npz')
+    return (found, todo), ljsabatch.load_results(output)[1]
+
+
+def test_batch_processes_new_and_changed_captures(tmp_path, capsys):
+    folder = str(tmp_path)
+    handler = DataHandler()
+    captures = [make_capture(i) for i in range(4)]
+    os.mkdir(os.path.join(folder, 'sub'))
+    for i in (0, 1):
+        handler.save_one(os.path.join(folder, 'sub', '%d.ljsa' % i),
+                         captures[i])
+    archive = SessionArchive(os.path.join(folder, 'session.ljsarc'),
+                             writable=True)
+    for data in captures[2:]:
+        archive.append(data)
+    names = [os.path.join('sub', '0.ljsa'), os.path.join('sub', '1.ljsa'),
+             'session.ljsarc#0', 'session.ljsarc#1']
+    counts, records = run(folder, capsys)
+    assert counts == (4, 4)
+    assert sorted(records) == sorted(names)
+    # Each capture of the archive is analysed as ARCHIVE#N.
+    for name, data in zip(names, captures):
+        f, psd = welch(2.0 * data['channels']['AIN0'], fs=1000.,
+                       window='hann', nperseg=256)
+        assert np.allclose(records[name]['channels']['AIN0']['psd'], psd,
+                           rtol=1e-5)
+    assert ljsabatch.load_capture(
+        os.path.join(folder, 'session.ljsarc#1'))['end_time'] == 1003.
+    # Nothing has changed, so nothing is processed again.
+    counts, again = run(folder, capsys)
+    assert counts == (4, 0)
+    assert sorted(again) == sorted(records)
+    # Only a file modified since is.
+    path = os.path.join(folder, names[1])
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    counts, again = run(folder, capsys)
+    assert counts == (4, 1)
+    assert again[names[1]]['mtime'] == st.st_mtime_ns + 10 ** 9
+    assert again[names[0]]['mtime'] == records[names[0]]['mtime']
+    # A capture added to the archive is new.
+    archive.append(make_capture(4))
+    counts, again = run(folder, capsys)
+    assert counts == (5, 1)
+    assert 'session.ljsarc#2' in again
@@ -0,0 +1,67 @@
+import numpy as np
+from scipy import signal
+
+from ljsacore import CrossSpectrum
+
+RATE = 1000.
+NPERSEG = 256
+
+
+def make_signals(n=20000):
+    """A reference, and a filtered copy of it plus noise"""
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal(n)
+    b, a = signal.butter(2, 0.2)
+    y = signal.lfilter(b, a, x) + 0.1 * rng.standard_normal(n)
+    return x, y
+
+
+def welch_kwargs():
+    return dict(fs=RATE, window='hann', nperseg=NPERSEG,
+                noverlap=NPERSEG // 2)
+
+
+def test_estimates_match_scipy():
+    x, y = make_signals()
+    cross = CrossSpectrum(RATE, NPERSEG)
+    cross.add(['x', 'y'], np.stack((x, y)))
+    est = cross.estimates('x')
+    f, coh = signal.coherence(x, y, **welch_kwargs())
+    assert np.allclose(cross.freqs, f)
+    assert np.allclose(est['coherence']['y'], coh)
+    _, pxx = signal.welch(x, **welch_kwargs())
+    _, pyy = signal.welch(y, **welch_kwargs())
+    _, pxy = signal.csd(x, y, **welch_kwargs())
+    _, pyx = signal.csd(y, x, **welch_kwargs())
+    assert np.allclose(est['H1']['y'], pxy / pxx)
+    assert np.allclose(est['H2']['y'], pyy / pyx)
+    assert 'x' not in est['coherence']
+
+
+def test_incremental_matches_one_call():
+    x, y = make_signals()
+    whole = CrossSpectrum(RATE, NPERSEG)
+    whole.add(['x', 'y'], np.stack((x, y)))
+    parts = CrossSpectrum(RATE, NPERSEG)
+    for i in range(0, len(x), 777):
+        parts.add(['x', 'y'], np.stack((x[i:i + 777], y[i:i + 777])))
+    assert parts.count() == whole.count()
+    a, b = parts.estimates(), whole.estimates()
+    for mode in CrossSpectrum.MODES:
+        assert np.allclose(a[mode]['y'], b[mode]['y'])
+
+
+def test_reset_on_new_channels_or_gap():
+    x, y = make_signals(4 * NPERSEG)
+    cross = CrossSpectrum(RATE, NPERSEG)
+    cross.add(['x', 'y'], np.stack((x, y)))
+    assert cross.count() == 7
+    cross.add(['y', 'x'], np.stack((y, x)))
+    assert cross.count() == 7
+    # Not contiguous: the tail of the last call is not used.
+    cross.add(['y', 'x'], np.stack((y[:NPERSEG], x[:NPERSEG])),
+              contiguous=False)
+    assert cross.count() == 8
+    assert cross.estimates() is not None
+    cross.reset()
+    assert cross.count() == 0 and cross.estimates() is None
@@ -0,0 +1,67 @@
+import collections
+
+import numpy as np
+import pytest
+
+from ljsacore import StreamDecoder
+
+u6 = pytest.importorskip('u6')
+
+SAMPLES_PER_PACKET = 25
+PACKET_SIZE = 14 + 2 * SAMPLES_PER_PACKET
+
+
+def make_device(channels, options=None):
+    """An unopened U6 with stream settings as left by streamConfig"""
+    dev = u6.U6(autoOpen=False)
+    dev.streamSamplesPerPacket = SAMPLES_PER_PACKET
+    dev.streamChannelNumbers = channels
+    dev.streamChannelOptions = options or [0] * len(channels)
+    # As streamConfig: channels appearing more than once in the scan list.
+    dev.streamChannelDuplicates = collections.Counter(
+        {k: n for k, n in collections.Counter(channels).items() if n > 1})
+    dev.streamPacketOffset = 0
+    return dev
+
+
+def make_results(npackets, packets_per_read, seed=0):
+    rng = np.random.default_rng(seed)
+    packets = np.zeros((npackets, PACKET_SIZE // 2), dtype='<u2')
+    packets[:, 6:6 + SAMPLES_PER_PACKET] = rng.integers(
+        0, 2**16, (npackets, SAMPLES_PER_PACKET))
+    raw = packets.tobytes()
+    size = PACKET_SIZE * packets_per_read
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def expected(dev, results):
+    data = {}
+    for result in results:
+        for k, v in dev.processStreamData(result).items():
+            data.setdefault(k, []).extend(v)
+    return data
+
+
+@pytest.mark.parametrize('channels', [[0], [0, 1, 2], [3, 1], [0, 1, 0]])
+def test_decode_matches_processStreamData(channels):
+    # Reads of 7 packets do not end on a scan boundary for most of these.
+    results = make_results(48, 7)
+    want = expected(make_device(channels), results)
+    decoder = StreamDecoder(make_device(channels))
+    got = {}
+    for result in results:
+        for k, v in decoder.decode(result).items():
+            got.setdefault(k, []).append(v)
+    assert got.keys() == want.keys()
+    for k in want:
+        assert np.array_equal(np.concatenate(got[k]), want[k]), k
+
+
+def test_decode_gains():
+    # Gain index in bits 4-5 of the channel options.
+    channels, options = [0, 1], [0x00, 0x30]
+    results = make_results(10, 10)
+    want = expected(make_device(channels, options), results)
+    got = StreamDecoder(make_device(channels, options)).decode(results)
+    for k in want:
+        assert np.array_equal(got[k], want[k]), k
@@ -0,0 +1,50 @@
+import numpy as np
+
+from ljsacore import FeatureExtractor, FeatureLog, load_features
+
+# Time of the first capture.
+T0 = 1000.
+
+
+def make_capture(t, channels=('AIN0', 'AIN1'), rate=1000, amplitude=1.):
+    n = 1000
+    x = amplitude * np.sin(2 * np.pi * 50 * np.arange(n) / rate)
+    return {'rate': rate, 'points': n, 'dropped': 0, 'sequence': int(t),
+            'end_time': T0 + t, 'prefactor': 1.0, 'unit': 'V',
+            'channels': {k: x for k in channels}}
+
+
+def make_log(path):
+    log = FeatureLog(str(path), FeatureExtractor(npeaks=2), maxrows=4)
+    for t in range(10):
+        log.add(make_capture(t, amplitude=t + 1))
+    # A new segment, for new channels.
+    for t in range(10, 15):
+        log.add(make_capture(t, channels=('AIN0',)))
+    log.flush()
+    return log
+
+
+def test_time_slicing(tmp_path):
+    log = make_log(tmp_path)
+    assert log.stats['rows'] == 15 and log.stats['segments'] == 2
+    everything = load_features(str(tmp_path))
+    assert np.array_equal(everything['time'], T0 + np.arange(15.))
+    part = load_features(str(tmp_path), start=T0 + 3, stop=T0 + 12)
+    assert np.array_equal(part['time'], T0 + np.arange(3., 12.))
+    assert np.array_equal(part['sequence'], np.arange(3, 12))
+    # Within one segment, and none at all.
+    within = load_features(str(tmp_path), start=T0 + 4.5, stop=T0 + 7)
+    assert np.array_equal(within['time'], [T0 + 5, T0 + 6])
+    assert len(load_features(str(tmp_path), start=T0 + 20)['time']) == 0
+
+
+def test_columns(tmp_path):
+    make_log(tmp_path)
+    data = load_features(str(tmp_path), columns=['time', 'AIN1:rms'],
+                         start=T0 + 8, stop=T0 + 12)
+    assert list(data) == ['time', 'AIN1:rms']
+    # rms of a sine of amplitude t + 1, then NaN without AIN1.
+    assert np.allclose(data['AIN1:rms'][:2], np.array([9, 10]) / np.sqrt(2),
+                       rtol=1e-3)
+    assert np.isnan(data['AIN1:rms'][2:]).all()
@@ -0,0 +1,91 @@
+import socket
+import threading
+import time
+
+import numpy as np
+
+from ljsacore import FramePublisher, subscribe
+
+
+def make_frame(i, npoints=1000):
+    rng = np.random.default_rng(i)
+    freqs = np.linspace(0, 500, npoints // 2 + 1)
+    return {'sequence': i, 'rate': 1000, 'points': npoints, 'new': npoints,
+            'dropped': 0, 'prefactor': 0.5, 'unit': 'V',
+            'channels': {'AIN0': rng.standard_normal(npoints),
+                         'AIN1': rng.integers(0, 9, npoints)},
+            'spectra': {'AIN0': (freqs, rng.random(len(freqs))),
+                        'AIN1': (freqs, rng.random(len(freqs)))}}
+
+
+def wait_for(condition, timeout=5.):
+    t_end = time.time() + timeout
+    while not condition():
+        assert time.time() < t_end
+        time.sleep(0.01)
+
+
+def test_frames_arrive_intact(tmp_path):
+    path = str(tmp_path / 'frames.sock')
+    publisher = FramePublisher(path, maxqueue=20)
+    received = []
+    thread = threading.Thread(
+        target=lambda: received.extend(subscribe(path)))
+    thread.start()
+    wait_for(lambda: publisher.subscribers == 1)
+    frames = [make_frame(i) for i in range(20)]
+    # A read-only view into a buffer that is then reused is sent as it
+    # was when published.
+    buffer = np.arange(2000.)
+    view = buffer[1000:]
+    view.flags.writeable = False
+    frames[0]['channels']['AIN0'] = view
+    expected = view.copy()
+    for frame in frames:
+        publisher.publish(frame)
+    buffer[:] = -1
+    wait_for(lambda: publisher.stats['sent'] == 20)
+    publisher.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert publisher.stats == {'published': 20, 'sent': 20, 'dropped': 0}
+    assert len(received) == 20
+    frames[0]['channels']['AIN0'] = expected
+    for frame, got in zip(frames, received):
+        for k in ('sequence', 'rate', 'points', 'prefactor', 'unit'):
+            assert got[k] == frame[k]
+        assert list(got['channels']) == ['AIN0', 'AIN1']
+        for k, v in frame['channels'].items():
+            assert got['channels'][k].dtype == v.dtype
+            assert np.array_equal(got['channels'][k], v)
+        for k, (f, p) in frame['spectra'].items():
+            assert np.array_equal(got['spectra'][k][0], f)
+            assert np.array_equal(got['spectra'][k][1], p)
+
+
+def test_stalled_subscriber_drops_and_stop_is_prompt(tmp_path):
+    path = str(tmp_path / 'frames.sock')
+    publisher = FramePublisher(path, maxqueue=2)
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(path)
+    try:
+        wait_for(lambda: publisher.subscribers == 1)
+        # Frames of 1.6 MB soon fill the socket buffers of a subscriber
+        # that never reads, then its queue.
+        frame = make_frame(0, npoints=100000)
+        t_end = time.time() + 5
+        while not publisher.stats['dropped'] and time.time() < t_end:
+            publisher.publish(frame)
+            time.sleep(0.01)
+        assert publisher.stats['dropped'] > 0
+        assert publisher.stats['sent'] < publisher.stats['published']
+        # Publishing never waits for the subscriber.
+        t0 = time.perf_counter()
+        for i in range(10):
+            publisher.publish(frame)
+        assert time.perf_counter() - t0 < 0.5
+        t0 = time.perf_counter()
+        publisher.stop()
+        assert time.perf_counter() - t0 < 1
+    finally:
+        sock.close()
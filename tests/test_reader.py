@@ -0,0 +1,261 @@
+import time
+
+import numpy as np
+
+from ljsacore import MultiStreamReader, RingBuffer, StreamReader, metrics
+from ljsasim import SimulatedU6
+
+
+def make_reader(**kwargs):
+    reader = StreamReader(lambda: SimulatedU6(seed=0, **kwargs))
+    reader.set_channels([0])
+    reader.set_sampling(rate=5000, time=0.1, overlap=0.5)
+    return reader
+
+
+def next_frame(source, accept=lambda data: True, timeout=5.):
+    """Return the next fetched frame that accept allows"""
+    t_end = time.time() + timeout
+    while time.time() < t_end:
+        data = source.fetch_data()
+        if data and accept(data):
+            return data
+    raise AssertionError("No frame: %s" % source.get_status())
+
+
+
+def test_ring_buffer_wraps_around():
+    buf = RingBuffer(2, 8)
+    buf.write(0, np.arange(5.))
+    assert list(buf.latest(0)) == [0, 1, 2, 3, 4]
+    assert len(buf.latest(1)) == 0
+    # This write wraps: the latest samples are still one contiguous view.
+    buf.write(0, np.arange(5., 11.))
+    view = buf.latest(0)
+    assert list(view) == list(range(3, 11))
+    assert view.base is not None and not view.flags.writeable
+    assert list(buf.latest(0, 3)) == [8, 9, 10]
+    assert list(buf.latest(0, 20)) == list(range(3, 11))
+    # A write longer than the buffer keeps only its end.
+    buf.write(0, np.arange(11., 31.))
+    assert list(buf.latest(0)) == list(range(23, 31))
+    assert buf.written(0) == 31 and buf.written(1) == 0
+    for start in range(31, 100, 3):
+        buf.write(0, np.arange(start, start + 3.))
+        assert list(buf.latest(0)) == list(range(start - 5, start + 3))
+    buf.clear()
+    assert len(buf.latest(0)) == 0
+
+
+def record_stream(reader, nrecords=200):
+    """Record each read and each window the reader publishes, along with
+    the samples per channel stored at the time"""
+    reads = []
+    windows = []
+    store, publish = reader._store, reader._publish_window
+
+    def record_store(raw):
+        reads.append(raw['missed'])
+        return store(raw)
+
+    def record_publish(rate, nwindow, dropped, stats):
+        if len(windows) < nrecords:
+            windows.append(dict(
+                stats, nwindow=nwindow, dropped=dropped,
+                written=reader.buffer.written(0), reads=list(reads),
+                samples=np.array(reader.buffer.latest(0, nwindow))))
+        publish(rate, nwindow, dropped, stats)
+
+    reader._store = record_store
+    reader._publish_window = record_publish
+    return windows
+
+
+def test_continuous_accounting_with_overflow():
+    reader = make_reader(realtime=False, overflow_rate=0.3)
+    reader.set_sampling(rate=5000, time=0.5, overlap=0.5)
+    windows = record_stream(reader)
+    fetched = []
+    assert reader.start_acquisition(continuous=True)
+    try:
+        t_end = time.time() + 10
+        while len(windows) < 200 and time.time() < t_end:
+            data = reader.fetch_data()
+            if 'sequence' in data:
+                fetched.append(data)
+            if 50 <= len(windows) < 100:
+                # A slow consumer: windows are replaced before fetched.
+                time.sleep(0.01)
+    finally:
+        reader.stop_acquisition()
+    reader._acq_thread.join(2)
+    assert len(windows) == 200 and fetched
+    nwindow, hop = 2500, 1250
+    previous = None
+    for i, w in enumerate(windows, 1):
+        assert w['sequence'] == i
+        # Reads that lost samples on the device, and the samples lost
+        # since the last window.
+        missed = w['reads']
+        assert w['gaps'] == sum(1 for m in missed if m)
+        last = previous['reads'] if previous else []
+        assert w['dropped'] == sum(missed) - sum(last)
+        assert np.isclose(w['duty'],
+                          w['written'] / (w['written'] + sum(missed)))
+        if previous is None:
+            assert w['new'] == min(w['written'], nwindow)
+        else:
+            # Windows together cover every sample once.
+            assert w['new'] == w['written'] - previous['written']
+            assert w['nwindow'] == max(nwindow, w['new'])
+            old = w['samples'][:-w['new']]
+            assert np.array_equal(old, previous['samples'][len(
+                previous['samples']) - len(old):])
+        previous = w
+    assert windows[-1]['gaps'] > 0
+    # Windows end on read boundaries, but keep to the hop on average.
+    advance = (windows[-1]['written'] - windows[0]['written']) / 199
+    assert abs(advance - hop) < 1200 / 199 + 1
+    # Every window is either fetched or replaced by the next, not counted
+    # until then.
+    for k, data in enumerate(fetched, 1):
+        assert data['points'] == max(nwindow, data['new'])
+        assert (data['sequence'] - k - 1 <= data['skipped']
+                <= data['sequence'] - k)
+    assert fetched[-1]['skipped'] > 0
+
+
+def test_settings_apply_at_once_when_stopped():
+    reader = make_reader()
+    reader.set_channels([1, 2])
+    reader.set_sampling(rate=2000, time=0.5, overlap=2.)
+    assert reader._channels == [1, 2]
+    assert (reader._rate, reader._t_integrate, reader._overlap) == (
+        2000, 0.5, 0.95)
+
+
+def test_reconfigure_while_streaming():
+    reader = make_reader()
+    assert reader.start_acquisition(continuous=True)
+    try:
+        first = next_frame(reader)
+        assert list(first['channels']) == ['AIN0'] and first['rate'] == 5000
+        thread = reader._acq_thread
+        count = metrics.snapshot()['histograms'].get(
+            'reconfigure_ms', {}).get('count', 0)
+        t0 = time.perf_counter()
+        reader.set_channels([0, 1])
+        reader.set_sampling(rate=2000)
+        # Requests are queued, not applied by stopping the thread.
+        assert time.perf_counter() - t0 < 0.05
+        data = next_frame(reader)
+        # No frame from before the change is delivered after it.
+        assert list(data['channels']) == ['AIN0', 'AIN1']
+        assert data['rate'] == 2000 and data['points'] >= 200
+        # Numbering restarts, so the frame is not contiguous with the last.
+        assert data['sequence'] == 1
+        assert reader._acq_thread is thread and reader.is_running()
+        assert reader.reconfigure_latency is not None
+        assert metrics.snapshot()['histograms']['reconfigure_ms'][
+            'count'] == count + 1
+    finally:
+        reader.stop_acquisition()
+    # The thread ends after its current read.
+    reader._acq_thread.join(2)
+    assert not reader.is_running()
+
+
+def test_idle_without_channels():
+    reader = make_reader()
+    assert reader.start_acquisition(continuous=True)
+    try:
+        next_frame(reader)
+        reader.set_channels([])
+        time.sleep(0.3)
+        # The thread waits for usable settings, rather than exiting.
+        assert reader.is_running()
+        assert reader.get_status() == "No channels selected."
+        reader.set_channels([3])
+        data = next_frame(reader)
+        assert list(data['channels']) == ['AIN3']
+    finally:
+        reader.stop_acquisition()
+
+
+def test_reconfigure_single_acquisition():
+    reader = make_reader()
+    reader.set_sampling(time=1.)
+    assert reader.start_acquisition(continuous=False)
+    try:
+        time.sleep(0.2)
+        # Part way through: the partial capture is discarded.
+        reader.set_channels([0, 1])
+        reader.set_sampling(time=0.2)
+        data = next_frame(reader)
+        assert list(data['channels']) == ['AIN0', 'AIN1']
+        assert data['points'] < 5000
+    finally:
+        reader.stop_acquisition()
+
+
+def test_multi_reconfigure():
+    source = MultiStreamReader(
+        [lambda: SimulatedU6(seed=1), lambda: SimulatedU6(seed=2)],
+        ['A', 'B'])
+    source.set_channels([[0], []])
+    source.set_sampling(rate=5000, time=0.2, overlap=0.5)
+    assert source.start_acquisition(continuous=True)
+    try:
+        last = next_frame(source)
+        assert list(last['channels']) == ['A/AIN0']
+        # A device newly given channels starts along with the other.
+        source.set_channels([[0], [0, 1]])
+        data = next_frame(source)
+        assert list(data['channels']) == ['A/AIN0', 'B/AIN0', 'B/AIN1']
+        assert data['sequence'] > last['sequence'] + 1
+        assert source.is_running()
+        # Both devices restart, and nothing at the old rate is combined.
+        source.set_sampling(rate=2000)
+        data = next_frame(source)
+        assert data['rate'] == 2000
+        assert all(r.reconfigure_latency is not None
+                   for r in source.readers)
+    finally:
+        source.stop_acquisition()
+
+
+def test_multi_aligns_devices_and_counts_drops():
+    # A slow signal, so that device start skew barely changes it.
+    source = MultiStreamReader(
+        [lambda: SimulatedU6(signals=[(1., 1.)], seed=1),
+         lambda: SimulatedU6(signals=[(1., 1.)], overflow_rate=0.1,
+                             seed=2)],
+        ['A', 'B'])
+    source.set_channels([[0], [0, 1]])
+    source.set_sampling(rate=2000, time=0.5, overlap=0.5)
+    assert source.start_acquisition(continuous=True)
+    try:
+        frames = [next_frame(source) for i in range(15)]
+    finally:
+        source.stop_acquisition()
+    aligned = 0
+    previous = None
+    for data in frames:
+        channels = data['channels']
+        assert list(channels) == ['A/AIN0', 'B/AIN0', 'B/AIN1']
+        assert all(len(v) == data['points'] for v in channels.values())
+        devices = data['devices']
+        assert devices['A']['dropped'] == 0 and devices['A']['gaps'] == 0
+        assert data['dropped'] == devices['B']['dropped']
+        # The same signal on both devices matches wherever no samples
+        # were lost within the window.
+        if (previous is not None and not previous['dropped']
+                and not data['dropped']
+                and data['sequence'] == previous['sequence'] + 1):
+            diff = channels['A/AIN0'] - channels['B/AIN0']
+            assert np.abs(diff).max() < 0.12
+            aligned += 1
+        previous = data
+    assert aligned
+    assert sum(data['dropped'] for data in frames) > 0
+    assert frames[-1]['devices']['B']['gaps'] > 0
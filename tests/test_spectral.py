@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+from ljsacore import (SpectralEngine, SpectrumAverager, SpectrumProcessor,
+                      ZoomSpectrum)
+
+
+@pytest.mark.parametrize('npoints', [4096, 1001])
+def test_psd_matches_periodogram(npoints):
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((3, npoints)) + 0.5
+    engine = SpectralEngine()
+    freqs, psd = engine.psd(x, 1000., scale=0.25)
+    f, p = signal.periodogram(x, fs=1000., window='hann', axis=-1)
+    assert np.allclose(freqs, f)
+    assert np.allclose(psd, 0.25 * p)
+
+
+def test_psd_single_row_and_sequence():
+    rng = np.random.default_rng(1)
+    rows = [rng.standard_normal(512) for i in range(2)]
+    engine = SpectralEngine()
+    f, p = signal.periodogram(rows[0], fs=200., window='hann')
+    freqs, psd = engine.psd(rows[0], 200.)
+    assert psd.shape == p.shape and np.allclose(psd, p)
+    freqs, psd = engine.psd(rows, 200.)
+    assert np.allclose(psd[1], signal.periodogram(rows[1], fs=200.,
+                                                  window='hann')[1])
+
+
+def test_plans_are_cached_and_bounded():
+    engine = SpectralEngine()
+    plan = engine.plan(256, 100.)
+    assert engine.plan(256, 100.) is plan
+    for n in range(SpectralEngine.MAXPLANS):
+        engine.plan(300 + n, 100.)
+    assert engine.plan(256, 100.) is not plan
+
+
+
+def feed_in_chunks(averager, x, seed=3):
+    """Add x to averager in contiguous chunks of random length"""
+    rng = np.random.default_rng(seed)
+    start = 0
+    while start < len(x):
+        stop = start + int(rng.integers(1, 3000))
+        averager.add('AIN0', x[start:stop])
+        start = stop
+
+
+def test_averager_matches_welch():
+    rng = np.random.default_rng(4)
+    x = rng.standard_normal(20000) + np.sin(np.arange(20000) * 0.3)
+    averager = SpectrumAverager(1000., nperseg=1024, navg=1000)
+    feed_in_chunks(averager, x)
+    f, p = signal.welch(x, fs=1000., window='hann', nperseg=1024,
+                        noverlap=512)
+    assert averager.count('AIN0') == (len(x) - 1024) // 512 + 1
+    for mode in ('linear', 'exponential'):
+        # Fewer segments than navg: the exponential average is linear.
+        freqs, psd = averager.spectrum('AIN0', mode)
+        assert np.allclose(freqs, f)
+        assert np.allclose(psd, p)
+
+
+def test_averager_exponential_weights_recent_segments():
+    rng = np.random.default_rng(5)
+    x = rng.standard_normal(20000) * np.linspace(0.5, 2, 20000)
+    averager = SpectrumAverager(1000., nperseg=1024, navg=4)
+    feed_in_chunks(averager, x)
+    # The periodograms of the same segments, averaged by hand.
+    f, t, segments = signal.spectrogram(x, fs=1000., window='hann',
+                                        nperseg=1024, noverlap=512,
+                                        mode='psd')
+    expected = np.zeros(len(f))
+    for count, p in enumerate(segments.T, 1):
+        expected += (p - expected) / min(count, 4)
+    freqs, psd = averager.spectrum('AIN0', 'exponential')
+    assert np.allclose(psd, expected)
+    assert not np.allclose(psd, averager.spectrum('AIN0', 'linear')[1])
+
+
+
+def add_tone(zoom, freq, seconds=3., amplitude=1.):
+    """Add a tone on two channels, the second at half amplitude, in
+    blocks that are not a multiple of the decimation"""
+    t = np.arange(int(zoom.rate * seconds)) / zoom.rate
+    x = amplitude * np.sin(2 * np.pi * freq * t)
+    for i in range(0, len(x), 997):
+        block = x[i:i + 997]
+        zoom.add(['AIN0', 'AIN1'], np.stack([block, 0.5 * block]))
+
+
+def test_zoom_spectrum_tone_in_band():
+    zoom = ZoomSpectrum(10000., 1000., 1100., resolution=1.)
+    add_tone(zoom, 1050.3)
+    freqs, psd = zoom.spectra()
+    assert freqs[0] >= 1000 and freqs[-1] < 1100
+    assert np.allclose(np.diff(freqs), 1.)
+    assert freqs[np.argmax(psd[0])] == 1050.
+    # The power in the band is the tone's, A ** 2 / 2, on each channel.
+    power = psd.sum(axis=1) * (freqs[1] - freqs[0])
+    assert np.allclose(power, [0.5, 0.125], rtol=0.01)
+
+
+def test_zoom_spectrum_rejects_tone_out_of_band():
+    for freq in (900., 1200., 3000.):
+        zoom = ZoomSpectrum(10000., 1000., 1100., resolution=1.)
+        add_tone(zoom, freq)
+        freqs, psd = zoom.spectra()
+        assert psd.sum(axis=1).max() * (freqs[1] - freqs[0]) < 1e-6
+
+
+def test_zoom_spectrum_reset():
+    zoom = ZoomSpectrum(10000., 1000., 1100., resolution=1.)
+    add_tone(zoom, 1020.)
+    assert zoom.duration() == 1.
+    zoom.reset()
+    assert zoom.spectra() is None and zoom.duration() == 0.
+    # Nothing of the first tone is left after a reset.
+    add_tone(zoom, 1080.)
+    freqs, psd = zoom.spectra()
+    assert freqs[np.argmax(psd[0])] == 1080.
+    assert psd[0][freqs == 1020.] < 1e-6 * psd[0].max()
+
+
+def make_frame(x, sequence, rate=1000.):
+    return {'rate': rate, 'points': len(x), 'new': len(x), 'dropped': 0,
+            'sequence': sequence, 'prefactor': 1.0, 'unit': 'V',
+            'channels': {'AIN0': x}}
+
+
+def test_processor_settings_apply_between_frames():
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal(4096)
+    processor = SpectrumProcessor(workers=1)
+    processor.set_averaging(mode='linear', nperseg=1024)
+    # Nothing changes until the next frame is processed.
+    assert processor._average is None
+    frame = processor.process(make_frame(x, 1))
+    assert len(frame['spectra']['AIN0'][0]) == 513
+    assert processor._averager.count() == 7
+    processor.reset_average()
+    processor.set_averaging(nperseg=512)
+    assert processor._averager.count() == 7
+    frame = processor.process(make_frame(x, 2))
+    assert len(frame['spectra']['AIN0'][0]) == 257
+    processor.set_averaging(mode='off')
+    processor.set_zoom((100, 200), resolution=1.)
+    frame = processor.process(make_frame(x, 3))
+    freqs = frame['spectra']['AIN0'][0]
+    assert freqs.min() >= 100 and freqs.max() <= 200
+
+
+@pytest.mark.parametrize('settings', [
+    {}, {'average': 'linear'}, {'zoom': (100, 200)}, {'spectrogram': 1.}])
+def test_processor_scales_spectra_not_data(settings):
+    rng = np.random.default_rng(2)
+    x = rng.standard_normal(4096)
+    frames = []
+    for prefactor in (1.0, -3.0):
+        processor = SpectrumProcessor(workers=1)
+        if 'average' in settings:
+            processor.set_averaging(mode=settings['average'], nperseg=1024)
+        if 'zoom' in settings:
+            processor.set_zoom(settings['zoom'], resolution=1.)
+        if 'spectrogram' in settings:
+            processor.set_spectrogram(settings['spectrogram'], nperseg=256)
+        data = make_frame(x, 1)
+        data['prefactor'] = prefactor
+        frames.append(processor.process(data))
+    unscaled, scaled = frames
+    # The traces are passed on as they are, not copied.
+    assert scaled['channels']['AIN0'] is x and 'scaled' not in scaled
+    freqs, psd = scaled['spectra']['AIN0']
+    assert np.allclose(freqs, unscaled['spectra']['AIN0'][0])
+    assert np.allclose(psd, 9 * unscaled['spectra']['AIN0'][1])
+    if 'spectrogram' in settings:
+        rows = scaled['spectrogram']['rows']['AIN0']
+        assert len(rows) and np.allclose(
+            rows, 9 * unscaled['spectrogram']['rows']['AIN0'])
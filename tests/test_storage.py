@@ -0,0 +1,152 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from ljsacore import DataHandler, SessionArchive
+
+# Nominal U6 calibration for the +/-10 V range.
+CENTER = 33523.0
+SLOPE = 3.1580578e-4
+
+
+def make_capture(npoints=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = np.round(CENTER + rng.normal(0, 3000, npoints))
+    return {'prefactor': 0.1, 'unit': 'm/s', 'rate': 5000, 'points': npoints,
+            'dropped': 3, 'end_time': 1000.5,
+            'channels': {'AIN0': (counts - CENTER) * SLOPE,
+                         'AIN1': rng.standard_normal(npoints)}}
+
+
+def check_equal(loaded, data):
+    for k in ('prefactor', 'unit', 'rate', 'points', 'dropped'):
+        assert loaded[k] == data[k]
+    assert list(loaded['channels']) == list(data['channels'])
+    for k, v in data['channels'].items():
+        assert np.array_equal(np.asarray(loaded['channels'][k]), v), k
+
+
+@pytest.mark.parametrize('ext', ['.ljsa', '.txt'])
+def test_round_trip(tmp_path, ext):
+    data = make_capture()
+    handler = DataHandler()
+    fpath = str(tmp_path / ("capture" + ext))
+    assert not handler.save_one(fpath, data)
+    check_equal(handler.load_one(fpath), data)
+
+
+def test_binary_encodings(tmp_path):
+    # More distinct values in AIN1 than a uint16 code can index.
+    npoints = 2**16 + 100
+    data = make_capture(npoints)
+    data['channels']['AIN2'] = np.zeros(0)
+    fpath = str(tmp_path / "capture.ljsa")
+    DataHandler().save_one(fpath, data)
+    loaded = DataHandler().load_one(fpath)
+    check_equal(loaded, data)
+    # ADC samples as a table of levels, decoded on loading; anything else
+    # as float64, memory-mapped.
+    assert not isinstance(loaded['channels']['AIN0'], np.memmap)
+    assert isinstance(loaded['channels']['AIN1'], np.memmap)
+    nlevels = len(np.unique(data['channels']['AIN0']))
+    assert os.path.getsize(fpath) < npoints * (2 + 8) + nlevels * 8 + 4096
+
+
+def test_exclusive(tmp_path):
+    fpath = str(tmp_path / "capture.ljsa")
+    handler = DataHandler()
+    handler.save_one(fpath, make_capture())
+    with pytest.raises(FileExistsError):
+        handler.save_one(fpath, make_capture(), exclusive=True)
+
+
+def make_archive(fpath, n=3):
+    archive = SessionArchive(fpath, writable=True)
+    captures = [make_capture(2000, seed=i) for i in range(n)]
+    for i, data in enumerate(captures):
+        archive.append(data, timestamp=100. + i)
+    return captures
+
+
+def test_archive_round_trip(tmp_path):
+    fpath = str(tmp_path / "session.ljsarc")
+    captures = make_archive(fpath)
+    archive = SessionArchive(fpath)
+    assert len(archive) == 3
+    for i, data in enumerate(captures):
+        entry = archive.index[i]
+        assert entry['time'] == 100. + i
+        assert entry['channels'] == ['AIN0', 'AIN1']
+        assert entry['dropped'] == 3
+        check_equal(archive.load(i), data)
+        preview = archive.preview(i)
+        v = data['channels']['AIN0']
+        assert np.isclose(preview['channels']['AIN0']['max'].max(), v.max())
+        assert np.isclose(preview['channels']['AIN0']['min'].min(), v.min())
+    # load_one gives the last capture.
+    check_equal(DataHandler().load_one(fpath), captures[-1])
+
+
+def test_archive_index_rebuilt(tmp_path):
+    fpath = str(tmp_path / "session.ljsarc")
+    make_archive(fpath)
+    index = SessionArchive(fpath).index
+    # A lost index is rebuilt from the records.
+    os.remove(fpath + SessionArchive.INDEX_SUFFIX)
+    assert SessionArchive(fpath).index == index
+    # So is one that fell behind, with a partly written last line.
+    with open(fpath + SessionArchive.INDEX_SUFFIX, 'w') as fh:
+        fh.write(json.dumps(index[0]) + '\n' + json.dumps(index[1])[:20])
+    assert SessionArchive(fpath).index == index
+
+
+def test_archive_partial_record_discarded(tmp_path):
+    fpath = str(tmp_path / "session.ljsarc")
+    captures = make_archive(fpath, 2)
+    size = os.path.getsize(fpath)
+    # As if writing a third capture was interrupted.
+    with open(fpath, 'ab') as fh:
+        fh.write(SessionArchive.RECORD_MAGIC + b'\xff' * 100)
+    assert len(SessionArchive(fpath)) == 2
+    archive = SessionArchive(fpath, writable=True)
+    assert os.path.getsize(fpath) == size
+    archive.append(captures[0])
+    check_equal(SessionArchive(fpath).load(2), captures[0])
+
+
+@pytest.mark.parametrize('fmt', ['archive', 'binary', 'json'])
+def test_convert_force_replaces(tmp_path, fmt):
+    from ljsaconvert import convert
+    src = str(tmp_path / ("capture" + (".txt" if fmt != 'json' else ".ljsa")))
+    data = make_capture(1000)
+    handler = DataHandler()
+    handler.save_one(src, data)
+    dst = convert(handler, src, fmt)
+    assert convert(handler, src, fmt) is None
+    assert convert(handler, src, fmt, force=True) == dst
+    if fmt == 'archive':
+        assert len(SessionArchive(dst)) == 1
+    check_equal(handler.load_one(dst), data)
+
+
+@pytest.mark.parametrize('fmt', ['binary', 'archive'])
+def test_save_all_names(tmp_path, fmt):
+    handler = DataHandler(fmt=fmt)
+    handler.set_save_all(str(tmp_path))
+    captures = [make_capture(1000, seed=i) for i in range(3)]
+    for data in captures:
+        handler.save_continuous(data)
+    handler.flush(timeout=5)
+    names = sorted(os.listdir(str(tmp_path)))
+    # No colons, which Windows does not allow in file names.
+    assert names and not any(':' in n for n in names)
+    if fmt == 'archive':
+        archive = SessionArchive(str(tmp_path / names[0]))
+        for i, data in enumerate(captures):
+            check_equal(archive.load(i), data)
+    else:
+        assert len(names) == 3
+        for name, data in zip(names, captures):
+            check_equal(handler.load_one(str(tmp_path / name)), data)
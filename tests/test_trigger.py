@@ -0,0 +1,54 @@
+import numpy as np
+
+from ljsacore import LevelCondition, Trigger, parse_condition
+
+RATE = 1000
+
+
+def make_stream(spikes, n=6000):
+    x = np.zeros(n)
+    x[spikes] = 5.
+    return x
+
+
+def frames(x, window=1000, hop=500, start_sequence=1):
+    """Half-overlapping windows of x, as from continuous streaming"""
+    for i, end in enumerate(range(window, len(x) + 1, hop)):
+        yield {'rate': RATE, 'points': window, 'new': hop, 'dropped': 0,
+               'sequence': start_sequence + i, 'prefactor': 1.0,
+               'unit': 'V', 'end_time': 100. + end / RATE,
+               'channels': {'AIN0': x[end - window:end],
+                            'AIN1': -x[end - window:end]}}
+
+
+def test_pre_and_post_windows():
+    x = make_stream([2300, 2450, 3500])
+    trigger = Trigger([LevelCondition('AIN0', 1.)], pre=0.2, post=0.3)
+    events = []
+    for i, data in enumerate(frames(x)):
+        for event in trigger.feed(data):
+            events.append((i, event))
+    # The spike at 2450 falls within the first event, so is not another.
+    assert len(events) == 2
+    for (i, event), t, end in zip(events, (2300, 3500), (3000, 4000)):
+        # Returned with the first frame holding all its post samples.
+        assert 1000 + 500 * i == end
+        assert event['points'] == 500
+        assert np.array_equal(event['channels']['AIN0'], x[t - 200:t + 300])
+        assert np.array_equal(event['channels']['AIN1'], -x[t - 200:t + 300])
+        assert event['trigger']['pre'] == 0.2
+        assert np.isclose(event['trigger']['time'], 100. + t / RATE)
+        assert event['trigger']['condition'] == 'level:AIN0>1'
+    assert trigger.stats['events'] == 2
+    assert trigger.stats['saved'] == 2 * 500 * 2
+
+
+def test_gap_returns_partial_event():
+    x = make_stream([2800])
+    trigger = Trigger([parse_condition('level:AIN0>1')], pre=0.2, post=0.5)
+    stream = list(frames(x))
+    # The frame ending at 3000 has the spike; then a window is missed.
+    assert sum(len(trigger.feed(d)) for d in stream[:5]) == 0
+    events = trigger.feed(stream[6])
+    assert len(events) == 1
+    assert np.array_equal(events[0]['channels']['AIN0'], x[2600:3000])